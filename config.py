@@ -4,9 +4,10 @@ import ast
 from pathlib import Path
 
 
-def init():
-    use_case = '2018_GLOBAL'  # Prefered kept as capitals as the default section of config.ini has to.
-    place = 'home'
+def init(use_case=None,
+         place='home'):
+    if use_case is None:
+        use_case = '2018_GLOBAL'  # Prefered kept as capitals as the default section of config.ini has to.
 
     # Set initial parameters
     root_path = Path(r'C:\Users\Simon\PycharmProjects\rnd-private')
@@ -55,12 +56,25 @@ def import_my_cases(use_case, place, root_path, base_path, case_path):
                 'year_first': cases.get(use_case, 'year_first'),
                 'year_last': cases.get(use_case, 'year_last'),
                 'rnd_limit': cases.getfloat(use_case, 'rnd_limit'),
+                'coverage_limits': [float(limit) for limit in cases.getlist(use_case, 'coverage_limits')],
                 'methods': cases.getlist(use_case, 'methods'),
                 'company_types': cases.getlist(use_case, 'company_types'),
                 'parent_id_files_n': ast.literal_eval(cases.get(use_case, 'parent_id_files_n')),
                 'parent_fin_files_n': cases.getint(use_case, 'parent_fin_files_n'),
                 'sub_id_files_n': cases.getint(use_case, 'sub_id_files_n'),
                 'sub_fin_files_n': cases.getint(use_case, 'sub_fin_files_n'),
+                'loader_workers': cases.getint(use_case, 'loader_workers'),
+                'screening_workers': cases.getint(use_case, 'screening_workers'),
+                'cache_root': case_path.joinpath(cases.get(use_case, 'cache_root'))
+                if cases.getboolean(use_case, 'use_cache') else None,
+                'float32': cases.getboolean(use_case, 'float32'),
+                'select_sub_fins': cases.getboolean(use_case, 'select_sub_fins'),
+                'exposure_by_year': cases.getboolean(use_case, 'exposure_by_year'),
+                'sparse_allocation': cases.getboolean(use_case, 'sparse_allocation'),
+                'background_writes': cases.getboolean(use_case, 'background_writes'),
+                'trace_memory': cases.getboolean(use_case, 'trace_memory'),
+                'previous_case_root': case_path.joinpath(cases.get(use_case, 'previous_case_root'))
+                if cases.get(use_case, 'previous_case_root') else None,
                 'root': root_path,
                 'base': base_path
                 }
@@ -100,8 +114,29 @@ def import_my_files(cases):
                    'rnd': config.get('RND_OUTPUT', 'rnd')
                    }
 
+    # Format of intermediate outputs, bvd9 lists remaining csv files to be uploaded in Orbis
+    output_format = config.get('OUTPUT_FORMAT', 'format')
+
+    compression = config.get('OUTPUT_FORMAT', 'compression')
+
+    my_files['output_options'] = {
+        'compression': None if compression == 'None' else compression,
+        'csv_export': config.getboolean('OUTPUT_FORMAT', 'csv_export')
+    }
+
+    # Entity registry interning company identifiers, persisted with the case
+    my_files['entities'] = cases['case_root'].joinpath(config.get('RND_OUTPUT', 'entities') + '.' + output_format)
+
+    # Reference tables shared by all cases
+    my_files['ref_tables'] = {'mnc_ids': cases['root'].joinpath(config.get('REF_TABLES', 'mnc_ids'))}
+
+    # Aggregation cube of sub rnd estimates, persisted with the case
+    my_files['cube'] = cases['case_root'].joinpath(config.get('RND_OUTPUT', 'cube') + '.' + output_format)
+
     for key, value in rnd_outputs.items():
-        my_files['rnd_outputs']['parents'][key] = cases['case_root'].joinpath(value + ' - parents.csv')
-        my_files['rnd_outputs']['subs'][key] = cases['case_root'].joinpath(value + ' - subsidiaries.csv')
+        extension = '.csv' if key in ['bvd9_full', 'bvd9_short'] else '.' + output_format
+
+        my_files['rnd_outputs']['parents'][key] = cases['case_root'].joinpath(value + ' - parents' + extension)
+        my_files['rnd_outputs']['subs'][key] = cases['case_root'].joinpath(value + ' - subsidiaries' + extension)
 
     return my_files
@@ -1,121 +1,856 @@
+import hashlib
+import inspect
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+# Dtype policy applied to every table entering the pipeline
+# - identifiers kept as strings when read from intermediate outputs
+STR_COLS = ['bvd9', 'bvd_id', 'legal_entity_id', 'NACE_4Dcode',
+            'sub_bvd9', 'sub_bvd_id', 'sub_legal_entity_id', 'sub_NACE_4Dcode',
+            'guo_bvd9', 'guo_bvd_id', 'guo_legal_entity_id', 'entity_bvd9']
+# - identifiers interned as int32 entity keys of the entity registry, turned back into strings when written
+ID_COLS = ['bvd9', 'sub_bvd9', 'guo_bvd9']
+# - low cardinality attributes always turned into categoricals
+CATEGORY_SUFFIXES = ('country_2DID_iso', 'country_3DID_iso', 'world_player', 'NACE_4Dcode', 'NACE_desc', 'guo_type',
+                     'method')
+# - boolean flags
+FLAG_PREFIXES = ('is_', 'keep_')
+# - yearly financials, optionally downcast to float32
+FIN_PREFIXES = ('op_revenue_y', 'rnd_y', 'sales_y', 'Emp_number_y')
+
+# Background writer persisting intermediate outputs while the next stages run
+# - a single thread so that successive writes of a same file land in order
+WRITER = {'executor': None, 'pending': {}}
+
+# Entity registry mapping every bvd9, sub_bvd9 and guo_bvd9 to a dense int32 key, its position in the registry
+# - the registry only grows so that keys handed out stay valid, also for tables pending in the background writer
+# - ranks give the position of each key once identifiers are sorted as strings
+ENTITIES = {'ids': pd.Index([], dtype=object), 'ranks': None, 'path': None}
+# - key of missing identifiers
+MISSING_ID = -1
+
+
+def compact_dtypes(df,
+                   flags=None,
+                   float32=False,
+                   id_ratio=0.5):
+    """
+    Apply the pipeline dtype policy to a table
+    :param df: DataFrame to convert
+    :param flags: list of boolean columns on top of is_*, keep_* and keyword_mask (e.g. keyword categories)
+    :param float32: downcast yearly financials from float64 to float32
+    :param id_ratio: identifiers with less unique values than id_ratio * rows are turned into categoricals
+    :return: converted DataFrame and dictionary of memory usage before and after conversion in MB
+    """
+    flags = ['keyword_mask'] + (flags or [])
+
+    before = df.memory_usage(deep=True).sum()
+
+    conversions = {}
+
+    for col in df.columns:
+        if df[col].dtype == object:
+            if str(col).endswith(CATEGORY_SUFFIXES) or (col in ID_COLS and df[col].nunique() < id_ratio * len(df)):
+                conversions[col] = 'category'
+            # Flags are only converted when complete as NaN would otherwise turn into True
+            elif (str(col).startswith(FLAG_PREFIXES) or col in flags) and df[col].notna().all():
+                conversions[col] = bool
+        elif float32 and df[col].dtype == 'float64' and str(col).startswith(FIN_PREFIXES):
+            conversions[col] = 'float32'
+
+    if conversions:
+        df = df.astype(conversions, copy=False)
+
+    after = df.memory_usage(deep=True).sum()
+
+    return df, {'before_MB': round(before / 2 ** 20, 3),
+                'after_MB': round(after / 2 ** 20, 3),
+                'saved_MB': round((before - after) / 2 ** 20, 3)}
+
+
+def read_table(file_path,
+               usecols=None,
+               flags=None,
+               float32=False):
+    """
+    Read an intermediate output table in the format given by its extension (csv, parquet or feather) and apply the
+    dtype policy
+    :param file_path: path to the table file
+    :param usecols: list of columns to read (None for all), returned in file order as with read_csv
+    :param flags: list of boolean columns on top of is_*, keep_* and keyword_mask
+    :param float32: downcast yearly financials from float64 to float32
+    :return: DataFrame and dictionary of memory usage before and after conversion in MB
+    """
+    wait_for_tables([file_path])
+
+    suffix = Path(file_path).suffix
+
+    if suffix == '.parquet':
+        df = pd.read_parquet(
+            file_path,
+            columns=[col for col in pq.read_schema(file_path).names if usecols is None or col in usecols]
+        )
+    elif suffix == '.feather':
+        # Feather files are memory mapped so that columns are selected after reading
+        df = pd.read_feather(file_path)
+
+        if usecols is not None:
+            df = df[[col for col in df.columns if col in usecols]]
+    else:
+        df = pd.read_csv(
+            file_path,
+            usecols=usecols,
+            na_values='#N/A',
+            dtype={
+                col: str for col in STR_COLS
+            }
+        )
+
+    return compact_dtypes(encode_ids(df), flags, float32)
+
+
+def init_entities(file_path):
+    """
+    Load the entity registry persisted with a case, or start an empty one
+    :param file_path: path to the registry table, its extension giving the format (csv, parquet or feather)
+    :return: number of registered entities
+    """
+    ENTITIES['path'] = Path(file_path)
+    ENTITIES['ranks'] = None
+
+    if ENTITIES['path'].exists():
+        registry = read_table(ENTITIES['path'])[0].sort_values('entity_id')
+
+        ENTITIES['ids'] = pd.Index(registry['entity_bvd9'].astype(str).values, dtype=object)
+    else:
+        ENTITIES['ids'] = pd.Index([], dtype=object)
+
+    return len(ENTITIES['ids'])
+
+
+def save_entities(compression=None,
+                  csv_export=False):
+    """
+    Persist the entity registry with the case
+    :param compression: compression of parquet files (e.g. snappy, gzip, None)
+    :param csv_export: also export a binary table as csv next to it
+    :return: Nothing
+    """
+    ids = ENTITIES['ids']
+
+    write_table(pd.DataFrame({'entity_id': np.arange(len(ids), dtype='int32'), 'entity_bvd9': ids.values}),
+                ENTITIES['path'],
+                compression=compression,
+                csv_export=csv_export
+                )
+
+
+def entity_keys(ids):
+    """
+    Intern identifiers as entity keys, registering identifiers seen for the first time
+    New identifiers are registered in sorted order
+    :param ids: list-like of identifiers, numbers being registered as their string representation
+    :return: int32 array of entity keys, MISSING_ID for missing identifiers
+    """
+    ids = pd.Series(ids).astype(object)
+
+    is_id = ids.notna().values
+    names = ids[is_id].astype(str).values
+
+    keys = np.full(len(ids), MISSING_ID, dtype='int32')
+
+    positions = ENTITIES['ids'].get_indexer(names)
+
+    if (positions < 0).any():
+        new_ids = np.sort(pd.unique(names[positions < 0]))
+
+        ENTITIES['ids'] = ENTITIES['ids'].append(pd.Index(new_ids, dtype=object))
+        ENTITIES['ranks'] = None
+
+        positions[positions < 0] = ENTITIES['ids'].get_indexer(names[positions < 0])
+
+    keys[is_id] = positions
+
+    return keys
+
+
+def entity_names(keys):
+    """
+    Turn entity keys back into identifiers
+    :param keys: list-like of entity keys, missing values and MISSING_ID standing for missing identifiers
+    :return: object array of identifiers, NaN for missing identifiers
+    """
+    keys = pd.Series(keys).fillna(MISSING_ID).astype('int64').values
+
+    # MISSING_ID picks the trailing NaN
+    return np.append(ENTITIES['ids'].values, np.nan)[keys]
+
+
+def entity_ranks(keys):
+    """
+    Rank entity keys as their identifiers sort as strings, missing identifiers last
+    :param keys: list-like of entity keys
+    :return: int64 array of ranks
+    """
+    ids = ENTITIES['ids']
+
+    if ENTITIES['ranks'] is None:
+        ranks = np.empty(len(ids) + 1, dtype='int64')
+
+        ranks[ids.argsort()] = np.arange(len(ids))
+        ranks[-1] = len(ids)
+
+        ENTITIES['ranks'] = ranks
+
+    return ENTITIES['ranks'][pd.Series(keys).fillna(MISSING_ID).astype('int64').values]
+
+
+def sort_by_ids(df,
+                col):
+    """
+    Order a table keyed by entities as the identifiers of one of its id columns sort as strings
+    Tables grouped by entity key are ordered by key, that is by order of registration, instead of by identifier
+    :param df: DataFrame with an id column of entity keys
+    :param col: id column to sort by
+    :return: sorted DataFrame with a new index
+    """
+    return df.iloc[np.argsort(entity_ranks(df[col]), kind='mergesort')].reset_index(drop=True)
+
+
+def encode_ids(df):
+    """
+    Intern the id columns of a table as entity keys, columns already holding keys being left as they are
+    :param df: DataFrame to convert
+    :return: converted DataFrame
+    """
+    cols = [col for col in ID_COLS if col in df.columns and not is_numeric_dtype(df[col])]
+
+    return df.assign(**{col: entity_keys(df[col]) for col in cols}) if cols else df
+
+
+def decode_ids(df):
+    """
+    Turn the entity keys of the id columns of a table back into identifiers
+    :param df: DataFrame to convert
+    :return: converted DataFrame
+    """
+    cols = [col for col in ID_COLS if col in df.columns and is_numeric_dtype(df[col]) and not is_bool_dtype(df[col])]
+
+    return df.assign(**{col: entity_names(df[col]) for col in cols}) if cols else df
+
+
+def ids_to_str(df):
+    """
+    Turn identifiers parsed from Excel as a mix of numbers and strings into strings, as when read back from csv, so
+    that they can be stored in typed binary formats
+    :param df: DataFrame to convert
+    :return: converted DataFrame
+    """
+    cols = [col for col in STR_COLS if col in df.columns and df[col].dtype == object]
+
+    return df.assign(**{col: df[col].where(df[col].isna(), df[col].astype(str)) for col in cols})
+
+
+def table_to_file(df,
+                  file_path,
+                  compression=None,
+                  csv_export=False):
+    """
+    Write a table in the format given by its extension (csv, parquet or feather) through a temporary file so that an
+    interrupted write never leaves a truncated output
+    :param df: DataFrame to write
+    :param file_path: path to the table file
+    :param compression: compression of parquet files (e.g. snappy, gzip, None)
+    :param csv_export: also export a binary table as csv next to it
+    :return: Nothing
+    """
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(file_path.name + '.tmp')
+
+    df = decode_ids(df)
+
+    if file_path.suffix in ['.parquet', '.feather']:
+        df = ids_to_str(df)
+
+    if file_path.suffix == '.parquet':
+        df.to_parquet(tmp_path, compression=compression, index=False)
+    elif file_path.suffix == '.feather':
+        df.reset_index(drop=True).to_feather(tmp_path)
+    else:
+        df.to_csv(tmp_path,
+                  float_format='%.10f',
+                  index=False,
+                  na_rep='#N/A'
+                  )
+
+    os.replace(tmp_path, file_path)
+
+    if csv_export and file_path.suffix != '.csv':
+        table_to_file(df, file_path.with_suffix('.csv'))
+
+
+def start_background_writer():
+    """
+    Persist tables passed to write_table in a background thread instead of blocking the pipeline
+    :return: Nothing
+    """
+    if WRITER['executor'] is None:
+        WRITER['executor'] = ThreadPoolExecutor(max_workers=1)
+
+
+def write_table(df,
+                file_path,
+                columns=None,
+                compression=None,
+                csv_export=False):
+    """
+    Persist an intermediate output table, in the background if the background writer is started
+    The table is snapshotted first so that the caller can go on modifying it
+    :param df: DataFrame to write
+    :param file_path: path to the table file, its extension giving the format (csv, parquet or feather)
+    :param columns: list of columns to write (None for all)
+    :param compression: compression of parquet files (e.g. snappy, gzip, None)
+    :param csv_export: also export a binary table as csv next to it
+    :return: Nothing
+    """
+    snapshot = df[columns] if columns is not None else df.copy()
+
+    if WRITER['executor'] is None:
+        table_to_file(snapshot, file_path, compression, csv_export)
+        return
+
+    # Remove the previous version right away so that a run stopped before the write completes leaves no stale output
+    wait_for_tables([file_path])
+
+    if Path(file_path).exists():
+        os.remove(file_path)
+
+    WRITER['pending'][str(file_path)] = WRITER['executor'].submit(table_to_file, snapshot, file_path, compression,
+                                                                 csv_export)
+
+
+def wait_for_tables(file_paths):
+    """
+    Wait for the pending background writes of some tables
+    :param file_paths: list of paths to the csv files
+    :return: Nothing
+    """
+    futures = [WRITER['pending'].pop(str(file_path)) for file_path in file_paths
+               if str(file_path) in WRITER['pending']]
+
+    for future in futures:
+        future.result()
+
+
+def flush_tables():
+    """
+    Wait for all pending background writes and stop the background writer
+    :return: Nothing
+    """
+    if WRITER['executor'] is None:
+        return
+
+    pending_n = len(WRITER['pending'])
+
+    if pending_n:
+        print('Wait for ' + str(pending_n) + ' output(s) to be written ...')
+
+    wait_for_tables(list(WRITER['pending'].keys()))
+
+    WRITER['executor'].shutdown()
+    WRITER['executor'] = None
+
+
+def file_digest(file_path,
+                chunk_size=2 ** 20):
+    """
+    Hash the content of a file
+    :param file_path: path of the file to hash
+    :param chunk_size: number of bytes read at a time
+    :return: sha256 hex digest
+    """
+    sha = hashlib.sha256()
+
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def is_code_of(value,
+               packages):
+    name = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+
+    return isinstance(name, str) and any(name == package or name.startswith(package + '.') for package in packages)
+
+
+def is_constant(value):
+    """
+    Check whether a module global is a constant such as a list of column names, as opposed to the dictionaries and
+    lists holding the state of a module (e.g. ENTITIES)
+    """
+    if isinstance(value, (str, int, float)):
+        return True
+
+    return isinstance(value, (list, tuple)) and all(isinstance(item, str) for item in value)
+
+
+def code_names(code):
+    """
+    List the global and attribute names referenced by compiled code, including its nested functions, lambdas and
+    comprehensions
+    :param code: code object
+    :return: set of names
+    """
+    names = set(code.co_names)
+
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= code_names(const)
+
+    return names
+
+
+def code_sources(functions,
+                 packages):
+    """
+    Collect the source of functions and of the functions and constants of the given packages they reference, directly
+    or through other helpers, so that a fingerprint of functions only changes with the code they run
+    Helpers are found from the names referenced in function code, either as globals of the function module or as
+    attributes of the modules it imports (e.g. load.read_table)
+    :param functions: list of functions
+    :param packages: list of top level packages and modules whose functions and constants are collected
+    :return: dictionary of qualified names to sources of functions and representations of constants
+    """
+    sources = {}
+    pending = list(functions)
+
+    while pending:
+        function = inspect.unwrap(pending.pop())
+        qualified_name = function.__module__ + '.' + function.__qualname__
+
+        if qualified_name in sources:
+            continue
+
+        sources[qualified_name] = inspect.getsource(function)
+
+        names = code_names(function.__code__)
+
+        members = {function.__module__ + '.' + name: function.__globals__[name] for name in names
+                   if name in function.__globals__}
+
+        for (member_name, member) in list(members.items()):
+            if inspect.ismodule(member) and is_code_of(member, packages):
+                members.update({member.__name__ + '.' + attr: getattr(member, attr) for attr in names
+                                if hasattr(member, attr)})
+
+        for (member_name, member) in members.items():
+            if inspect.isfunction(member) and is_code_of(inspect.unwrap(member), packages):
+                pending.append(member)
+            elif member_name.split('.')[-1].isupper() and is_constant(member):
+                sources[member_name] = repr(member)
+
+    return sources
+
+
+def loader_schema(read_file):
+    """
+    Fingerprint a parsing function with its source code (names, dtypes, ...), the source of the helpers of this module
+    it runs (read_results_sheet, compact_dtypes, ...) and its bound arguments
+    :param read_file: module level function or functools.partial of it
+    :return: string describing the loader schema
+    """
+    if isinstance(read_file, partial):
+        return repr(sorted(code_sources([read_file.func], [__name__]).items())) + repr(read_file.args) + repr(
+            sorted(read_file.keywords.items()))
+
+    return repr(sorted(code_sources([read_file], [__name__]).items()))
+
+
+def select_rows_n_columns(df,
+                          columns=None,
+                          isin=None):
+    """
+    Keep the requested rows and columns of a parsed export
+    :param df: parsed export
+    :param columns: list of columns to keep (None for all)
+    :param isin: dictionary of column names to the values rows must hold to be kept (None for all rows)
+    :return: selected DataFrame
+    """
+    for col, values in (isin or {}).items():
+        df = df[df[col].isin(values)]
+
+    if columns is not None:
+        df = df[columns]
+
+    return df
+
+
+def parsed_columns(columns,
+                   isin=None):
+    """
+    List the columns to parse to select the requested columns and rows, columns rows are filtered on being parsed too
+    :param columns: list of columns to keep (None for all)
+    :param isin: dictionary of column names to the values rows must hold to be kept (None for all rows)
+    :return: list of columns to parse (None for all)
+    """
+    if columns is None:
+        return None
+
+    return columns + [col for col in (isin or {}) if col not in columns]
+
+
+def select_xls_to_df(read_file,
+                     file_path,
+                     columns=None,
+                     isin=None):
+    """
+    Parse the requested columns of an export with read_file and keep the requested rows only
+    """
+    if columns is None:
+        return select_rows_n_columns(read_file(file_path), isin=isin)
+
+    return select_rows_n_columns(read_file(file_path, columns=parsed_columns(columns, isin)), columns, isin)
+
+
+def cached_xls_to_df(read_file,
+                     file_path,
+                     cache_root,
+                     columns=None,
+                     isin=None):
+    """
+    Parse an export with read_file through a cache of Feather (Arrow IPC) files keyed by content hash and loader schema
+    :param read_file: module level function parsing a single export into a DataFrame
+    :param file_path: path to the export
+    :param cache_root: folder of the cached files
+    :param columns: list of columns to read (None for all), the cache always holds the full export
+    :param isin: dictionary of column names to the values rows must hold to be kept (None for all rows)
+    :return: parsed DataFrame
+    """
+    key = hashlib.sha256((file_digest(file_path) + loader_schema(read_file)).encode()).hexdigest()
+
+    cache_root = Path(cache_root)
+    cache_root.mkdir(parents=True, exist_ok=True)
+
+    # Look the key up whatever the file name so that identical exports of different cases share a cached file
+    cache_path = next(cache_root.glob('* - ' + key[:16] + '.feather'), None)
+
+    if cache_path is not None:
+        return select_rows_n_columns(pd.read_feather(cache_path, columns=parsed_columns(columns, isin)), columns, isin)
+
+    # Only one process parses a given export, others wait for it and read its cached file
+    lock_path = cache_root.joinpath(key[:16] + '.lock')
+
+    locked = acquire_lock(lock_path, Path(file_path).name)
+
+    try:
+        cache_path = next(cache_root.glob('* - ' + key[:16] + '.feather'), None)
+
+        if cache_path is not None:
+            return select_rows_n_columns(pd.read_feather(cache_path, columns=parsed_columns(columns, isin)), columns,
+                                         isin)
+
+        cache_path = cache_root.joinpath(Path(file_path).stem + ' - ' + key[:16] + '.feather')
+
+        df = read_file(file_path)
+
+        # Write to a temporary file first so that an interrupted run never leaves a truncated cache behind
+        tmp_path = cache_path.with_name(cache_path.name + '.' + str(os.getpid()) + '.tmp')
+
+        try:
+            df.reset_index(drop=True).to_feather(tmp_path)
+            os.replace(tmp_path, cache_path)
+        except (ValueError, TypeError) as error:
+            print('... not cached (' + str(error) + ')')
+
+            if tmp_path.exists():
+                tmp_path.unlink()
+    finally:
+        if locked:
+            lock_path.unlink()
+
+    return select_rows_n_columns(df, columns, isin)
+
+
+def acquire_lock(lock_path,
+                 name,
+                 stale_after=3600):
+    """
+    Create a lock file, waiting while another process holds it
+    :param lock_path: path to the lock file
+    :param name: name of the locked resource for progress messages
+    :param stale_after: age in seconds after which a lock is considered left over by a stopped process
+    :return: True if the lock was acquired, False if the lock was stale and is ignored
+    """
+    waiting = False
+
+    while True:
+        try:
+            os.close(os.open(str(lock_path), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            pass
+
+        try:
+            age = time.time() - lock_path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+
+        if age > stale_after:
+            return False
+
+        if not waiting:
+            print('... wait for another process parsing ' + name)
+            waiting = True
+
+        time.sleep(1)
+
+
+def orbis_xls_to_df(read_file,
+                    file_paths,
+                    workers=1,
+                    cache_root=None,
+                    columns=None,
+                    float32=False,
+                    isin=None):
+    """
+    Parse a list of ORBIS exports and consolidate them in file order
+    :param read_file: module level function parsing a single export into a DataFrame
+    :param file_paths: list of paths to the exports
+    :param workers: number of worker processes parsing the exports concurrently (1 for sequential)
+    :param cache_root: folder of the parsed exports cache (None to always parse the exports)
+    :param columns: list of columns to keep from each export (None for all)
+    :param float32: downcast yearly financials from float64 to float32
+    :param isin: dictionary of column names to the values rows must hold to be kept, applied to each export as soon
+    as it is parsed (None for all rows)
+    :return: consolidated DataFrame with the dtype policy applied
+    """
+    dfs = []
+
+    if cache_root is not None:
+        read_file = partial(cached_xls_to_df, read_file, cache_root=cache_root, columns=columns, isin=isin)
+    elif columns is not None or isin is not None:
+        read_file = partial(select_xls_to_df, read_file, columns=columns, isin=isin)
+
+    if workers > 1 and len(file_paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(file_paths))) as executor:
+            # map returns results in submission order so that row order does not depend on scheduling
+            for number, df in enumerate(executor.map(read_file, file_paths), 1):
+                print('File #' + str(number) + '/' + str(len(file_paths)))
+
+                dfs.append(df)
+    else:
+        for number, file_path in enumerate(file_paths, 1):
+            print('File #' + str(number) + '/' + str(len(file_paths)))
+
+            dfs.append(read_file(file_path))
+
+    if not dfs:
+        return pd.DataFrame()
+
+    # Categoricals are built once all files are consolidated so that they share the same categories
+    (df, memory) = compact_dtypes(pd.concat(dfs), float32=float32)
+
+    print('... memory: ' + str(memory['before_MB']) + ' MB -> ' + str(memory['after_MB']) + ' MB')
+
+    return df
+
+
+def read_results_sheet(file_path,
+                       names,
+                       columns=None,
+                       **kwargs):
+    """
+    Read the Results sheet of an ORBIS export, parsing the requested columns only
+    :param file_path: path to the export
+    :param names: list of names of all the columns of the sheet
+    :param columns: list of columns to parse (None for all)
+    :param kwargs: other parameters of read_excel (e.g. na_values, dtype)
+    :return: DataFrame of the parsed columns, in sheet order
+    """
+    usecols = [position for position, name in enumerate(names) if columns is None or name in columns]
+
+    return pd.read_excel(file_path,
+                         sheet_name='Results',
+                         names=[names[position] for position in usecols],
+                         usecols=usecols,
+                         **kwargs
+                         )
+
+
+def parent_ids_from_xls(file_path,
+                        columns=None):
+    # Read input list of companies
+    return read_results_sheet(file_path,
+                              columns=columns,
+                              names=['rank', 'company_name', 'bvd9', 'bvd_id', 'legal_entity_id', 'country_2DID_iso',
+                                     'NACE_4Dcode', 'NACE_desc', 'subs_n',
+                                     'guo_type', 'guo_name', 'guo_bvd9', 'guo_bvd_id', 'guo_legal_entity_id',
+                                     'guo_country_2DID_iso'],
+                              na_values='n.a.',
+                              dtype={
+                                  **{col: str for col in ['company_name', 'bvd9', 'bvd_id', 'legal_entity_id',
+                                                          'country_2DID_iso', 'NACE_4Dcode', 'NACE_desc',
+                                                          'guo_type', 'guo_name', 'guo_bvd9', 'guo_bvd_id',
+                                                          'guo_legal_entity_id', 'guo_country_2DID_iso']}
+                              }
+                              ).drop(columns='rank', errors='ignore')
 
 
 def parent_ids_from_orbis_xls(root,
                               file_number,
-                              company_type):
-    parent_ids = pd.DataFrame()
-
-    for number in list(range(1, file_number + 1)):
-        print('File #' + str(number) + '/' + str(file_number))
-        # Read input list of companies
-        df = pd.read_excel(root.joinpath(str(company_type) + '_parent_ids_#' + str(number) + '.xlsx'),
-                           sheet_name='Results',
-                           names=['rank', 'company_name', 'bvd9', 'bvd_id', 'legal_entity_id', 'country_2DID_iso',
-                                  'NACE_4Dcode', 'NACE_desc', 'subs_n',
-                                  'guo_type', 'guo_name', 'guo_bvd9', 'guo_bvd_id', 'guo_legal_entity_id',
-                                  'guo_country_2DID_iso'],
-                           na_values='n.a.',
-                           dtype={
-                               **{col: str for col in ['company_name', 'bvd9', 'bvd_id', 'legal_entity_id',
-                                                       'country_2DID_iso', 'NACE_4Dcode', 'NACE_desc',
-                                                       'guo_type', 'guo_name', 'guo_bvd9', 'guo_bvd_id',
-                                                       'guo_legal_entity_id', 'guo_country_2DID_iso']}
-                           }
-                           ).drop(columns='rank')
-
-        parent_ids = parent_ids.append(df)
-
-    return parent_ids
+                              company_type,
+                              workers=1,
+                              cache_root=None,
+                              columns=None,
+                              float32=False):
+    return orbis_xls_to_df(
+        parent_ids_from_xls,
+        [root.joinpath(str(company_type) + '_parent_ids_#' + str(number) + '.xlsx')
+         for number in range(1, file_number + 1)],
+        workers,
+        cache_root,
+        columns,
+        float32
+    )
+
+
+def parent_fins_from_xls(file_path,
+                         oprev_ys,
+                         rnd_ys,
+                         LY,
+                         columns=None):
+    # Read input list of company financials
+    return read_results_sheet(file_path,
+                              columns=columns,
+                              names=['rank', 'company_name', 'bvd9', ]
+                                    + ['Emp_number_y' + LY, 'sales_y' + LY]
+                                    + rnd_ys[::-1] + oprev_ys[::-1],
+                              na_values='n.a.',
+                              dtype={
+                                  **{col: str for col in
+                                     ['company_name', 'bvd9']}
+                                  # **{col: float for col in
+                                  #    ['operating_revenue_y' + LY, 'sales_y' + LY, 'Emp_number_y' + LY]
+                                  #    + rnd_ys
+                                  #    }
+                              }
+                              ).drop(columns=['rank'], errors='ignore')
 
 
 def parent_fins_from_orbis_xls(root,
                                file_number,
                                oprev_ys,
                                rnd_ys,
-                               LY):
-    parent_fins = pd.DataFrame()
-
-    for number in list(range(1, file_number + 1)):
-        print('File #' + str(number) + '/' + str(file_number))
-        # Read input list of company financials
-        df = pd.read_excel(root.joinpath('parent_fins_#' + str(number) + '.xlsx'),
-                           sheet_name='Results',
-                           names=['rank', 'company_name', 'bvd9', ]
-                                 + ['Emp_number_y' + LY, 'sales_y' + LY]
-                                 + rnd_ys[::-1] + oprev_ys[::-1],
-                           na_values='n.a.',
-                           dtype={
-                               **{col: str for col in
-                                  ['company_name', 'bvd9']}
-                               # **{col: float for col in
-                               #    ['operating_revenue_y' + LY, 'sales_y' + LY, 'Emp_number_y' + LY]
-                               #    + rnd_ys
-                               #    }
-                           }
-                           ).drop(columns=['rank'])
-
-        parent_fins = parent_fins.append(df)
-
-    return parent_fins
+                               LY,
+                               workers=1,
+                               cache_root=None,
+                               columns=None,
+                               float32=False):
+    return orbis_xls_to_df(
+        partial(parent_fins_from_xls, oprev_ys=oprev_ys, rnd_ys=rnd_ys, LY=LY),
+        [root.joinpath('parent_fins_#' + str(number) + '.xlsx') for number in range(1, file_number + 1)],
+        workers,
+        cache_root,
+        columns,
+        float32
+    )
+
+
+def sub_ids_from_xls(file_path,
+                     columns=None):
+    return read_results_sheet(
+        file_path,
+        columns=columns,
+        na_values=['No data fulfill your filter criteria', 'n.a.'],
+        names=['rank', 'company_name', 'bvd9', 'sub_company_name', 'sub_bvd9', 'sub_bvd_id',
+               'sub_legal_entity_id', 'sub_country_2DID_iso', 'sub_NACE_4Dcode', 'sub_NACE_desc', 'sub_lvl'],
+        dtype={
+            **{col: str for col in
+               ['rank', 'company_name', 'bvd9', 'subsidiary_name', 'sub_bvd9',
+                'sub_bvd_id', 'sub_legal_entity_id', 'sub_country_2DID_iso', 'sub_NACE_4Dcode', 'sub_NACE_desc']}
+            # 'sub_lvl': pd.Int8Dtype()
+        }
+    ).drop(columns=['rank'], errors='ignore')
 
 
 def sub_ids_from_orbis_xls(root,
-                           file_number):
-    sub_ids = pd.DataFrame()
-
-    for number in list(range(1, file_number + 1)):
-        print('File #' + str(number) + '/' + str(file_number))
-        df = pd.read_excel(
-            root.joinpath('sub_ids_#' + str(number) + '.xlsx'),
-            sheet_name='Results',
-            na_values=['No data fulfill your filter criteria', 'n.a.'],
-            names=['rank', 'company_name', 'bvd9', 'sub_company_name', 'sub_bvd9', 'sub_bvd_id',
-                   'sub_legal_entity_id', 'sub_country_2DID_iso', 'sub_NACE_4Dcode', 'sub_NACE_desc', 'sub_lvl'],
-            dtype={
-                **{col: str for col in
-                   ['rank', 'company_name', 'bvd9', 'subsidiary_name', 'sub_bvd9',
-                    'sub_bvd_id', 'sub_legal_entity_id', 'sub_country_2DID_iso', 'sub_NACE_4Dcode', 'sub_NACE_desc']}
-                # 'sub_lvl': pd.Int8Dtype()
-            }
-        ).drop(columns=['rank'])
+                           file_number,
+                           workers=1,
+                           cache_root=None,
+                           columns=None,
+                           float32=False):
+    # Consolidate list of subsidiaries
+    return orbis_xls_to_df(
+        sub_ids_from_xls,
+        [root.joinpath('sub_ids_#' + str(number) + '.xlsx') for number in range(1, file_number + 1)],
+        workers,
+        cache_root,
+        columns,
+        float32
+    )
 
-        # Consolidate list of subsidiaries
-        sub_ids = sub_ids.append(df)
 
-    return sub_ids
+def sub_fins_from_xls(file_path,
+                      oprev_ys,
+                      rnd_ys,
+                      LY,
+                      columns=None):
+    return read_results_sheet(file_path,
+                              columns=columns,
+                              names=['rank', 'sub_company_name', 'sub_bvd9'] +
+                                    ['trade_desc', 'products&services_desc', 'full_overview_desc'] +
+                                    oprev_ys[::-1] + rnd_ys[::-1],
+                              na_values='n.a.',
+                              dtype={
+                                  **{col: str for col in
+                                     ['sub_company_name', 'sub_bvd9', 'trade_desc', 'products&services_desc',
+                                      'full_overview_desc']}
+                                  # **{col: float for col in oprev_ys[::-1] + rnd_ys[::-1]}
+                              }
+                              ).drop(columns=['rank'], errors='ignore')
 
 
 def sub_fins_from_orbis_xls(root,
                             file_number,
                             oprev_ys,
                             rnd_ys,
-                            LY):
-    sub_fins = pd.DataFrame()
-
-    for number in list(range(1, file_number + 1)):
-        print('File #' + str(number) + '/' + str(file_number))
-        df = pd.read_excel(root.joinpath('sub_fin_#' + str(number) + '.xlsx'),
-                           sheet_name='Results',
-                           names=['rank', 'sub_company_name', 'sub_bvd9'] +
-                                 ['trade_desc', 'products&services_desc', 'full_overview_desc'] + oprev_ys[
-                                                                                                  ::-1] + rnd_ys[::-1],
-                           na_values='n.a.',
-                           dtype={
-                               **{col: str for col in
-                                  ['sub_company_name', 'sub_bvd9', 'trade_desc', 'products&services_desc',
-                                   'full_overview_desc']}
-                               # **{col: float for col in oprev_ys[::-1] + rnd_ys[::-1]}
-                           }
-                           ).drop(columns=['rank'])
-
-        # Consolidate subsidiaries financials
-        sub_fins = sub_fins.append(df)
-
-    return sub_fins
-
-
-def soeur_rnd_from_xls(file_path):
+                            LY,
+                            workers=1,
+                            cache_root=None,
+                            columns=None,
+                            float32=False,
+                            sub_bvd9_ids=None):
+    # Consolidate subsidiaries financials
+    return orbis_xls_to_df(
+        partial(sub_fins_from_xls, oprev_ys=oprev_ys, rnd_ys=rnd_ys, LY=LY),
+        [root.joinpath('sub_fin_#' + str(number) + '.xlsx') for number in range(1, file_number + 1)],
+        workers,
+        cache_root,
+        columns,
+        float32,
+        None if sub_bvd9_ids is None else {'sub_bvd9': sub_bvd9_ids}
+    )
+
+
+def soeur_rnd_from_xls(file_path,
+                       cache_root=None):
+    if cache_root is not None:
+        return cached_xls_to_df(soeur_rnd_xls_to_df, file_path, cache_root)
+
+    return soeur_rnd_xls_to_df(file_path)
+
+
+def soeur_rnd_xls_to_df(file_path):
     names_2019b = ['Group_Id', 'Group_Name', 'Group_Country', 'Id_Group_Region', 'Group_Region',
                    'Group_MI_member', 'BvD_ID', 'ICB_ID', 'ICB_3_name', 'Nace_ID', 'Sector_UC',
                    'Group_UC', 'RnD_Group_UC', 'Group_Size', 'Group_R&D_MEUR', 'Group_Sales_MEUR',
@@ -163,3 +898,14 @@ def soeur_rnd_from_xls(file_path):
         ['soeur_sub_id', 'soeur_sub_name', 'sub_country_2DID_soeur', 'sub_NUTS1', 'sub_NUTS2', 'sub_NUTS3',
          'technology', 'action', 'priority', 'rnd_clean']
     ]
+
+
+def country_map_from_csv(file_path='https://raw.githubusercontent.com/pysleto/mapping-tables/master/country_table.csv'):
+    """
+    Read the country mapping table
+    :param file_path: url or path of the country table
+    :return: DataFrame of country codes and world players
+    """
+    print('Read country mapping table ...')
+
+    return pd.read_csv(file_path, error_bad_lines=False)
@@ -8,13 +8,14 @@ from data_input import file_loader as load
 
 # TODO: clean and extensive icb table
 
-def update_n_format_soeur_rnd(file):
+def update_n_format_soeur_rnd(file,
+                              cache_root=None):
     """
     Load output form soeur_rnd approach
     """
     print('Read soeur_rnd from xls tables ...')
 
-    soeur_rnd = load.soeur_rnd_from_xls(file)
+    soeur_rnd = load.soeur_rnd_from_xls(file, cache_root)
 
     soeur_rnd = soeur_rnd[(soeur_rnd['action'] != 'z_Others') &
                           (soeur_rnd['technology'] != 'z_Others') &
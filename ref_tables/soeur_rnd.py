@@ -16,7 +16,7 @@ soeur_version = 'SOEUR_rnd_2019b'
 
 soeur_path = Path(r'C:\Users\Simon\PycharmProjects\rnd-private\data_input\soeur_rnd\SOEUR_rnd_2019b_20200309.xlsx')
 
-soeur_rnd = mtd.update_n_format_soeur_rnd(soeur_path)
+soeur_rnd = mtd.update_n_format_soeur_rnd(soeur_path, soeur_path.parent.joinpath('cache'))
 
 print('Save output table')
 print('... at subsidiary level')
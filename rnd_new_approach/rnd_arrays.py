@@ -0,0 +1,140 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+
+def label_years(labels):
+    """
+    Read the years of yearly financial column labels, e.g. rnd_y18 for 2018
+    :param labels: list of column labels ending with a two digit year
+    :return: int array of years
+    """
+    return np.array([int('20' + label[-2:]) for label in labels], dtype='int64')
+
+
+def wide_array(df,
+               cols):
+    """
+    Stack the yearly columns of a table into a dense array of rows by years
+    :param df: DataFrame with yearly financial columns
+    :param cols: list of yearly columns, in year order
+    :return: float array of rows by years
+    """
+    # Financials downcast to float32 stay in float32
+    return df[cols].to_numpy(dtype=np.result_type(np.float32, *df[cols].dtypes))
+
+
+def take_rows(array,
+              rows):
+    """
+    Select the rows of a dense array, missing rows reading as missing values
+    :param array: float array of rows by years, or of rows
+    :param rows: int array of row positions, -1 for missing rows
+    :return: float array of the selected rows by years, or of the selected rows
+    """
+    # Column-major so that the selected rows flatten year after year without a copy
+    taken = np.full((len(rows),) + array.shape[1:], np.nan, dtype=array.dtype, order='F')
+    taken[rows >= 0] = array[rows[rows >= 0]]
+
+    return taken
+
+
+def join_rows(left_keys,
+              right_keys):
+    """
+    Pair the rows of two lists of keys as a left merge would, in left order and then right order
+    :param left_keys: int array of entity keys, or list of int arrays for composite keys (e.g. method, bvd9 and year)
+    :param right_keys: int array of entity keys, or list of int arrays for composite keys
+    :return: int arrays of left row positions and right row positions, -1 when a left key has no match
+    """
+    if not isinstance(left_keys, list):
+        (left_keys, right_keys) = ([left_keys], [right_keys])
+
+    keys = ['key' + str(index) for index in range(len(left_keys))]
+
+    left = pd.DataFrame(dict(zip(keys, left_keys)))
+    right = pd.DataFrame(dict(zip(keys, right_keys)))
+
+    pairs = pd.merge(left.assign(left=np.arange(len(left))),
+                     right.assign(right=np.arange(len(right))),
+                     on=keys,
+                     how='left'
+                     )
+
+    return pairs['left'].values, pairs['right'].fillna(-1).values.astype('int64')
+
+
+def group_sums(groups,
+               group_n,
+               array):
+    """
+    Sum the rows of a dense array by group, missing values counting as zero as in a grouped sum
+    :param groups: int array of the group position of each row
+    :param group_n: number of groups
+    :param array: float array of rows by years
+    :return: float array of groups by years
+    """
+    sums = np.zeros((group_n, array.shape[1]))
+
+    for col in range(array.shape[1]):
+        sums[:, col] = np.bincount(groups, weights=np.nan_to_num(array[:, col]), minlength=group_n)
+
+    return sums
+
+
+def dense_array(keys,
+                years,
+                values,
+                index_keys,
+                index_years):
+    """
+    Scatter the values of a long table into a dense array of entities by years
+    :param keys: int array of the entity key of each row
+    :param years: int array of the year of each row
+    :param values: float array of the value of each row
+    :param index_keys: int array of entity keys, the rows of the dense array
+    :param index_years: int array of sorted years, the columns of the dense array
+    :return: float array of entities by years, missing values where the long table has no row
+    """
+    array = np.full((len(index_keys), len(index_years)), np.nan)
+
+    rows = pd.Index(index_keys).get_indexer(keys)
+    cols = np.searchsorted(index_years, years)
+
+    known = (rows >= 0) & (cols < len(index_years))
+    known[known] = index_years[cols[known]] == years[known]
+
+    array[rows[known], cols[known]] = values[known]
+
+    return array
+
+
+def long_table(key_cols,
+               years,
+               arrays,
+               year_major=False):
+    """
+    Materialise dense arrays of entities by years as a long table with one row per entity and year
+    :param key_cols: dictionary of key columns to arrays of one value per entity
+    :param years: int array of years
+    :param arrays: dictionary of value columns to float arrays of entities by years
+    :param year_major: list rows year after year, entities in order within each year (as melt does), instead of
+    entity after entity, years in order within each entity
+    :return: DataFrame of key columns, year and value columns
+    """
+    entity_n = len(next(iter(arrays.values())))
+
+    if year_major:
+        table = {col: np.tile(values, len(years)) for col, values in key_cols.items()}
+        table['year'] = np.repeat(years, entity_n)
+
+        # Column-major arrays flatten year after year without a copy
+        table.update({col: array.reshape(-1, order='F') for col, array in arrays.items()})
+    else:
+        table = {col: np.repeat(values, len(years)) for col, values in key_cols.items()}
+        table['year'] = np.tile(years, entity_n)
+
+        # Row-major arrays flatten entity after entity without a copy
+        table.update({col: array.reshape(-1) for col, array in arrays.items()})
+
+    return pd.DataFrame(table)
@@ -0,0 +1,60 @@
+# Import libraries
+import multiprocessing
+import sys
+from multiprocessing.connection import wait
+
+from rnd_new_approach import rnd_main
+from data_input import file_loader as load
+
+# Use cases run when none are given on the command line
+USE_CASES = ['2018_GLOBAL', '2018_EU_28', '2018_WESTERN_BALKAN']
+
+
+def run_batch(use_cases,
+              workers=None):
+    """
+    Run several use cases of cases.ini in parallel worker processes, each writing to its own case_root
+    Reference tables are read once and handed over to every case. Orbis exports that are identical between cases are
+    parsed once through the cache of parsed files (use_cache and cache_root shared by the cases), other cases waiting
+    for the file being parsed and reading it from the cache
+    :param use_cases: list of cases.ini sections to run
+    :param workers: maximum number of cases running at the same time (None for all at once)
+    :return: dictionary of use cases to the exit codes of their worker process (0 when successful)
+    """
+    country_map = load.country_map_from_csv()
+
+    workers = workers or len(use_cases)
+
+    pending = list(use_cases)
+    running = {}
+    exit_codes = {}
+
+    while pending or running:
+        while pending and len(running) < workers:
+            use_case = pending.pop(0)
+
+            print('Start ' + use_case + ' ...')
+
+            # Worker processes are not daemonic so that they can start their own pool of file loaders
+            process = multiprocessing.Process(target=rnd_main.main, args=(use_case, country_map), name=use_case)
+            process.start()
+
+            running[process.sentinel] = process
+
+        for sentinel in wait(list(running.keys())):
+            process = running.pop(sentinel)
+            process.join()
+
+            exit_codes[process.name] = process.exitcode
+
+            print(process.name + (' done' if process.exitcode == 0 else
+                                  ' failed (exit code ' + str(process.exitcode) + ')'))
+
+    return exit_codes
+
+
+if __name__ == '__main__':
+    # Guard the entry point so that spawned worker processes do not rerun the batch
+    exit_codes = run_batch(sys.argv[1:] or USE_CASES)
+
+    sys.exit(1 if any(exit_codes.values()) else 0)
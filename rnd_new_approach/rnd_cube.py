@@ -0,0 +1,65 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+# Dimensions and measures of the rnd cube, as in the tables returned by merge_n_group_sub_rnd
+DIMENSIONS = ['approach', 'year', 'sub_country_3DID_iso', 'sub_world_player', 'guo_type', 'type', 'cluster', 'method']
+MEASURES = ['sub_rnd_clean', 'is_embedded_in_MNC']
+
+
+def categorize(cube):
+    """
+    Turn the text dimensions of a cube into categoricals, so that slices compare integer codes
+    :param cube: DataFrame of dimensions and measures
+    :return: converted DataFrame
+    """
+    return cube.astype({dim: 'category' for dim in DIMENSIONS if dim in cube.columns and cube[dim].dtype == object})
+
+
+def build_cube(tables):
+    """
+    Aggregate grouped rnd tables into a cube with one row per combination of dimension values
+    :param tables: list of DataFrames with the dimensions and measures of the cube (e.g. grouped sub rnd for all
+    subsidiaries and for subsidiaries embedded in MNC, told apart by approach)
+    :return: DataFrame of dimensions and measures, sorted by dimensions
+    """
+    table = pd.concat(tables, ignore_index=True, sort=False)
+
+    dims = [dim for dim in DIMENSIONS if dim in table.columns]
+
+    cube = table.groupby(dims, observed=True)[MEASURES].sum().reset_index()
+
+    return categorize(cube).sort_values(dims, ignore_index=True)
+
+
+def query(cube,
+          by=None,
+          where=None,
+          measures=None):
+    """
+    Answer a slice, dice or rollup query from a cube without going back to subsidiary level data
+    e.g. query(cube, by=['year', 'sub_world_player'], where={'method': 'keep_all', 'cluster': ['a', 'b']})
+    :param cube: DataFrame returned by build_cube
+    :param by: list of dimensions to keep, the other dimensions being rolled up (None to keep all dimensions, [] for
+    the grand total)
+    :param where: dictionary of dimensions to a value (slice) or to a list of values (dice)
+    :param measures: list of measures (None for all)
+    :return: DataFrame of the kept dimensions and measures
+    """
+    measures = measures or [col for col in MEASURES if col in cube.columns]
+
+    rows = np.ones(len(cube), dtype=bool)
+
+    for (dim, values) in (where or {}).items():
+        rows &= cube[dim].isin(values if isinstance(values, (list, tuple, set)) else [values]).values
+
+    selected = cube[rows]
+
+    if by is None:
+        return selected[[dim for dim in DIMENSIONS if dim in cube.columns] + measures].reset_index(drop=True)
+
+    if not by:
+        return pd.DataFrame({col: [selected[col].sum()] for col in measures})
+
+    # Grouping over several categoricals does not sort the observed combinations
+    return selected.groupby(by, observed=True)[measures].sum().reset_index().sort_values(by, ignore_index=True)
@@ -0,0 +1,250 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+
+def csr_adjacency(sources,
+                  targets,
+                  n):
+    """
+    Build a compressed sparse row (CSR) adjacency from a list of edges
+    The targets of node i are indices[indptr[i]:indptr[i + 1]], in edge order
+    :param sources: int array of source entity keys
+    :param targets: int array of target entity keys
+    :param n: number of nodes
+    :return: dictionary of indptr and indices arrays, and of the edge (row) number of each index
+    """
+    order = np.argsort(sources, kind='mergesort')
+
+    indptr = np.zeros(n + 1, dtype='int64')
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=n))
+
+    return {'indptr': indptr, 'indices': targets[order], 'edges': order}
+
+
+def ownership_graph(sub_ids,
+                    parent_ids=None):
+    """
+    Build the ownership graph of parent companies, subsidiaries and global ultimate owners over entity keys
+    Parent to subsidiary edges are held as CSR adjacency in both directions, so that the subsidiaries of a parent and
+    the parents of a subsidiary are contiguous slices
+    :param sub_ids: DataFrame of (bvd9, sub_bvd9) edges as entity keys, without missing keys
+    :param parent_ids: DataFrame of parent companies with bvd9 and guo_bvd9 as entity keys (None for no parent list)
+    :return: dictionary with the number of nodes, the subs and parents adjacencies, the guo key of each node
+    (-1 if none) and the mask of nodes listed as parent companies
+    """
+    parents = sub_ids['bvd9'].values.astype('int64')
+    subs = sub_ids['sub_bvd9'].values.astype('int64')
+
+    keys = [parents, subs]
+
+    if parent_ids is not None:
+        keys += [parent_ids['bvd9'].values.astype('int64'), parent_ids['guo_bvd9'].values.astype('int64')]
+
+    n = int(max([key.max() + 1 for key in keys if len(key)], default=0))
+
+    guo = np.full(n, -1, dtype='int64')
+    is_listed_parent = np.zeros(n, dtype=bool)
+
+    if parent_ids is not None:
+        is_listed_parent[keys[2][keys[2] >= 0]] = True
+
+        has_guo = (keys[2] >= 0) & (keys[3] >= 0)
+
+        # First guo of a parent company listed several times, as parent companies are deduplicated
+        (first_parents, first_rows) = np.unique(keys[2][has_guo], return_index=True)
+        guo[first_parents] = keys[3][has_guo][first_rows]
+
+    return {
+        'n': n,
+        'subs': csr_adjacency(parents, subs, n),
+        'parents': csr_adjacency(subs, parents, n),
+        'guo': guo,
+        'is_listed_parent': is_listed_parent
+    }
+
+
+def degrees(adjacency):
+    """
+    Count the edges of each node
+    :param adjacency: subs or parents adjacency of an ownership graph
+    :return: int array of the number of subsidiaries (subs adjacency) or parents (parents adjacency) of each node
+    """
+    return np.diff(adjacency['indptr'])
+
+
+def neighbours(adjacency,
+               keys):
+    """
+    List the subsidiaries (subs adjacency) or parents (parents adjacency) of several nodes at once
+    :param adjacency: subs or parents adjacency of an ownership graph
+    :param keys: int array of entity keys
+    :return: int arrays of the position in keys and the entity key of each neighbour, grouped by position in keys
+    """
+    keys = np.asarray(keys, dtype='int64')
+
+    # Keys outside of the graph have no neighbours
+    inside = (keys >= 0) & (keys < len(adjacency['indptr']) - 1)
+
+    starts = np.zeros(len(keys), dtype='int64')
+    counts = np.zeros(len(keys), dtype='int64')
+
+    starts[inside] = adjacency['indptr'][keys[inside]]
+    counts[inside] = adjacency['indptr'][keys[inside] + 1] - starts[inside]
+
+    positions = np.repeat(np.arange(len(keys)), counts)
+
+    # Offset of each neighbour within the slice of its node
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return positions, adjacency['indices'][starts[positions] + offsets]
+
+
+def subs_of(graph,
+            keys):
+    """
+    List the direct subsidiaries of parent companies
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of parent company entity keys
+    :return: DataFrame of bvd9 and sub_bvd9 entity keys
+    """
+    keys = np.asarray(keys, dtype='int64')
+
+    (positions, subs) = neighbours(graph['subs'], keys)
+
+    return pd.DataFrame({'bvd9': keys[positions].astype('int32'), 'sub_bvd9': subs.astype('int32')})
+
+
+def parents_of(graph,
+               keys):
+    """
+    List the parent companies of subsidiaries
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of subsidiary entity keys
+    :return: DataFrame of sub_bvd9 and bvd9 entity keys
+    """
+    keys = np.asarray(keys, dtype='int64')
+
+    (positions, parents) = neighbours(graph['parents'], keys)
+
+    return pd.DataFrame({'sub_bvd9': keys[positions].astype('int32'), 'bvd9': parents.astype('int32')})
+
+
+def descendants(graph,
+                keys,
+                max_depth=None):
+    """
+    List the subsidiaries of parent companies down the ownership chains, subsidiaries of subsidiaries included
+    All parent companies are expanded together one level at a time, each descendant being listed once per parent
+    company at its shortest depth, so that cycles end
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of parent company entity keys
+    :param max_depth: number of levels to expand (None for all)
+    :return: DataFrame of bvd9, sub_bvd9 entity keys and depth (1 for direct subsidiaries)
+    """
+    n = graph['n']
+
+    roots = np.unique(np.asarray(keys, dtype='int64'))
+
+    frontier_roots = roots
+    frontier_nodes = roots
+
+    # Pairs of (root, node) already reached, encoded as single integers
+    seen = roots * n + roots
+
+    found = []
+    depth = 0
+
+    while len(frontier_nodes) and (max_depth is None or depth < max_depth):
+        depth += 1
+
+        (positions, children) = neighbours(graph['subs'], frontier_nodes)
+
+        pairs = np.unique(frontier_roots[positions] * n + children)
+        pairs = pairs[~np.isin(pairs, seen, assume_unique=True)]
+
+        seen = np.union1d(seen, pairs)
+
+        frontier_roots = pairs // n
+        frontier_nodes = pairs % n
+
+        found.append(pd.DataFrame({'bvd9': frontier_roots.astype('int32'),
+                                   'sub_bvd9': frontier_nodes.astype('int32'),
+                                   'depth': depth}))
+
+    if not found:
+        return pd.DataFrame({'bvd9': pd.Series(dtype='int32'), 'sub_bvd9': pd.Series(dtype='int32'),
+                             'depth': pd.Series(dtype='int64')})
+
+    return pd.concat(found, ignore_index=True)
+
+
+def guo_of(graph,
+           keys):
+    """
+    Look up the global ultimate owner of parent companies
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of parent company entity keys
+    :return: int array of guo entity keys, -1 when unknown
+    """
+    keys = np.asarray(keys, dtype='int64')
+
+    guo = np.full(len(keys), -1, dtype='int64')
+
+    known = (keys >= 0) & (keys < graph['n'])
+    guo[known] = graph['guo'][keys[known]]
+
+    return guo
+
+
+def node_mask(graph,
+              mask,
+              keys):
+    """
+    Read a mask over nodes for several entity keys, keys outside of the graph reading as False
+    :param graph: dictionary returned by ownership_graph
+    :param mask: boolean array over nodes
+    :param keys: list-like of entity keys
+    :return: boolean array
+    """
+    keys = np.asarray(keys, dtype='int64')
+
+    values = np.zeros(len(keys), dtype=bool)
+
+    known = (keys >= 0) & (keys < graph['n'])
+    values[known] = mask[keys[known]]
+
+    return values
+
+
+def is_sub(graph,
+           keys):
+    """
+    Flag entities that are the subsidiary of a parent company, e.g. parent companies that are themselves subsidiaries
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of entity keys
+    :return: boolean array
+    """
+    return node_mask(graph, degrees(graph['parents']) > 0, keys)
+
+
+def is_multi_parent_sub(graph,
+                        keys):
+    """
+    Flag subsidiaries of several parent companies
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of subsidiary entity keys
+    :return: boolean array
+    """
+    return node_mask(graph, degrees(graph['parents']) > 1, keys)
+
+
+def is_listed_parent(graph,
+                     keys):
+    """
+    Flag entities listed as parent companies, e.g. subsidiaries that are themselves parent companies
+    :param graph: dictionary returned by ownership_graph
+    :param keys: list-like of entity keys
+    :return: boolean array
+    """
+    return node_mask(graph, graph['is_listed_parent'], keys)
@@ -0,0 +1,384 @@
+# Import libraries
+import json
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+import config as cfg
+from rnd_new_approach import rnd_methods as mtd
+from data_input import file_loader as load
+
+# Stages recomputed for affected parent companies only, whose code must not have changed since the previous case.
+# Loading of orbis exports (#1 to #3) is not incremental and keyword screening (#4) is only incremental through the
+# screening cache of rnd_keywords: both run in full and their outputs are diffed with the previous case here
+INCREMENTAL_STAGES = ['compute_exposure', 'compute_parent_rnd', 'compute_sub_rnd']
+
+
+def values_equal(previous,
+                 current):
+    """
+    Compare two aligned columns, numbers within the precision of csv outputs and missing values as equal
+    :param previous: Series of previous values
+    :param current: Series of current values
+    :return: boolean array
+    """
+    if is_numeric_dtype(previous) and is_numeric_dtype(current):
+        return np.isclose(previous.astype(float), current.astype(float), rtol=1e-9, atol=1e-9, equal_nan=True)
+
+    return (previous.astype(str).values == current.astype(str).values) | (previous.isna().values &
+                                                                          current.isna().values)
+
+
+def diff_table(previous,
+               current,
+               keys,
+               value_cols):
+    """
+    Compare two versions of a table by keys
+    Keys held by several distinct rows in either version are reported as changed
+    :param previous: DataFrame of the previous case
+    :param current: DataFrame of the current case
+    :param keys: list of key columns
+    :param value_cols: list of columns to compare
+    :return: dictionary of added, removed and changed keys as DataFrames
+    """
+    versions = []
+
+    for df in [previous, current]:
+        df = df[keys + value_cols].drop_duplicates()
+
+        versions.append(df.assign(is_duplicate=df.duplicated(subset=keys, keep=False)))
+
+    merged = pd.merge(versions[0], versions[1],
+                      left_on=keys, right_on=keys,
+                      how='outer',
+                      suffixes=('_previous', '_current'),
+                      indicator=True
+                      )
+
+    both = merged[merged['_merge'] == 'both']
+
+    is_changed = both['is_duplicate_previous'].values | both['is_duplicate_current'].values
+
+    for col in value_cols:
+        is_changed |= ~values_equal(both[col + '_previous'], both[col + '_current'])
+
+    return {
+        'added': merged.loc[merged['_merge'] == 'right_only', keys].drop_duplicates(),
+        'removed': merged.loc[merged['_merge'] == 'left_only', keys].drop_duplicates(),
+        'changed': both.loc[is_changed, keys].drop_duplicates()
+    }
+
+
+def in_scope(df,
+             key,
+             ids):
+    """
+    Keep the rows of a table whose key is in a list of ids
+    :param df: DataFrame
+    :param key: id column of entity keys
+    :param ids: Index of entity keys
+    :return: filtered DataFrame
+    """
+    return df[df[key].isin(ids)]
+
+
+def previous_case_issue(cases,
+                        stages,
+                        previous_files,
+                        range_ys):
+    """
+    Check that the outputs of the previous case can be reused for parent companies that did not change
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param stages: dictionary returned by rnd_stages.init_stages
+    :param previous_files: dictionary of file paths of the previous case
+    :param range_ys: dictionary of year ranges for financials
+    :return: reason why the previous case cannot be used, None if it can
+    """
+    previous_root = cases['previous_case_root']
+
+    outputs = [previous_files['rnd_outputs'][level][key] for level, key in
+               [('parents', 'fin'), ('subs', 'id'), ('subs', 'fin'), ('parents', 'expo'), ('subs', 'expo'),
+                ('parents', 'rnd'), ('subs', 'rnd')]]
+
+    missing = [output.name for output in outputs if not output.exists()]
+
+    if missing:
+        return 'missing outputs in previous case: ' + ', '.join(missing)
+
+    if not previous_root.joinpath(r'stages.json').exists():
+        return 'no stages.json in previous case'
+
+    with open(previous_root.joinpath(r'stages.json'), 'r') as file:
+        previous_stages = json.load(file)['stages']
+
+    for name in INCREMENTAL_STAGES:
+        if previous_stages.get(name, {}).get('fingerprint', {}).get('code') != stages['fingerprints'][name]['code']:
+            return 'code of ' + name + ' changed since previous case'
+
+    previous_exposure = load.read_table(outputs[3])[0]
+
+    if not set(cases['methods']) <= set(previous_exposure['method'].astype(str)):
+        return 'methods missing in previous case'
+
+    if ('year' in previous_exposure.columns) != cases['exposure_by_year']:
+        return 'exposure by year ' + ('not ' if cases['exposure_by_year'] else '') + 'used in previous case'
+
+    previous_years = set(load.read_table(outputs[5], usecols=['year'])[0]['year'].dropna().astype(int))
+
+    if not previous_years <= set(int('20' + rnd_y[-2:]) for rnd_y in range_ys['rnd_ys']):
+        return 'years of previous case out of range'
+
+    previous_fin_cols = load.read_table(outputs[0], usecols=range_ys['rnd_ys'] + range_ys['oprev_ys'])[0].columns
+
+    if not set(range_ys['rnd_ys'] + range_ys['oprev_ys']) <= set(previous_fin_cols):
+        return 'years missing in previous case'
+
+    return None
+
+
+def diff_vintages(cases,
+                  files,
+                  range_ys,
+                  stages,
+                  parent_fins,
+                  exposure_ids,
+                  sub_fins):
+    """
+    Diff the inputs of exposure and rnd computations with the ones of the previous case and list the parent companies
+    affected by the changes. Only exposure and rnd (#5 and #6) are then recomputed for affected parent companies, the
+    ingestion and screening of the current vintage having run in full for all subsidiaries. Affected parent companies
+    are parent companies:
+    - with changed financials
+    - with added, removed or re-flagged subsidiaries
+    - with subsidiaries whose financials or keyword screening changed
+    - not computed in the previous case
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param files: dictionary of file paths parameters
+    :param range_ys: dictionary of year ranges for financials
+    :param stages: dictionary returned by rnd_stages.init_stages
+    :param parent_fins: DataFrame of parent company financials
+    :param exposure_ids: DataFrame of subsidiary identification used to compute exposure
+    :param sub_fins: DataFrame of screened subsidiary financials
+    :return: dictionary of the change set, None if the previous case cannot be used, and change set statistics
+    """
+    print('Diff with previous case ' + str(cases['previous_case_root']) + ' ...')
+
+    previous_files = cfg.import_my_files({**cases, 'case_root': cases['previous_case_root']})
+
+    issue = previous_case_issue(cases, stages, previous_files, range_ys)
+
+    if issue is not None:
+        print('... full computation (' + issue + ')')
+
+        return None, {'previous_case_root': str(cases['previous_case_root']), 'full_computation': issue}
+
+    columns = mtd.stage_columns(cases, range_ys)
+
+    previous_outputs = previous_files['rnd_outputs']
+
+    previous = {
+        'parent_fins': load.read_table(previous_outputs['parents']['fin'],
+                                       usecols=columns['compute_parent_rnd']['parent_fins'])[0],
+        'sub_ids': load.read_table(previous_outputs['subs']['id'],
+                                   usecols=columns['compute_exposure']['sub_ids'])[0],
+        'sub_fins': load.read_table(previous_outputs['subs']['fin'],
+                                    usecols=columns['compute_exposure']['sub_fins'])[0],
+        'parent_exposure': load.read_table(previous_outputs['parents']['expo'])[0],
+        'sub_exposure': load.read_table(previous_outputs['subs']['expo'])[0],
+        'parent_rnd': load.read_table(previous_outputs['parents']['rnd'])[0],
+        'sub_rnd': load.read_table(previous_outputs['subs']['rnd'])[0]
+    }
+
+    # Parent companies computed in the current case
+    universe = pd.Index(exposure_ids['bvd9'].unique())
+
+    # Only compare parent companies in scope and subsidiaries linked to them
+    linked_subs = pd.Index(exposure_ids['sub_bvd9'].unique())
+
+    parent_diff = diff_table(in_scope(previous['parent_fins'], 'bvd9', universe),
+                             in_scope(parent_fins, 'bvd9', universe),
+                             ['bvd9'], columns['compute_parent_rnd']['parent_fins'][1:])
+
+    link_diff = diff_table(in_scope(previous['sub_ids'], 'bvd9', universe), exposure_ids,
+                           ['bvd9', 'sub_bvd9'], cases['methods'])
+
+    sub_diff = diff_table(in_scope(previous['sub_fins'], 'sub_bvd9', linked_subs),
+                          in_scope(sub_fins, 'sub_bvd9', linked_subs),
+                          ['sub_bvd9'], columns['compute_exposure']['sub_fins'][1:])
+
+    changed_subs = pd.concat([sub_diff[change]['sub_bvd9'] for change in ['added', 'removed', 'changed']])
+
+    new_parents = universe.difference(previous['parent_exposure']['bvd9'].unique())
+
+    affected = universe.intersection(pd.Index(pd.concat([
+        parent_diff['changed']['bvd9'],
+        parent_diff['added']['bvd9'],
+        pd.concat([link_diff[change]['bvd9'] for change in ['added', 'removed', 'changed']]),
+        exposure_ids.loc[exposure_ids['sub_bvd9'].isin(changed_subs), 'bvd9'],
+        pd.Series(new_parents)
+    ]).unique()))
+
+    report = {
+        'previous_case_root': str(cases['previous_case_root']),
+        'parents_in_scope': len(universe),
+        'parents_not_in_previous_case': len(new_parents),
+        'parents_with_changed_financials': len(parent_diff['changed']),
+        'subsidiary_links': {change: len(link_diff[change]) for change in ['added', 'removed', 'changed']},
+        'subsidiary_financials': {change: len(sub_diff[change]) for change in ['added', 'removed', 'changed']},
+        'affected_parents': len(affected),
+        'affected_share': round(len(affected) / len(universe), 5) if len(universe) else None
+    }
+
+    print('... ' + str(len(affected)) + ' of ' + str(len(universe)) + ' parent companies affected by changes')
+
+    increment = {
+        'previous': previous,
+        'universe': universe,
+        'affected': affected
+    }
+
+    return increment, report
+
+
+def splice(cases,
+           previous,
+           recomputed,
+           increment,
+           order=('bvd9',)):
+    """
+    Merge the rows recomputed for affected parent companies with the previous rows of the other parent companies of
+    the current case, ordered by method and by the order columns as in the tables of a full run
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param previous: DataFrame of the previous case
+    :param recomputed: DataFrame recomputed for affected parent companies
+    :param increment: dictionary returned by diff_vintages
+    :param order: columns ordering the rows of each method, parent companies being ordered by entity rank
+    :return: spliced DataFrame with the columns of the previous case
+    """
+    kept = previous[previous['bvd9'].isin(increment['universe']) & ~previous['bvd9'].isin(increment['affected']) &
+                    previous['method'].isin(cases['methods'])]
+
+    spliced = pd.concat([kept, recomputed[list(previous.columns)]], ignore_index=True, sort=False)
+
+    method_order = spliced['method'].astype(str).map({method: i for i, method in enumerate(cases['methods'])})
+
+    spliced = spliced.assign(method_order=method_order, bvd9_order=load.entity_ranks(spliced['bvd9'])).sort_values(
+        ['method_order'] + ['bvd9_order' if col == 'bvd9' else col for col in order], kind='mergesort'
+    )
+
+    return spliced.drop(columns=['method_order', 'bvd9_order']).reset_index(drop=True)
+
+
+def rnd_report(cases,
+               rnd,
+               value_col):
+    """
+    Sum rnd by year for each method, as reported by compute_parent_rnd and compute_sub_rnd
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param rnd: DataFrame of rnd by year and method
+    :param value_col: rnd column to sum
+    :return: dictionary of methods to dictionaries of years to rnd
+    """
+    report = {}
+
+    for method in cases['methods']:
+        report.update(
+            pd.DataFrame.to_dict(
+                rnd.loc[rnd['method'] == method, ['year', value_col]].groupby(['year']).sum().rename(
+                    columns={value_col: 'with_method: ' + str(method)})
+            )
+        )
+
+    return report
+
+
+def compute_exposure(cases,
+                     files,
+                     range_ys,
+                     exposure_ids,
+                     sub_fins,
+                     increment):
+    """
+    Compute exposure for affected parent companies and splice it with the exposure of the previous case
+    :return: same as rnd_methods.compute_exposure
+    """
+    print('Compute exposure of affected parent companies')
+
+    (recomputed_parent_exposure, recomputed_sub_exposure) = mtd.compute_exposure(
+        cases, files, range_ys, exposure_ids[exposure_ids['bvd9'].isin(increment['affected'])], sub_fins, save=False
+    )[2:]
+
+    parent_exposure = splice(cases, increment['previous']['parent_exposure'], recomputed_parent_exposure, increment)
+    sub_exposure = splice(cases, increment['previous']['sub_exposure'], recomputed_sub_exposure, increment)
+
+    load.write_table(parent_exposure, files['rnd_outputs']['parents']['expo'], **files['output_options'])
+    load.write_table(sub_exposure, files['rnd_outputs']['subs']['expo'], **files['output_options'])
+
+    matching_subs = sub_fins.loc[sub_fins['keyword_mask'] == True, 'sub_bvd9']
+
+    report_keyword_match = {}
+    report_exposure = {'at_subsidiary_level': {}, 'at_parent_level': {}}
+
+    for method in cases['methods']:
+        sub_exposure_method = sub_exposure[sub_exposure['method'] == method]
+
+        report_keyword_match['From ORBIS with applied method: ' + str(method)] = {
+            'sub_bvd9_in_selected_bvd9': int(exposure_ids['sub_bvd9'][exposure_ids[method] == True].count()),
+            'unique_is_matching_a_keyword': int(sub_exposure_method.loc[
+                sub_exposure_method['sub_bvd9'].isin(matching_subs), 'sub_bvd9'].nunique())
+        }
+
+        report_exposure['at_parent_level']['With method: ' + str(method)] = {
+            'Total_exposure': parent_exposure.loc[parent_exposure['method'] == method, 'parent_exposure'].sum()
+        }
+
+        report_exposure['at_subsidiary_level']['With method: ' + str(method)] = {
+            'Total_exposure': sub_exposure_method['sub_exposure'].sum()
+        }
+
+    return report_keyword_match, report_exposure, parent_exposure, sub_exposure
+
+
+def compute_parent_rnd(cases,
+                       files,
+                       range_ys,
+                       parent_exposure,
+                       parent_fins,
+                       increment):
+    """
+    Compute parent level rnd for affected parent companies and splice it with the one of the previous case
+    :return: same as rnd_methods.compute_parent_rnd
+    """
+    recomputed = mtd.compute_parent_rnd(cases, files, range_ys,
+                                        parent_exposure[parent_exposure['bvd9'].isin(increment['affected'])],
+                                        parent_fins, save=False)[1]
+
+    parent_rnd = splice(cases, increment['previous']['parent_rnd'], recomputed, increment, order=['year', 'bvd9'])
+
+    load.write_table(parent_rnd, files['rnd_outputs']['parents']['rnd'], **files['output_options'])
+
+    return rnd_report(cases, parent_rnd, 'parent_rnd_clean'), parent_rnd
+
+
+def compute_sub_rnd(cases,
+                    files,
+                    range_ys,
+                    sub_exposure,
+                    parent_rnd,
+                    increment):
+    """
+    Compute subsidiary level rnd for affected parent companies and splice it with the one of the previous case
+    :return: same as rnd_methods.compute_sub_rnd
+    """
+    recomputed = mtd.compute_sub_rnd(cases, files, range_ys,
+                                     sub_exposure[sub_exposure['bvd9'].isin(increment['affected'])],
+                                     parent_rnd[parent_rnd['bvd9'].isin(increment['affected'])], save=False)[1]
+
+    # Subsidiaries without rnd are left out, as in the table written by a full run
+    sub_rnd = splice(cases, increment['previous']['sub_rnd'], recomputed.dropna(subset=['sub_rnd_clean']), increment)
+
+    load.write_table(sub_rnd, files['rnd_outputs']['subs']['rnd'], **files['output_options'])
+
+    return rnd_report(cases, sub_rnd, 'sub_rnd_clean'), sub_rnd
@@ -0,0 +1,250 @@
+# Import libraries
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+def trie_pattern(words):
+    """
+    Build a regular expression matching the longest of a list of words from a trie of their characters, so that the
+    regex engine follows shared prefixes once instead of trying each word in turn
+    :param words: list of words
+    :return: regular expression as a string
+    """
+    trie = {}
+
+    for word in words:
+        node = trie
+
+        for char in word:
+            node = node.setdefault(char, {})
+
+        # Empty key marks the end of a word
+        node[''] = {}
+
+    def node_pattern(node):
+        branches = [re.escape(char) + node_pattern(child) for char, child in sorted(node.items()) if char]
+
+        if not branches:
+            return ''
+
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+        # Greedy optional group so that a longer word is preferred to a word ending at this node
+        return '(?:' + pattern + ')?' if '' in node else pattern
+
+    return node_pattern(trie)
+
+
+def compile_keywords(keywords):
+    """
+    Compile keywords of all categories into a single matcher scanning a text once
+    Texts and keywords are compared upper cased, as str.contains(case=False) does. At each position of a text the
+    longest keyword starting there is matched and credited with the categories of all keywords it starts with, which
+    are the other keywords matching at that position
+    :param keywords: dictionary of categories to lists of keywords
+    :return: dictionary with the compiled pattern, the categories and the category indices of each matchable keyword
+    """
+    categories = list(keywords.keys())
+
+    word_categories = {}
+
+    for index, category in enumerate(categories):
+        for keyword in keywords[category]:
+            if keyword:
+                word_categories.setdefault(keyword.upper(), set()).add(index)
+
+    # Credit each keyword with the categories of the keywords it starts with
+    closure = {
+        word: tuple(sorted(set().union(*[indices for prefix, indices in word_categories.items()
+                                         if word.startswith(prefix)])))
+        for word in word_categories.keys()
+    }
+
+    return {
+        'pattern': re.compile('(?=(' + trie_pattern(word_categories.keys()) + '))') if word_categories else None,
+        'categories': categories,
+        'closure': closure
+    }
+
+
+def match_texts(texts,
+                matcher):
+    """
+    Scan texts once each for keywords of all categories
+    :param texts: Series of texts, values other than strings (e.g. NaN) are not scanned
+    :param matcher: dictionary returned by compile_keywords
+    :return: boolean array of texts by categories and boolean array of texts that are strings
+    """
+    hits = np.zeros((len(texts), len(matcher['categories'])), dtype=bool)
+    is_text = np.zeros(len(texts), dtype=bool)
+
+    pattern = matcher['pattern']
+    closure = matcher['closure']
+
+    for row, text in enumerate(texts):
+        if not isinstance(text, str):
+            continue
+
+        is_text[row] = True
+
+        if pattern is None:
+            continue
+
+        for word in set(pattern.findall(text.upper())):
+            hits[row, closure[word]] = True
+
+    return hits, is_text
+
+
+def screen_descriptions(df,
+                        matcher,
+                        desc_cols,
+                        workers=1,
+                        chunks_per_worker=4):
+    """
+    Flag the keyword categories matched in the description columns of a table
+    Descriptions are combined as the former chain of str.contains results did, a missing first description masking
+    matches in the second one: (first | second) is False when first is NaN, while (x | NaN) is x
+    :param df: DataFrame with description columns
+    :param matcher: dictionary returned by compile_keywords
+    :param desc_cols: list of description columns, in the order they were combined
+    :param workers: number of worker processes screening chunks of rows in parallel (1 to screen in this process)
+    :param chunks_per_worker: number of row chunks per worker, several so that uneven chunks balance out
+    :return: DataFrame of boolean category columns aligned on df
+    """
+    if workers > 1 and len(df) > workers:
+        print('... screen in ' + str(workers) + ' worker processes')
+
+        # Only descriptions are sent to workers, chunks being merged back in row order
+        chunk_n = min(workers * chunks_per_worker, len(df))
+        bounds = np.linspace(0, len(df), chunk_n + 1).astype(int)
+
+        chunks = [df.iloc[start:end][desc_cols] for start, end in zip(bounds[:-1], bounds[1:])]
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return pd.concat(list(executor.map(partial(screen_descriptions, matcher=matcher, desc_cols=desc_cols),
+                                               chunks)))
+
+    (hits, is_text) = match_texts(df[desc_cols[0]], matcher)
+
+    if len(desc_cols) > 1:
+        hits = is_text[:, None] & (hits | match_texts(df[desc_cols[1]], matcher)[0])
+
+    for col in desc_cols[2:]:
+        hits |= match_texts(df[col], matcher)[0]
+
+    return pd.DataFrame(hits, index=df.index, columns=matcher['categories'])
+
+
+def keyword_fingerprint(category_keywords,
+                        desc_cols):
+    """
+    Fingerprint the keywords of a category as they are matched
+    :param category_keywords: list of keywords of the category
+    :param desc_cols: list of description columns, in the order they are combined
+    :return: sha256 hex digest
+    """
+    words = sorted(set(keyword.upper() for keyword in category_keywords if keyword))
+
+    return hashlib.sha256(json.dumps([words, desc_cols]).encode()).hexdigest()
+
+
+def description_hashes(df,
+                       desc_cols):
+    """
+    Hash the upper cased descriptions of each row, values other than strings hashing as missing descriptions
+    :param df: DataFrame with description columns
+    :param desc_cols: list of description columns
+    :return: array of uint64 hashes, one per row
+    """
+    upper = pd.DataFrame({
+        col: df[col].map(lambda text: text.upper() if isinstance(text, str) else None) for col in desc_cols
+    })
+
+    return pd.util.hash_pandas_object(upper, index=False).values
+
+
+def screen_descriptions_cached(df,
+                               keywords,
+                               desc_cols,
+                               cache_root,
+                               workers=1):
+    """
+    Flag the keyword categories matched in the description columns of a table through a persistent cache of hits
+    Hits are cached per category in a Feather file keyed by the fingerprint of the category keywords and holding the
+    hit of each description hash, so that only categories whose keywords changed and descriptions never seen before
+    are screened. Identical descriptions are screened once
+    :param df: DataFrame with description columns
+    :param keywords: dictionary of categories to lists of keywords
+    :param desc_cols: list of description columns, in the order they are combined
+    :param cache_root: folder of the cached hits
+    :param workers: number of worker processes screening chunks of rows in parallel (1 to screen in this process)
+    :return: DataFrame of boolean category columns aligned on df
+    """
+    cache_root = Path(cache_root)
+    cache_root.mkdir(parents=True, exist_ok=True)
+
+    (desc_hashes, first_rows, inverse) = np.unique(description_hashes(df, desc_cols),
+                                                   return_index=True, return_inverse=True)
+
+    categories = list(keywords.keys())
+
+    hits = np.zeros((len(desc_hashes), len(categories)), dtype=bool)
+    known = np.zeros((len(desc_hashes), len(categories)), dtype=bool)
+
+    cache_paths = {}
+    cached = {}
+
+    for index, category in enumerate(categories):
+        cache_paths[category] = cache_root.joinpath(
+            category + ' - ' + keyword_fingerprint(keywords[category], desc_cols)[:16] + '.feather'
+        )
+
+        if cache_paths[category].exists():
+            cached[category] = pd.read_feather(cache_paths[category])
+
+            positions = pd.Index(cached[category]['desc_hash']).get_indexer(desc_hashes)
+
+            known[:, index] = positions >= 0
+            hits[known[:, index], index] = cached[category]['hit'].values[positions[known[:, index]]]
+
+    to_screen = ~known.all(axis=1)
+    stale = [category for index, category in enumerate(categories) if not known[:, index].all()]
+
+    print('... screen ' + str(to_screen.sum()) + ' of ' + str(len(desc_hashes)) + ' unique descriptions for ' +
+          str(len(stale)) + ' of ' + str(len(categories)) + ' categories, others found in cache')
+
+    if not stale:
+        return pd.DataFrame(hits[inverse], index=df.index, columns=categories)
+
+    new_hits = screen_descriptions(df.iloc[first_rows[to_screen]],
+                                   compile_keywords({category: keywords[category] for category in stale}),
+                                   desc_cols,
+                                   workers)
+
+    for category in stale:
+        index = categories.index(category)
+        missing = ~known[:, index]
+
+        hits[missing, index] = new_hits[category].values[missing[to_screen]]
+
+        update = pd.DataFrame({'desc_hash': desc_hashes[missing], 'hit': hits[missing, index]})
+
+        if category in cached:
+            update = pd.concat([cached[category], update], ignore_index=True)
+
+        # Write to a temporary file first so that an interrupted run never leaves a truncated cache behind
+        tmp_path = cache_paths[category].with_name(cache_paths[category].name + '.' + str(os.getpid()) + '.tmp')
+
+        update.to_feather(tmp_path)
+        os.replace(tmp_path, cache_paths[category])
+
+    return pd.DataFrame(hits[inverse], index=df.index, columns=categories)
@@ -5,6 +5,10 @@ import datetime
 import json
 
 from rnd_new_approach import rnd_methods as mtd
+from rnd_new_approach import rnd_stages as stg
+from rnd_new_approach import rnd_performance as perf
+from rnd_new_approach import rnd_incremental as inc
+from data_input import file_loader as load
 import config as cfg
 
 # TODO: GUI to prompt user for use_case and place instead of cfg.init hard coding
@@ -12,325 +16,470 @@ import config as cfg
 # TODO: Progress bars for reading input files by chunks
 # TODO: Implement .index over data frames
 
-# <editor-fold desc="#0 - Initialisation">
-print('#0 - Initialisation')
 
-# Set  dataframe display options
-pd.options.display.max_columns = None
-pd.options.display.width = None
+def main(use_case=None,
+         country_map=None):
+    """
+    Run the pipeline for a use case
+    :param use_case: name of the cases.ini section to run (None for the one hard coded in config.init)
+    :param country_map: country mapping table already read by the caller (None to read it)
+    :return: Nothing
+    """
+    # <editor-fold desc="#0 - Initialisation">
+    print('#0 - Initialisation')
 
-# Load config files
-(cases, files) = cfg.init()
+    perf.start_stage('#0 - Initialisation')
 
-# Initialize report
-report = {}
+    # Set  dataframe display options
+    pd.options.display.max_columns = None
+    pd.options.display.width = None
 
-if cases['case_root'].joinpath(r'report.json').exists():
-    # Load existing file
-    with open(cases['case_root'].joinpath(r'report.json'), 'r') as file:
-        report = json.load(file)
+    # Load config files
+    (cases, files) = cfg.init(use_case)
 
-    # Update time stamp
-    report['initialisation']['Datetime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-else:
-    cases_to_str = {}
+    # Initialize report
+    report = {}
 
-    for key in cases.keys():
-        cases_to_str[key] = str(cases[key])
+    if cases['case_root'].joinpath(r'report.json').exists():
+        # Load existing file
+        with open(cases['case_root'].joinpath(r'report.json'), 'r') as file:
+            report = json.load(file)
 
-    report['initialisation'] = {
-        'Datetime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'Use case': cases_to_str
+        # Update time stamp
+        report['initialisation']['Datetime'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        cases_to_str = {}
+
+        for key in cases.keys():
+            cases_to_str[key] = str(cases[key])
+
+        report['initialisation'] = {
+            'Datetime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'Use case': cases_to_str
+        }
+
+    # Memory usage of the tables read from intermediate outputs
+    report['memory'] = {}
+
+    # Time, CPU and memory used by each stage and function of the run
+    report['performance'] = perf.init_performance(cases['trace_memory'])
+
+    mtd.update_report(report, cases)
+
+    # Persist intermediate outputs in the background while tables are handed over in memory to the next stages
+    if cases['background_writes']:
+        load.start_background_writer()
+
+    # Load keywords for activity screening
+    with open(cases['base'].joinpath(r'keywords.json'), 'r') as file:
+        keywords = json.load(file)
+
+    # Define data ranges
+    print('Define data ranges ...')
+
+    range_ys = {
+        'rnd_ys': ['rnd_y' + str(YY) for YY in range(int(cases['year_first'][-2:]), int(cases['year_last'][-2:]) + 1)],
+        'oprev_ys': ['op_revenue_y' + str(YY) for YY in
+                     range(int(cases['year_first'][-2:]), int(cases['year_last'][-2:]) + 1)],
+        'LY': str(cases['year_last'])[-2:]
     }
 
-mtd.update_report(report, cases)
+    # Intern company identifiers as int32 entity keys, with the keys registered by previous runs of the case
+    load.init_entities(files['entities'])
 
-# Load keywords for activity screening
-with open(cases['base'].joinpath(r'keywords.json'), 'r') as file:
-    keywords = json.load(file)
+    # Columns read by each stage from its input tables
+    stage_cols = mtd.stage_columns(cases, range_ys)
 
-# Define data ranges
-print('Define data ranges ...')
+    # Fingerprint stages to only run those whose inputs, configuration or code changed since their last run
+    stages = stg.init_stages(cases, files, range_ys, keywords)
 
-range_ys = {
-    'rnd_ys': ['rnd_y' + str(YY) for YY in range(int(cases['year_first'][-2:]), int(cases['year_last'][-2:]) + 1)],
-    'oprev_ys': ['op_revenue_y' + str(YY) for YY in
-                 range(int(cases['year_first'][-2:]), int(cases['year_last'][-2:]) + 1)],
-    'LY': str(cases['year_last'])[-2:]
-}
+    # Import mapping tables, unless shared by the batch runner
+    if country_map is None:
+        country_map = load.country_map_from_csv()
 
-# Import mapping tables
-print('Read country mapping table ...')
+    # Initialize final consolidation
+    sub_rnd = pd.DataFrame()
+    # </editor-fold>
 
-country_map = pd.read_csv('https://raw.githubusercontent.com/pysleto/mapping-tables/master/country_table.csv',
-                          error_bad_lines=False)
+    # <editor-fold desc="#1 - Select parent companies">
+    print('#1 - Select parent companies')
 
-# Initialize final consolidation
-sub_rnd = pd.DataFrame()
-# </editor-fold>
+    perf.start_stage('#1 - Select parent companies')
 
-# <editor-fold desc="#1 - Select parent companies">
-print('#1 - Select parent companies')
+    report['select_parents'] = {}
 
-report['select_parents'] = {}
+    # Select parent companies
+    if stg.is_stale(stages, 'select_parents'):
+        (report['select_parents'], parent_ids, parent_guo_ids) = mtd.load_parent_ids(cases, files, range_ys,
+                                                                                      country_map)
+        mtd.update_report(report, cases)
 
-# Select parent companies
-if not files['rnd_outputs']['parents']['id'].exists():
-    (report['select_parents'], parent_ids, parent_guo_ids) = mtd.load_parent_ids(cases, files, country_map)
-    mtd.update_report(report, cases)
-else:
-    print('Read from file ...')
-    parent_ids = pd.read_csv(
-        files['rnd_outputs']['parents']['id'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['guo_bvd9', 'bvd9', 'bvd_id', 'legal_entity_id', 'NACE_4Dcode']
-        }
-    )
+        stg.mark_done(stages, 'select_parents')
+    else:
+        print('Read from file ...')
+        (parent_ids, report['memory']['parent_ids']) = load.read_table(
+            files['rnd_outputs']['parents']['id'],
+            float32=cases['float32']
+        )
 
-    parent_guo_ids = pd.read_csv(
-        files['rnd_outputs']['parents']['guo'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['guo_bvd9', 'guo_bvd_id', 'guo_legal_entity_id']
-        }
-    )
+        (parent_guo_ids, report['memory']['parent_guo_ids']) = load.read_table(
+            files['rnd_outputs']['parents']['guo'],
+            float32=cases['float32']
+        )
 
-parent_id_cols = list(parent_ids.columns)
+    parent_id_cols = list(parent_ids.columns)
 
-pd.Series(parent_ids.bvd9.unique()).to_csv(files['rnd_outputs']['parents']['bvd9_full'],
-                                           index=False,
-                                           header=False,
-                                           na_rep='#N/A'
-                                           )
-# </editor-fold>
+    pd.Series(load.entity_names(parent_ids.bvd9.unique())).to_csv(files['rnd_outputs']['parents']['bvd9_full'],
+                                                                  index=False,
+                                                                  header=False,
+                                                                  na_rep='#N/A'
+                                                                  )
+    # </editor-fold>
 
-# <editor-fold desc="#2 - Load parent company financials">
-print('#2 - Load parent company financials')
+    # <editor-fold desc="#2 - Load parent company financials">
+    print('#2 - Load parent company financials')
 
-if not files['rnd_outputs']['parents']['fin'].exists():
-    (report['load_parent_financials'], parent_fins) = mtd.load_parent_fins(cases, files, range_ys)
+    perf.start_stage('#2 - Load parent company financials')
 
-    # TODO: Check that selected parent ids based on rnd_limit is representative of total rnd in each world region
-    selected_parent_ids = mtd.select_parent_ids_with_rnd(parent_fins, cases['rnd_limit'])
+    if stg.is_stale(stages, 'load_parent_fins'):
+        (report['load_parent_financials'], parent_fins) = mtd.load_parent_fins(cases, files, range_ys)
 
-    selected_parent_bvd9_ids = pd.Series(selected_parent_ids.bvd9.unique())
+        selected_parent_ids = mtd.select_parent_ids_with_rnd(parent_fins, cases['rnd_limit'])
 
-    selected_parent_bvd9_ids.to_csv(files['rnd_outputs']['parents']['bvd9_short'],
-                                    float_format='%.10f',
-                                    index=False,
-                                    header=False,
-                                    na_rep='#N/A'
-                                    )
+        selected_parent_bvd9_ids = pd.Series(selected_parent_ids.bvd9.unique())
 
-    # select = parent_fins[parent_fins['bvd9'].isin(parent_ids['bvd9'])]
-    #
-    # report['load_parent_financials']['With financials'] = {
-    #     'total_bvd9': parent_fins['bvd9'].nunique(),
-    #     'total_rnd_y' + str(cases['year_last'])[-2:]: parent_fins['rnd_y' + str(cases['year_last'])[-2:]].sum(),
-    #     'selected_bvd9': select['bvd9'].nunique(),
-    #     'selected_rnd_y' + str(cases['year_last'])[-2:]: select['rnd_y' + str(cases['year_last'])[-2:]].sum()
-    # }
+        pd.Series(load.entity_names(selected_parent_bvd9_ids)).to_csv(
+            files['rnd_outputs']['parents']['bvd9_short'],
+            float_format='%.10f',
+            index=False,
+            header=False,
+            na_rep='#N/A'
+        )
 
-    mtd.update_report(report, cases)
-else:
-    print('Read from file ...')
-    parent_fins = pd.read_csv(
-        files['rnd_outputs']['parents']['fin'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['bvd9']
-        }
-    )
+        # select = parent_fins[parent_fins['bvd9'].isin(parent_ids['bvd9'])]
+        #
+        # report['load_parent_financials']['With financials'] = {
+        #     'total_bvd9': parent_fins['bvd9'].nunique(),
+        #     'total_rnd_y' + str(cases['year_last'])[-2:]: parent_fins['rnd_y' + str(cases['year_last'])[-2:]].sum(),
+        #     'selected_bvd9': select['bvd9'].nunique(),
+        #     'selected_rnd_y' + str(cases['year_last'])[-2:]: select['rnd_y' + str(cases['year_last'])[-2:]].sum()
+        # }
+
+        mtd.update_report(report, cases)
+
+        stg.mark_done(stages, 'load_parent_fins')
+    else:
+        print('Read from file ...')
+        (parent_fins, report['memory']['parent_fins']) = load.read_table(
+            files['rnd_outputs']['parents']['fin'],
+            usecols=stage_cols['rnd_coverage']['parent_fins'] + stage_cols['compute_parent_rnd']['parent_fins'],
+            float32=cases['float32']
+        )
 
-    selected_parent_bvd9_ids = pd.read_csv(
-        files['rnd_outputs']['parents']['bvd9_short'],
-        na_values='#N/A',
-        header=None,
-        dtype=str
-    )[0]
+        selected_parent_bvd9_ids = pd.Series(load.entity_keys(pd.read_csv(
+            files['rnd_outputs']['parents']['bvd9_short'],
+            na_values='#N/A',
+            header=None,
+            dtype=str
+        )[0]))
 
-parent_fin_cols = list(parent_fins.columns)
-# </editor-fold>
+    parent_fin_cols = list(parent_fins.columns)
 
-# <editor-fold desc="#3 - Load subsidiary identification and flag for calculation methods">
-print('#3 - Load subsidiary identification')
+    # Representativeness of the selection of parent companies in total and in each world region and country
+    report['rnd_coverage'] = mtd.rnd_coverage(parent_fins, parent_ids,
+                                              sorted(set(cases['coverage_limits'] + [cases['rnd_limit']])))
+    # </editor-fold>
 
-if not files['rnd_outputs']['subs']['id'].exists():
-    (report['load_subsidiary_identification'], sub_ids) = mtd.load_sub_ids(cases, files, country_map)
+    # <editor-fold desc="#3 - Load subsidiary identification and flag for calculation methods">
+    print('#3 - Load subsidiary identification')
 
-    selected_sub_ids = sub_ids[sub_ids.bvd9.isin(selected_parent_bvd9_ids)]
+    perf.start_stage('#3 - Load subsidiary identification')
 
-    (report['screen_subsidiaries_for_method'], sub_ids) = mtd.screen_sub_ids_for_method(cases, files, parent_ids,
-                                                                                        sub_ids)
+    if stg.is_stale(stages, 'load_sub_ids'):
+        (report['load_subsidiary_identification'], sub_ids) = mtd.load_sub_ids(cases, files, range_ys, country_map)
 
-    mtd.update_report(report, cases)
+        (report['screen_subsidiaries_for_method'], sub_ids) = mtd.screen_sub_ids_for_method(cases, files, parent_ids,
+                                                                                            sub_ids)
 
-    # Save lists of subsidiary bvd9 ids
-    sub_bvd9_ids = pd.Series(sub_ids.bvd9.unique())
+        selected_sub_ids = sub_ids[sub_ids.bvd9.isin(selected_parent_bvd9_ids)]
 
-    sub_bvd9_ids.to_csv(files['rnd_outputs']['subs']['bvd9_full'],
-                        index=False,
-                        header=False,
-                        na_rep='#N/A'
-                        )
+        mtd.update_report(report, cases)
 
-    selected_sub_bvd9_ids = pd.Series(selected_sub_ids.sub_bvd9.unique())
+        # Save lists of subsidiary bvd9 ids
+        sub_bvd9_ids = pd.Series(load.entity_names(sub_ids.bvd9.unique()))
 
-    selected_sub_bvd9_ids.to_csv(files['rnd_outputs']['subs']['bvd9_short'],
-                                 index=False,
-                                 header=False,
-                                 na_rep='#N/A'
-                                 )
+        sub_bvd9_ids.to_csv(files['rnd_outputs']['subs']['bvd9_full'],
+                            index=False,
+                            header=False,
+                            na_rep='#N/A'
+                            )
 
-    # Update retrieved subsidiary count in parent_ids
-    if 'subs_n_collected' not in parent_id_cols:
-        parent_id_cols.insert(parent_id_cols.index('subs_n') + 1, 'subs_n_collected')
+        selected_sub_bvd9_ids = pd.Series(selected_sub_ids.sub_bvd9.unique())
 
+        pd.Series(load.entity_names(selected_sub_bvd9_ids)).to_csv(
+            files['rnd_outputs']['subs']['bvd9_short'],
+            index=False,
+            header=False,
+            na_rep='#N/A'
+        )
+
+        # Update retrieved subsidiary count in parent_ids
+        if 'subs_n_collected' not in parent_id_cols:
+            parent_id_cols.insert(parent_id_cols.index('subs_n') + 1, 'subs_n_collected')
+
+        # Counts from a previous run are replaced as subsidiaries may have changed since
         parent_ids = pd.merge(
-            parent_ids,
-            sub_ids[['bvd9', 'sub_bvd9']].groupby(['bvd9']).count().rename(
+            parent_ids.drop(columns=['subs_n_collected'], errors='ignore'),
+            sub_ids[['bvd9', 'sub_bvd9']].groupby(['bvd9'], observed=True).count().rename(
                 columns={'sub_bvd9': 'subs_n_collected'}
             ).reset_index(),
             left_on='bvd9', right_on='bvd9',
             how='left',
             suffixes=(False, False)
         )
-    # TODO: Implement check and update of a MNC reference table
-    # Flag parent_ids that are keep_sub to consolidate a unique list of MNCs
-    if 'is_MNC' not in parent_id_cols:
-        parent_id_cols.insert(parent_id_cols.index('guo_bvd9') + 1, 'is_MNC')
-
-        parent_ids['is_MNC'] = True
-
-        parent_ids.loc[parent_ids['bvd9'].isin(sub_ids['sub_bvd9']), 'is_MNC'] = False
-
-    # Update parent_ids output file
-    parent_ids.to_csv(files['rnd_outputs']['parents']['id'],
-                      columns=parent_id_cols,
-                      float_format='%.10f',
-                      index=False,
-                      na_rep='#N/A'
-                      )
-else:
-    print('Read from file ...')
-    sub_ids = pd.read_csv(
-        files['rnd_outputs']['subs']['id'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['bvd9', 'bvd_id', 'sub_bvd9', 'sub_bvd_id', 'sub_legal_entity_id', 'sub_NACE_4Dcode']
-        }
-    )
+        # TODO: Implement check and update of a MNC reference table
+        # Flag parent_ids that are keep_sub to consolidate a unique list of MNCs
+        if 'is_MNC' not in parent_id_cols:
+            parent_id_cols.insert(parent_id_cols.index('guo_bvd9') + 1, 'is_MNC')
+
+        parent_ids['is_MNC'] = ~parent_ids['bvd9'].isin(sub_ids['sub_bvd9'])
+
+        # Update parent_ids output file
+        load.write_table(parent_ids,
+                         files['rnd_outputs']['parents']['id'],
+                         columns=parent_id_cols,
+                         **files['output_options']
+                         )
+
+        sub_ids = sub_ids[stage_cols['compute_exposure']['sub_ids']]
+        selected_sub_ids = selected_sub_ids[stage_cols['compute_exposure']['sub_ids']]
+
+        stg.mark_done(stages, 'load_sub_ids')
+    else:
+        print('Read from file ...')
+        (sub_ids, report['memory']['sub_ids']) = load.read_table(
+            files['rnd_outputs']['subs']['id'],
+            usecols=stage_cols['compute_exposure']['sub_ids'],
+            float32=cases['float32']
+        )
 
-    selected_sub_bvd9_ids = pd.read_csv(files['rnd_outputs']['subs']['bvd9_short'],
-                                        na_values='#N/A',
-                                        header=None,
-                                        dtype=str
-                                        )[0]
+        selected_sub_bvd9_ids = pd.Series(load.entity_keys(pd.read_csv(
+            files['rnd_outputs']['subs']['bvd9_short'],
+            na_values='#N/A',
+            header=None,
+            dtype=str
+        )[0]))
 
-    selected_sub_ids = sub_ids[sub_ids.sub_bvd9.isin(selected_sub_bvd9_ids)]
+        selected_sub_ids = sub_ids[sub_ids.bvd9.isin(selected_parent_bvd9_ids)]
 
-selected_sub_id_cols = list(selected_sub_ids.columns)
-# </editor-fold>
+    selected_sub_id_cols = list(selected_sub_ids.columns)
+    # </editor-fold>
 
-# <editor-fold desc="#4 - Load subsidiary financials and screen keywords in activity">
-print('#4 - Load subsidiary financials')
+    # <editor-fold desc="#4 - Load subsidiary financials and screen keywords in activity">
+    print('#4 - Load subsidiary financials')
 
-if not files['rnd_outputs']['subs']['fin'].exists():
-    (report['load_subsidiary_financials'], sub_fins) = mtd.load_sub_fins(cases, files, range_ys)
-    (report['screen_subsidiary_activities'], sub_fins) = mtd.screen_sub_fins_for_keywords(cases, files, range_ys,
-                                                                                          keywords,
-                                                                                          sub_fins)
+    perf.start_stage('#4 - Load subsidiary financials')
 
-    mtd.update_report(report, cases)
-else:
-    print('Read from file ...')
-    sub_fins = pd.read_csv(
-        files['rnd_outputs']['subs']['fin'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['sub_bvd9', 'sub_bvd_id']
-        }
-    )
+    # Only load and screen financials of subsidiaries of the selected parent companies
+    sub_bvd9_filter = selected_sub_bvd9_ids if cases['select_sub_fins'] else None
+
+    if stg.is_stale(stages, 'load_sub_fins'):
+        (report['load_subsidiary_financials'], sub_fins) = mtd.load_sub_fins(cases, files, range_ys, sub_bvd9_filter)
+
+        stg.mark_done(stages, 'load_sub_fins')
+    elif stg.is_stale(stages, 'screen_sub_fins'):
+        print('Read from file ...')
+        # Screening reruns on loaded financials (e.g. after a change of keywords)
+        (sub_fins, report['memory']['sub_fins']) = load.read_table(
+            files['rnd_outputs']['subs']['fin'],
+            usecols=stage_cols['screen_sub_fins_for_keywords']['sub_fins'],
+            float32=cases['float32']
+        )
+
+    if stg.is_stale(stages, 'screen_sub_fins'):
+        (report['screen_subsidiary_activities'], sub_fins) = mtd.screen_sub_fins_for_keywords(cases, files, range_ys,
+                                                                                              keywords,
+                                                                                              sub_fins,
+                                                                                              sub_bvd9_filter)
+
+        # Descriptions are only needed for keyword screening
+        sub_fins = sub_fins[stage_cols['compute_exposure']['sub_fins']]
+
+        mtd.update_report(report, cases)
+
+        stg.mark_done(stages, 'screen_sub_fins')
+    else:
+        print('Read from file ...')
+        (sub_fins, report['memory']['sub_fins']) = load.read_table(
+            files['rnd_outputs']['subs']['fin'],
+            usecols=stage_cols['compute_exposure']['sub_fins'],
+            flags=list(keywords.keys()),
+            float32=cases['float32']
+        )
+
+    sub_fin_cols = list(sub_fins.columns)
+    # </editor-fold>
+
+    # <editor-fold desc="#5 - Calculating group and subsidiary level exposure">
+    print('#5 - Calculating group and subsidiary level exposure')
+
+    perf.start_stage('#5 - Calculating group and subsidiary level exposure')
+
+    exposure_ids = selected_sub_ids if cases['select_sub_fins'] else sub_ids
+
+    # Only recompute exposure and rnd of parent companies affected by changes since a previous vintage of the case
+    # (loading and screening above are not incremental)
+    increment = None
+
+    if cases['previous_case_root'] is not None and any(stg.is_stale(stages, name) for name in inc.INCREMENTAL_STAGES):
+        (increment, report['incremental']) = inc.diff_vintages(cases, files, range_ys, stages, parent_fins,
+                                                               exposure_ids, sub_fins)
+
+        mtd.update_report(report, cases)
 
-sub_fin_cols = list(sub_fins.columns)
-# </editor-fold>
+    # TODO: integrate parents that are MNC but do not have subsidiaries (therefore are not managed by keep_sub) in exposure and rnd calculations
+    # Loading exposure at subsidiary and parent company level
+    if stg.is_stale(stages, 'compute_exposure') and increment is not None:
+        (report['keyword_screen_by_method'], report['compute_exposure'], parent_exposure, sub_exposure) = \
+            inc.compute_exposure(cases, files, range_ys, exposure_ids, sub_fins, increment)
 
-# <editor-fold desc="#5 - Calculating group and subsidiary level exposure">
-print('#5 - Calculating group and subsidiary level exposure')
+        mtd.update_report(report, cases)
 
-# TODO: integrate parents that are MNC but do not have subsidiaries (therefore are not managed by keep_sub) in exposure and rnd calculations
-# Loading exposure at subsidiary and parent company level
-if not (files['rnd_outputs']['parents']['expo'].exists() & files['rnd_outputs']['subs']['expo'].exists()):
-    (report['keyword_screen_by_method'], report['compute_exposure'], parent_exposure, sub_exposure) = \
-        mtd.compute_exposure(
+        stg.mark_done(stages, 'compute_exposure')
+    elif stg.is_stale(stages, 'compute_exposure'):
+        (report['keyword_screen_by_method'], report['compute_exposure'], parent_exposure, sub_exposure) = \
+            mtd.compute_exposure(
+                cases,
+                files,
+                range_ys,
+                exposure_ids,
+                sub_fins
+            )
+
+        mtd.update_report(report, cases)
+
+        stg.mark_done(stages, 'compute_exposure')
+    else:
+        print('Read from files ...')
+
+        (parent_exposure, report['memory']['parent_exposure']) = load.read_table(
+            files['rnd_outputs']['parents']['expo'],
+            float32=cases['float32']
+        )
+
+        (sub_exposure, report['memory']['sub_exposure']) = load.read_table(
+            files['rnd_outputs']['subs']['expo'],
+            usecols=stage_cols['compute_sub_rnd']['sub_exposure'],
+            float32=cases['float32']
+        )
+    # </editor-fold>
+
+    # <editor-fold desc="#6 - Calculating group and subsidiary level rnd">
+    print('#6 - Calculating group and subsidiary level rnd')
+
+    perf.start_stage('#6 - Calculating group and subsidiary level rnd')
+
+    report.setdefault('compute_rnd', {})
+
+    if stg.is_stale(stages, 'compute_parent_rnd') and increment is not None:
+        (report['compute_rnd']['at_parent_level'], parent_rnd) = inc.compute_parent_rnd(cases, files, range_ys,
+                                                                                        parent_exposure, parent_fins,
+                                                                                        increment)
+
+        mtd.update_report(report, cases)
+
+        stg.mark_done(stages, 'compute_parent_rnd')
+    elif stg.is_stale(stages, 'compute_parent_rnd'):
+        (report['compute_rnd']['at_parent_level'], parent_rnd) = mtd.compute_parent_rnd(
             cases,
             files,
             range_ys,
-            sub_ids,
-            sub_fins
+            parent_exposure,
+            parent_fins
         )
 
-    mtd.update_report(report, cases)
-else:
-    print('Read from files ...')
-
-    parent_exposure = pd.read_csv(
-        files['rnd_outputs']['parents']['expo'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['bvd9']
-        }
-    )
+        mtd.update_report(report, cases)
 
-    sub_exposure = pd.read_csv(
-        files['rnd_outputs']['subs']['expo'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['bvd9', 'sub_bvd9']
-        }
-    )
-# </editor-fold>
+        stg.mark_done(stages, 'compute_parent_rnd')
+    else:
+        print('Read from file ...')
 
-# <editor-fold desc="#6 - Calculating group and subsidiary level rnd">
-print('#6 - Calculating group and subsidiary level rnd')
+        (parent_rnd, report['memory']['parent_rnd']) = load.read_table(
+            files['rnd_outputs']['parents']['rnd'],
+            usecols=stage_cols['compute_sub_rnd']['parent_rnd'],
+            float32=cases['float32']
+        )
 
-if not files['rnd_outputs']['parents']['rnd'].exists():
-    report['compute_rnd'] = {}
+    if stg.is_stale(stages, 'compute_sub_rnd') and increment is not None:
+        (report['compute_rnd']['at_subsidiary_level'], sub_rnd) = inc.compute_sub_rnd(cases, files, range_ys,
+                                                                                      sub_exposure, parent_rnd,
+                                                                                      increment)
 
-    (report['compute_rnd']['at_parent_level'], parent_rnd) = mtd.compute_parent_rnd(
-        cases,
-        files,
-        range_ys,
-        parent_exposure,
-        parent_fins
-    )
+        mtd.update_report(report, cases)
 
-    mtd.update_report(report, cases)
-else:
-    print('Read from file ...')
-
-    parent_rnd = pd.read_csv(
-        files['rnd_outputs']['parents']['rnd'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['bvd9']
-        }
-    )
+        stg.mark_done(stages, 'compute_sub_rnd')
+    elif stg.is_stale(stages, 'compute_sub_rnd'):
+        (report['compute_rnd']['at_subsidiary_level'], sub_rnd) = mtd.compute_sub_rnd(cases, files, range_ys,
+                                                                                      sub_exposure, parent_rnd)
+
+        mtd.update_report(report, cases)
+
+        stg.mark_done(stages, 'compute_sub_rnd')
+    else:
+        print('Read from file ...')
 
-if not files['rnd_outputs']['subs']['rnd'].exists():
-    (report['compute_rnd']['at_subsidiary_level'], sub_rnd) = mtd.compute_sub_rnd(cases, files, range_ys, sub_exposure,
-                                                                                  parent_rnd)
+        (sub_rnd, report['memory']['sub_rnd']) = load.read_table(
+            files['rnd_outputs']['subs']['rnd'],
+            float32=cases['float32']
+        )
+    # </editor-fold>
+
+    # <editor-fold desc="#7 - Build rnd cube">
+    print('#7 - Build rnd cube')
+
+    perf.start_stage('#7 - Build rnd cube')
+
+    if stg.is_stale(stages, 'build_rnd_cube'):
+        # Countries and keyword clusters of subsidiaries are not handed over in memory by the upstream stages
+        (cube_sub_ids, report['memory']['cube_sub_ids']) = load.read_table(
+            files['rnd_outputs']['subs']['id'],
+            usecols=stage_cols['build_rnd_cube']['sub_ids'],
+            float32=cases['float32']
+        )
+
+        (cube_sub_fins, report['memory']['cube_sub_fins']) = load.read_table(
+            files['rnd_outputs']['subs']['fin'],
+            usecols=stage_cols['build_rnd_cube']['sub_fins'] + list(keywords.keys()),
+            flags=list(keywords.keys()),
+            float32=cases['float32']
+        )
+
+        mtd.build_rnd_cube(
+            cases,
+            files,
+            list(keywords.keys()),
+            sub_rnd,
+            parent_ids,
+            parent_guo_ids,
+            cube_sub_ids,
+            country_map,
+            cube_sub_fins
+        )
+
+        stg.mark_done(stages, 'build_rnd_cube')
+    # </editor-fold>
+
+    perf.start_stage('Write pending outputs')
+
+    load.save_entities(**files['output_options'])
+
+    load.flush_tables()
+
+    perf.end_stage()
 
     mtd.update_report(report, cases)
-else:
-    print('Read from file ...')
-
-    sub_rnd = pd.read_csv(
-        files['rnd_outputs']['subs']['rnd'],
-        na_values='#N/A',
-        dtype={
-            col: str for col in ['bvd9', 'sub_bvd9']
-        }
-    )
-# </editor-fold>
\ No newline at end of file
+
+
+if __name__ == '__main__':
+    # Guard the entry point so that worker processes spawned for file parsing do not rerun the pipeline
+    main()
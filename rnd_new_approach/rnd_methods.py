@@ -3,15 +3,81 @@ from pathlib import Path
 
 import pandas as pd
 import numpy as np
+from pandas.api.types import is_float_dtype
 
 import json
 from tabulate import tabulate
 
 from data_input import file_loader as load
+from rnd_new_approach import rnd_performance as perf
+from rnd_new_approach import rnd_keywords as kwd
+from rnd_new_approach import rnd_graph as grf
+from rnd_new_approach import rnd_arrays as arr
+from rnd_new_approach import rnd_sparse as sps
+from rnd_new_approach import rnd_star as star
+from rnd_new_approach import rnd_cube as cube
 
 
+def stage_columns(cases,
+                  range_ys):
+    """
+    Declare the columns each pipeline stage reads from its input tables
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param range_ys: dictionary of year ranges for financials
+    :return: dictionary of stage names to dictionaries of table names to lists of columns
+    """
+    oprev_ys = range_ys['oprev_ys']
+    rnd_ys = range_ys['rnd_ys']
+    LY = range_ys['LY']
+
+    desc_cols = ['trade_desc', 'products&services_desc', 'full_overview_desc']
+
+    return {
+        'load_parent_ids': {
+            'parent_ids': ['company_name', 'bvd9', 'bvd_id', 'legal_entity_id', 'country_2DID_iso', 'NACE_4Dcode',
+                           'NACE_desc', 'subs_n', 'guo_type', 'guo_name', 'guo_bvd9', 'guo_bvd_id',
+                           'guo_legal_entity_id', 'guo_country_2DID_iso']
+        },
+        'load_parent_fins': {
+            'parent_fins': ['bvd9', 'Emp_number_y' + LY, 'sales_y' + LY] + rnd_ys[::-1] + oprev_ys[::-1]
+        },
+        'load_sub_ids': {
+            'sub_ids': ['company_name', 'bvd9', 'sub_company_name', 'sub_bvd9', 'sub_bvd_id', 'sub_legal_entity_id',
+                        'sub_country_2DID_iso', 'sub_NACE_4Dcode', 'sub_NACE_desc', 'sub_lvl']
+        },
+        'load_sub_fins': {
+            'sub_fins': ['sub_bvd9'] + desc_cols + oprev_ys[::-1] + rnd_ys[::-1]
+        },
+        'screen_sub_fins_for_keywords': {
+            'sub_fins': ['sub_bvd9'] + desc_cols + oprev_ys[::-1]
+        },
+        'compute_exposure': {
+            'sub_ids': ['bvd9', 'sub_bvd9'] + cases['methods'],
+            'sub_fins': ['sub_bvd9', 'sub_turnover_sum', 'sub_turnover_sum_masked', 'keyword_mask'] +
+                        (oprev_ys if cases['exposure_by_year'] else [])
+        },
+        'rnd_coverage': {
+            'parent_fins': ['bvd9', 'rnd_mean']
+        },
+        'compute_parent_rnd': {
+            'parent_fins': ['bvd9'] + rnd_ys + oprev_ys
+        },
+        'compute_sub_rnd': {
+            'sub_exposure': ['sub_bvd9', 'bvd9'] + (['year'] if cases['exposure_by_year'] else []) +
+                            ['sub_exposure', 'method'],
+            'parent_rnd': ['bvd9', 'year', 'parent_rnd', 'parent_rnd_clean', 'method']
+        },
+        'build_rnd_cube': {
+            'sub_ids': ['sub_bvd9', 'sub_country_2DID_iso'],
+            'sub_fins': ['sub_bvd9']
+        }
+    }
+
+
+@perf.track
 def load_parent_ids(cases,
                     files,
+                    range_ys,
                     country_map):
     """
     Load identification data for parent companies
@@ -29,7 +95,11 @@ def load_parent_ids(cases,
         df = load.parent_ids_from_orbis_xls(
             cases['case_root'].joinpath(r'input/parent_ids'),
             cases['parent_id_files_n'][company_type],
-            company_type
+            company_type,
+            cases['loader_workers'],
+            cases['cache_root'],
+            stage_columns(cases, range_ys)['load_parent_ids']['parent_ids'],
+            float32=cases['float32']
         )
 
         df['is_' + str(company_type)] = True
@@ -47,6 +117,9 @@ def load_parent_ids(cases,
         parent_ids['is_' + str(company_type)] = False
         parent_ids.loc[parent_ids['bvd9'].isin(df_cache[company_type]), 'is_' + str(company_type)] = True
 
+    # Intern identifiers as entity keys for the joins of the next stages
+    parent_ids = load.encode_ids(parent_ids)
+
     # Define column ids
     id_columns = ['bvd9', 'company_name', 'bvd_id', 'legal_entity_id', 'guo_bvd9'] + \
                  ['is_' + str(company_type) for company_type in cases['company_types']] + \
@@ -79,23 +152,22 @@ def load_parent_ids(cases,
     print('Save parent company ids output files ...')
 
     # Save output table of selected parent companies
-    id_merge.to_csv(files['rnd_outputs']['parents']['id'],
-                    columns=id_columns + ['country_3DID_iso', 'world_player'],
-                    float_format='%.10f',
-                    index=False,
-                    na_rep='#N/A'
-                    )
-
-    guo_merge.to_csv(files['rnd_outputs']['parents']['guo'],
+    load.write_table(id_merge,
+                     files['rnd_outputs']['parents']['id'],
+                     columns=id_columns + ['country_3DID_iso', 'world_player'],
+                     **files['output_options']
+                     )
+
+    load.write_table(guo_merge,
+                     files['rnd_outputs']['parents']['guo'],
                      columns=guo_columns + ['guo_country_3DID_iso', 'guo_world_player'],
-                     float_format='%.10f',
-                     index=False,
-                     na_rep='#N/A'
+                     **files['output_options']
                      )
 
     return report, id_merge, guo_merge
 
 
+@perf.track
 def load_parent_fins(cases,
                      files,
                      range_ys):
@@ -116,7 +188,11 @@ def load_parent_fins(cases,
         cases['parent_fin_files_n'],
         oprev_ys,
         rnd_ys,
-        LY
+        LY,
+        cases['loader_workers'],
+        cases['cache_root'],
+        stage_columns(cases, range_ys)['load_parent_fins']['parent_fins'],
+        float32=cases['float32']
     )
 
     parent_fins = parent_fins.dropna(subset=rnd_ys, how='all')
@@ -124,6 +200,9 @@ def load_parent_fins(cases,
     for cols in rnd_ys:
         parent_fins[parent_fins[cols] < 0] = 0
 
+    # Intern identifiers as entity keys for the joins of the next stages
+    parent_fins = load.encode_ids(parent_fins)
+
     parent_fins['rnd_mean'] = parent_fins[rnd_ys].mean(axis=1, skipna=True)
 
     parent_fin_cols = ['bvd9', 'Emp_number_y' + LY, 'sales_y' + LY,
@@ -131,13 +210,12 @@ def load_parent_fins(cases,
 
     # parent_fins['Emp_number_y' + LY] = parent_fins['Emp_number_y' + LY].astype(int)
 
-    # Save it as csv
-    parent_fins.to_csv(files['rnd_outputs']['parents']['fin'],
-                       columns=parent_fin_cols,
-                       float_format='%.10f',
-                       index=False,
-                       na_rep='#N/A'
-                       )
+    # Save it
+    load.write_table(parent_fins,
+                     files['rnd_outputs']['parents']['fin'],
+                     columns=parent_fin_cols,
+                     **files['output_options']
+                     )
 
     # melted = parent_fins.melt(
     #     id_vars=['bvd9'],
@@ -157,29 +235,110 @@ def load_parent_fins(cases,
     return report, parent_fins
 
 
+@perf.track
+def rank_parent_ids_by_rnd(parent_fins,
+                           rnd_limits):
+    """
+    Rank parent companies by decreasing mean rnd and count the top companies needed to represent each rnd_limit
+    A single sort and cumulative sum give all counts: the count for a limit is the length of the shortest head of the
+    ranking whose cumulated mean rnd reaches rnd_limit of total mean rnd
+    :param parent_fins: DataFrame of parent company financials with rnd_mean
+    :param rnd_limits: list of shares of total mean rnd to represent
+    :return: DataFrame of parent companies with rnd ranked by decreasing mean rnd (ties in input order) and dictionary
+    of rnd_limits to the number of top companies representing them
+    """
+    ranked = parent_fins.dropna(subset=['rnd_mean']).sort_values(by='rnd_mean', ascending=False, kind='mergesort')
+
+    cum_rnd = ranked['rnd_mean'].cumsum().values
+
+    total_rnd = parent_fins['rnd_mean'].sum()
+
+    counts = {}
+
+    for rnd_limit in rnd_limits:
+        threshold = rnd_limit * total_rnd
+
+        counts[rnd_limit] = 0 if threshold <= 0 else int(
+            min(np.searchsorted(cum_rnd, threshold, side='left') + 1, len(ranked))
+        )
+
+    return ranked, counts
+
+
+@perf.track
 def select_parent_ids_with_rnd(parent_fins,
                                rnd_limit):
-    # Identify the top companies that constitute 99% of the R&D expenses
-    start = 0.0
-    count = 0
-
+    """
+    Select the top parent companies by mean rnd that represent rnd_limit of total mean rnd
+    :param parent_fins: DataFrame of parent company financials with rnd_mean
+    :param rnd_limit: share of total mean rnd to represent
+    :return: DataFrame of selected parent companies ranked by decreasing mean rnd
+    """
     print('Select parent companies representing ' + str(rnd_limit) + ' of total RnD')
 
-    parent_fins.sort_values(by='rnd_mean', ascending=False, na_position='last')
+    (ranked, counts) = rank_parent_ids_by_rnd(parent_fins, [rnd_limit])
+
+    return ranked.head(counts[rnd_limit])
+
+
+@perf.track
+def rnd_coverage(parent_fins,
+                 parent_ids,
+                 rnd_limits,
+                 by=('world_player', 'country_3DID_iso')):
+    """
+    Report how the selection of top parent companies by mean rnd represents total mean rnd for several rnd_limit, in
+    total and in each region, from a single ranking
+    :param parent_fins: DataFrame of parent company financials with rnd_mean
+    :param parent_ids: DataFrame of parent company identification with region columns
+    :param rnd_limits: list of shares of total mean rnd to evaluate
+    :param by: region columns of parent_ids to report coverage for
+    :return: dictionary of total coverage by rnd_limit and, for each region column, of coverage by region and
+    rnd_limit
+    """
+    print('Compute rnd coverage of parent company selection ...')
+
+    (ranked, counts) = rank_parent_ids_by_rnd(parent_fins, rnd_limits)
+
+    ranked = pd.merge(
+        ranked[['bvd9', 'rnd_mean']],
+        parent_ids.drop_duplicates(subset=['bvd9'])[['bvd9'] + list(by)],
+        left_on='bvd9', right_on='bvd9',
+        how='left',
+        suffixes=(False, False)
+    )
+
+    total_rnd = ranked['rnd_mean'].sum()
+
+    report = {'total': {}}
 
-    while start < rnd_limit * parent_fins['rnd_mean'].sum():
-        count += 1
-        start = parent_fins.nlargest(count, ['rnd_mean'])['rnd_mean'].sum()
+    for rnd_limit in rnd_limits:
+        selected = ranked.head(counts[rnd_limit])
 
-    selected_parent_ids = parent_fins.nlargest(count, ['rnd_mean'])
+        report['total'][str(rnd_limit)] = {
+            'selected_bvd9': int(selected['bvd9'].nunique()),
+            'selected_rnd_mean': float(selected['rnd_mean'].sum()),
+            'coverage': float(selected['rnd_mean'].sum() / total_rnd) if total_rnd else None
+        }
+
+    for region in by:
+        region_rnd = ranked.groupby(region, observed=True)['rnd_mean'].sum()
 
-    selected_parent_ids.drop_duplicates(subset=['bvd9'], keep='first')
+        coverage = pd.DataFrame({
+            str(rnd_limit): ranked.head(counts[rnd_limit]).groupby(region, observed=True)['rnd_mean'].sum().reindex(
+                region_rnd.index, fill_value=0
+            ) / region_rnd for rnd_limit in rnd_limits
+        })
 
-    return selected_parent_ids
+        report[region] = coverage.astype(object).where(coverage.notna(), None).to_dict(orient='index')
 
+    return report
 
+
+@perf.track
 def load_sub_ids(cases,
                  files,
+                 range_ys,
                  country_map):
     """
     Consolidate a unique list of subsidiaries
@@ -192,12 +351,19 @@ def load_sub_ids(cases,
 
     sub_ids = load.sub_ids_from_orbis_xls(
         cases['case_root'].joinpath(r'input/sub_ids'),
-        cases['sub_id_files_n']
+        cases['sub_id_files_n'],
+        cases['loader_workers'],
+        cases['cache_root'],
+        stage_columns(cases, range_ys)['load_sub_ids']['sub_ids'],
+        float32=cases['float32']
     )
 
     # Drop not bvd identified subsidiaries and (group,subs) duplicates
     sub_ids = sub_ids.dropna(subset=['bvd9', 'sub_bvd9']).drop_duplicates(['bvd9', 'sub_bvd9'], keep='first')
 
+    # Intern identifiers as entity keys for the joins of the next stages
+    sub_ids = load.encode_ids(sub_ids)
+
     report['Claimed by parent companies'] = {'selected_bvd9': sub_ids['bvd9'].nunique(),
                                              'sub_bvd9_in_selected_bvd9': sub_ids['sub_bvd9'].count().sum(),
                                              'unique_sub_bvd9': sub_ids['sub_bvd9'].nunique()
@@ -220,22 +386,25 @@ def load_sub_ids(cases,
     sub_id_cols = ['sub_bvd9', 'bvd9', 'sub_company_name', 'sub_bvd_id',
                    'sub_legal_entity_id', 'sub_lvl', 'sub_country_2DID_iso', 'sub_country_3DID_iso', 'sub_world_player']
 
-    # Save it as csv
-    id_merge.to_csv(files['rnd_outputs']['subs']['id'],
-                    columns=sub_id_cols,
-                    float_format='%.10f',
-                    index=False,
-                    na_rep='#N/A'
-                    )
+    # Save it
+    load.write_table(id_merge,
+                     files['rnd_outputs']['subs']['id'],
+                     columns=sub_id_cols,
+                     **files['output_options']
+                     )
 
     return report, sub_ids
 
 
+@perf.track
 def load_sub_fins(cases,
                   files,
-                  range_ys):
+                  range_ys,
+                  sub_bvd9_ids=None):
     """
     Loads financials for subsidiaries
+    :param sub_bvd9_ids: entity keys of the subsidiaries to keep, rows of other subsidiaries are discarded as each file
+    is read (None to keep all subsidiaries)
     """
     sub_fins = pd.DataFrame()
     report = {}
@@ -251,16 +420,23 @@ def load_sub_fins(cases,
         cases['sub_fin_files_n'],
         oprev_ys,
         rnd_ys,
-        LY
+        LY,
+        cases['loader_workers'],
+        cases['cache_root'],
+        stage_columns(cases, range_ys)['load_sub_fins']['sub_fins'],
+        float32=cases['float32'],
+        # Exports are filtered on identifiers as parsed
+        sub_bvd9_ids=None if sub_bvd9_ids is None else load.entity_names(sub_bvd9_ids)
     )
 
-    # sub_fins = sub_fins[sub_fins['sub_bvd9'].isin(select_subs['sub_bvd9'])]
-
     sub_fins = sub_fins.drop_duplicates('sub_bvd9')
 
     for cols in rnd_ys:
         sub_fins[sub_fins[cols] < 0] = 0
 
+    # Intern identifiers as entity keys for the joins of the next stages
+    sub_fins = load.encode_ids(sub_fins)
+
     sub_fins_w_fin = sub_fins.dropna(subset=oprev_ys, how='all')
 
     report['Returned by ORBIS'] = {'sub_bvd9_in_selected_bvd9': sub_fins['sub_bvd9'].count().sum(),
@@ -279,13 +455,12 @@ def load_sub_fins(cases,
     sub_fins_cols = ['sub_bvd9', 'trade_desc', 'products&services_desc', 'full_overview_desc'] + \
                     oprev_ys[::-1] + rnd_ys[::-1]
 
-    # Save it as csv
-    sub_fins.to_csv(files['rnd_outputs']['subs']['fin'],
-                    columns=sub_fins_cols,
-                    float_format='%.10f',
-                    index=False,
-                    na_rep='#N/A'
-                    )
+    # Save it
+    load.write_table(sub_fins,
+                     files['rnd_outputs']['subs']['fin'],
+                     columns=sub_fins_cols,
+                     **files['output_options']
+                     )
 
     # melted = sub_fins.melt(
     #     id_vars=['sub_company_name', 'sub_bvd9', 'trade_desc', 'products&services_desc', 'full_overview_desc'],
@@ -305,6 +480,7 @@ def load_sub_fins(cases,
     return report, sub_fins
 
 
+@perf.track
 def screen_sub_ids_for_method(cases,
                               files,
                               parent_ids,
@@ -325,21 +501,22 @@ def screen_sub_ids_for_method(cases,
     # sub_ids['is_sub_a_comp'] = sub_ids['sub_bvd9'].isin(sub_ids['bvd9'])
     # sub_ids['has_fin'] = sub_ids['sub_bvd9'].isin(sub_fins['sub_bvd9'])
 
+    # Ownership graph over entity keys, flags being read from the edges of each company instead of isin over tables
+    graph = grf.ownership_graph(sub_ids, parent_ids)
+
     # Flag subsidiaries that are subsidiaries of multiple parent companies
-    sub_ids.loc[sub_ids['sub_bvd9'].duplicated(keep=False), 'is_sub_a_duplicate'] = True
-    sub_ids.loc[sub_ids['is_sub_a_duplicate'] != True, 'is_sub_a_duplicate'] = False
+    sub_ids['is_sub_a_duplicate'] = grf.is_multi_parent_sub(graph, sub_ids['sub_bvd9'])
 
-    sub_ids.loc[:, 'keep_all'] = True
+    sub_ids['keep_all'] = True
 
     # sub_ids.loc[~sub_ids['bvd9'].isin(sub_ids['sub_bvd9']), 'keep_comps'] = True
     # sub_ids.loc[sub_ids['keep_comps'] != True, 'keep_comps'] = False
     # sub_ids.loc[~sub_ids['sub_bvd9'].isin(sub_ids['bvd9']), 'keep_subs'] = True
     # sub_ids.loc[sub_ids['keep_subs'] != True, 'keep_subs'] = False
 
-    sub_ids.loc[~sub_ids['bvd9'].isin(sub_ids['sub_bvd9']), 'keep_subs'] = True
-    sub_ids.loc[sub_ids['keep_subs'] != True, 'keep_subs'] = False
-    sub_ids.loc[~sub_ids['sub_bvd9'].isin(parent_ids['bvd9']), 'keep_comps'] = True
-    sub_ids.loc[sub_ids['keep_comps'] != True, 'keep_comps'] = False
+    # Parent companies that are a subsidiary and subsidiaries that are a parent company
+    sub_ids['keep_subs'] = ~grf.is_sub(graph, sub_ids['bvd9'])
+    sub_ids['keep_comps'] = ~grf.is_listed_parent(graph, sub_ids['sub_bvd9'])
 
     for method in cases['methods']:
         print('Flag strategy: ' + str(method))
@@ -356,24 +533,32 @@ def screen_sub_ids_for_method(cases,
     sub_ids_cols = ['sub_bvd9', 'bvd9', 'sub_company_name', 'sub_bvd_id', 'sub_legal_entity_id', 'sub_country_2DID_iso',
                     'sub_NACE_4Dcode', 'sub_NACE_desc', 'sub_lvl', 'keep_all', 'keep_comps', 'keep_subs']
 
-    # Save it as csv
-    sub_ids.to_csv(files['rnd_outputs']['subs']['id'],
-                   columns=sub_ids_cols,
-                   float_format='%.10f',
-                   index=False,
-                   na_rep='#N/A'
-                   )
+    # Save it
+    load.write_table(sub_ids,
+                     files['rnd_outputs']['subs']['id'],
+                     columns=sub_ids_cols,
+                     **files['output_options']
+                     )
 
     return report, sub_ids
 
 
+@perf.track
 def screen_sub_fins_for_keywords(cases,
                                  files,
                                  range_ys,
                                  keywords,
-                                 sub_fins):
+                                 sub_fins,
+                                 sub_bvd9_ids=None):
+    """
+    Flag subsidiaries whose activity descriptions match keywords and compute their (masked) turnover
+    :param sub_bvd9_ids: entity keys of the subsidiaries to screen (None to screen all subsidiaries)
+    """
     print('Screen subsidiary activity for keywords')
 
+    if sub_bvd9_ids is not None:
+        sub_fins = sub_fins[sub_fins['sub_bvd9'].isin(sub_bvd9_ids)].copy()
+
     categories = list(keywords.keys())
 
     report = {}
@@ -382,14 +567,23 @@ def screen_sub_fins_for_keywords(cases,
     rnd_ys = range_ys['rnd_ys']
     LY = range_ys['LY']
 
-    for category in categories:
+    desc_cols = ['trade_desc', 'products&services_desc', 'full_overview_desc']
+
+    # Scan each description once for the keywords of all categories, only for categories and descriptions not cached
+    if cases['cache_root'] is None:
+        category_hits = kwd.screen_descriptions(sub_fins,
+                                                kwd.compile_keywords(keywords),
+                                                desc_cols,
+                                                cases['screening_workers'])
+    else:
+        category_hits = kwd.screen_descriptions_cached(sub_fins,
+                                                       keywords,
+                                                       desc_cols,
+                                                       cases['cache_root'].joinpath(r'keyword_hits'),
+                                                       cases['screening_workers'])
 
-        sub_fins[category] = False
-
-        for keyword in keywords[category]:
-            sub_fins[category] |= sub_fins['trade_desc'].str.contains(keyword, case=False, regex=False) | \
-                                  sub_fins['products&services_desc'].str.contains(keyword, case=False, regex=False) | \
-                                  sub_fins['full_overview_desc'].str.contains(keyword, case=False, regex=False)
+    for category in categories:
+        sub_fins[category] = category_hits[category]
 
     # screen_subs = sub_fins.loc[:, ['sub_company_name', 'sub_bvd9', 'sub_bvd_id'] + categories]
 
@@ -407,78 +601,113 @@ def screen_sub_fins_for_keywords(cases,
     sub_fins_cols = ['sub_bvd9', 'trade_desc', 'products&services_desc', 'full_overview_desc'] + \
                     oprev_ys[::-1]
 
-    # Save it as csv
-    sub_fins.to_csv(files['rnd_outputs']['subs']['fin'],
-                    columns=sub_fins_cols +
-                            ['sub_turnover_sum', 'sub_turnover_sum_masked', 'keyword_mask'] +
-                            [cat for cat in categories],
-                    float_format='%.10f',
-                    index=False,
-                    na_rep='#N/A'
-                    )
+    # Save it
+    load.write_table(sub_fins,
+                     files['rnd_outputs']['subs']['fin'],
+                     columns=sub_fins_cols +
+                             ['sub_turnover_sum', 'sub_turnover_sum_masked', 'keyword_mask'] +
+                             [cat for cat in categories],
+                     **files['output_options']
+                     )
 
     return report, sub_fins
 
 
+@perf.track
 def compute_exposure(cases,
                      files,
                      range_ys,
                      selected_sub_ids,
-                     sub_fins):
-    sub_exposure_conso = pd.DataFrame()
-    parent_exposure_conso = pd.DataFrame()
+                     sub_fins,
+                     save=True):
+    """
+    Compute parent and subsidiary level exposure for all methods in one pass
+    Subsidiaries are joined with their financials once and the turnovers of each parent company are summed for all
+    methods in a single grouped aggregation, the rows of subsidiaries not kept by a method being masked as missing so
+    that each method sums the same values in the same order as when computed on its own
+    :param selected_sub_ids: DataFrame of (bvd9, sub_bvd9) with a boolean flag column per method
+    :param sub_fins: DataFrame of screened subsidiary financials
+    :param save: write the output tables (False to only return them)
+    :return: keyword match and exposure reports, parent and subsidiary exposure of all methods, method after method
+    """
+    if cases['exposure_by_year']:
+        return compute_exposure_by_year(cases, files, range_ys, selected_sub_ids, sub_fins, save)
+
     report_keyword_match = {}
     report_exposure = {'at_subsidiary_level': {}, 'at_parent_level': {}}
 
-    oprev_ys = range_ys['oprev_ys']
-    rnd_ys = range_ys['rnd_ys']
-    LY = range_ys['LY']
+    methods = [str(method) for method in cases['methods']]
 
-    print('Compute exposure for strategy:')
+    # Keep only the columns used for exposure, descriptions do not travel through the merges
+    sub_fins = sub_fins[stage_columns(cases, range_ys)['compute_exposure']['sub_fins']]
 
-    for method in cases['methods']:
-        print('... ' + str(method))
-        sub_exposure = pd.DataFrame()
+    print('Compute exposure for strategies: ' + ', '.join(methods))
 
-        # Merging selected subsidiaries by method with masked turnover and turnover
-        sub_exposure = pd.merge(
-            selected_sub_ids[selected_sub_ids[method] == True], sub_fins,
-            left_on=['sub_bvd9'], right_on=['sub_bvd9'],
-            how='left'
-        )
+    # Merging selected subsidiaries with masked turnover and turnover, once for all methods
+    sub_exposure = pd.merge(
+        selected_sub_ids[['bvd9', 'sub_bvd9'] + cases['methods']], sub_fins,
+        left_on=['sub_bvd9'], right_on=['sub_bvd9'],
+        how='left'
+    )
 
-        # Calculating group exposure
-        parent_exposure = sub_exposure[
-            ['bvd9', 'sub_turnover_sum_masked', 'sub_turnover_sum']
-        ].groupby(['bvd9']).sum().rename(
-            columns={'sub_turnover_sum': 'total_sub_turnover_sum_in_parent',
-                     'sub_turnover_sum_masked': 'total_sub_turnover_sum_masked_in_parent'}
-        )
+    flags = (sub_exposure[cases['methods']] == True).values
 
-        parent_exposure['parent_exposure'] = parent_exposure['total_sub_turnover_sum_masked_in_parent'] / \
-                                             parent_exposure['total_sub_turnover_sum_in_parent']
+    sub_exposure = sub_exposure.drop(columns=cases['methods'])
 
-        parent_exposure['method'] = str(method)
+    # Calculating group exposure of all methods, turnovers of subsidiaries not kept by a method being missing
+    masked_turnover = sub_exposure['sub_turnover_sum_masked'].values[:, None]
+    turnover = sub_exposure['sub_turnover_sum'].values[:, None]
 
-        parent_exposure.reset_index(inplace=True)
+    group_sums = pd.concat(
+        [pd.DataFrame(np.where(flags, masked_turnover, np.nan)),
+         pd.DataFrame(np.where(flags, turnover, np.nan)),
+         pd.DataFrame(flags)],
+        axis=1, keys=['masked', 'total', 'kept']
+    ).groupby(sub_exposure['bvd9'].values).sum()
 
-        parent_exposure_conso = parent_exposure_conso.append(parent_exposure)
+    group_keys = group_sums.index.values
+    masked_sums = group_sums['masked'].values
+    total_sums = group_sums['total'].values
 
-        # Calculating subsidiary level exposure
-        sub_exposure = pd.merge(
-            sub_exposure, parent_exposure[
-                ['bvd9', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
-                 'parent_exposure']],
-            left_on='bvd9', right_on='bvd9',
-            how='left'
-        )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exposures = masked_sums / total_sums
+
+    # Parent companies kept by each method, method after method and in bvd9 order
+    group_order = np.argsort(load.entity_ranks(group_keys), kind='mergesort')
+
+    (method_index, group_index) = np.nonzero(group_sums['kept'].values[group_order].T > 0)
+    group_index = group_order[group_index]
 
-        sub_exposure['sub_exposure'] = sub_exposure['sub_turnover_sum_masked'] / sub_exposure[
-            'total_sub_turnover_sum_in_parent']
+    parent_exposure_conso = pd.DataFrame({
+        'bvd9': group_keys[group_index],
+        'total_sub_turnover_sum_masked_in_parent': masked_sums[group_index, method_index],
+        'total_sub_turnover_sum_in_parent': total_sums[group_index, method_index],
+        'parent_exposure': exposures[group_index, method_index],
+        'method': np.array(methods, dtype=object)[method_index]
+    })
 
-        sub_exposure['method'] = str(method)
+    # Calculating subsidiary level exposure of the subsidiaries kept by each method, method after method
+    (method_index, row_index) = np.nonzero(flags.T)
+    group_index = np.searchsorted(group_keys, sub_exposure['bvd9'].values[row_index])
 
-        sub_exposure.dropna(subset=['parent_exposure', 'sub_turnover_sum'], inplace=True)
+    sub_exposure_conso = sub_exposure.iloc[row_index].reset_index(drop=True).assign(
+        total_sub_turnover_sum_masked_in_parent=masked_sums[group_index, method_index],
+        total_sub_turnover_sum_in_parent=total_sums[group_index, method_index],
+        parent_exposure=exposures[group_index, method_index]
+    )
+
+    sub_exposure_conso['sub_exposure'] = sub_exposure_conso['sub_turnover_sum_masked'] / sub_exposure_conso[
+        'total_sub_turnover_sum_in_parent']
+
+    sub_exposure_conso['method'] = np.array(methods, dtype=object)[method_index]
+
+    sub_exposure_conso.dropna(subset=['parent_exposure', 'sub_turnover_sum'], inplace=True)
+
+    for method in cases['methods']:
+        print('... ' + str(method))
+
+        parent_exposure = parent_exposure_conso[parent_exposure_conso['method'] == str(method)]
+        sub_exposure = sub_exposure_conso[sub_exposure_conso['method'] == str(method)]
 
         report_keyword_match['From ORBIS with applied method: ' + str(method)] = {
             'sub_bvd9_in_selected_bvd9': selected_sub_ids['sub_bvd9'][selected_sub_ids[method] == True].count().sum(),
@@ -497,160 +726,361 @@ def compute_exposure(cases,
             }
         })
 
-        sub_exposure_conso = sub_exposure_conso.append(sub_exposure)
-
     parent_exposure_cols = ['bvd9', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
                             'parent_exposure', 'method']
 
+    sub_exposure_cols = ['sub_bvd9', 'sub_turnover_sum', 'sub_turnover_sum_masked', 'sub_exposure'] + \
+                        parent_exposure_cols
+
     # Save output tables
-    parent_exposure_conso.to_csv(files['rnd_outputs']['parents']['expo'],
-                                 columns=parent_exposure_cols,
-                                 float_format='%.10f',
-                                 index=False,
-                                 na_rep='#N/A'
-                                 )
-
-    sub_exposure_conso.to_csv(files['rnd_outputs']['subs']['expo'],
-                              columns=['sub_bvd9',
-                                       'sub_turnover_sum',
-                                       'sub_turnover_sum_masked',
-                                       'sub_exposure'] + parent_exposure_cols,
-                              float_format='%.10f',
-                              index=False,
-                              na_rep='#N/A'
-                              )
-
-    return report_keyword_match, report_exposure, parent_exposure_conso, sub_exposure_conso
+    if save:
+        load.write_table(parent_exposure_conso,
+                         files['rnd_outputs']['parents']['expo'],
+                         columns=parent_exposure_cols,
+                         **files['output_options']
+                         )
+
+        load.write_table(sub_exposure_conso,
+                         files['rnd_outputs']['subs']['expo'],
+                         columns=sub_exposure_cols,
+                         **files['output_options']
+                         )
+
+    return report_keyword_match, report_exposure, parent_exposure_conso, sub_exposure_conso[sub_exposure_cols]
+
+
+@perf.track
+def compute_exposure_by_year(cases,
+                             files,
+                             range_ys,
+                             selected_sub_ids,
+                             sub_fins,
+                             save=True):
+    """
+    Compute parent and subsidiary level exposure year by year for all methods
+    Yearly turnovers of subsidiaries are held as dense arrays of subsidiaries by years and summed by parent company
+    for each method, so that exposure follows the activity mix of each year. Long tables with a year column are only
+    built for the outputs
+    :param selected_sub_ids: DataFrame of (bvd9, sub_bvd9) with a boolean flag column per method
+    :param sub_fins: DataFrame of screened subsidiary financials with yearly turnovers
+    :param save: write the output tables (False to only return them)
+    :return: keyword match and exposure reports, parent and subsidiary exposure by year of all methods, method after
+    method
+    """
+    report_keyword_match = {}
+    report_exposure = {'at_subsidiary_level': {}, 'at_parent_level': {}}
+
+    parent_exposure_conso = []
+    sub_exposure_conso = []
+
+    oprev_ys = range_ys['oprev_ys']
+    years = arr.label_years(oprev_ys)
+
+    # Keep only the columns used for exposure, descriptions do not travel through the merges
+    sub_fins = sub_fins[stage_columns(cases, range_ys)['compute_exposure']['sub_fins']]
+
+    print('Compute exposure by year for strategies: ' + ', '.join([str(method) for method in cases['methods']]))
+
+    # Merging selected subsidiaries with yearly turnovers, once for all methods
+    sub_exposure = pd.merge(
+        selected_sub_ids[['bvd9', 'sub_bvd9'] + cases['methods']], sub_fins,
+        left_on=['sub_bvd9'], right_on=['sub_bvd9'],
+        how='left'
+    )
+
+    flags = (sub_exposure[cases['methods']] == True).values
+
+    # Subsidiaries by years, turnovers of subsidiaries not matching keywords being masked as missing
+    turnover = arr.wide_array(sub_exposure, oprev_ys)
+    masked_turnover = np.where((sub_exposure['keyword_mask'] == True).values[:, None], turnover, np.nan)
+
+    (group_keys, groups) = np.unique(sub_exposure['bvd9'].values, return_inverse=True)
+
+    # Parent companies in bvd9 order
+    group_order = np.argsort(load.entity_ranks(group_keys), kind='mergesort')
+
+    for (index, method) in enumerate(cases['methods']):
+        print('... ' + str(method))
+
+        # Calculating group exposure by year, turnovers of subsidiaries not kept by the method counting as zero
+        masked_sums = arr.group_sums(groups, len(group_keys), masked_turnover * flags[:, [index]])
+        total_sums = arr.group_sums(groups, len(group_keys), turnover * flags[:, [index]])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exposures = masked_sums / total_sums
+
+        kept = np.bincount(groups, weights=flags[:, index], minlength=len(group_keys)) > 0
+        parents = group_order[kept[group_order]]
+
+        parent_exposure = arr.long_table({'bvd9': group_keys[parents]}, years, {
+            'total_sub_turnover_sum_masked_in_parent': masked_sums[parents],
+            'total_sub_turnover_sum_in_parent': total_sums[parents],
+            'parent_exposure': exposures[parents]
+        })
+
+        parent_exposure['method'] = str(method)
+
+        # Calculating subsidiary level exposure by year
+        rows = np.flatnonzero(flags[:, index])
+        sub_groups = groups[rows]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sub_exposures = masked_turnover[rows] / total_sums[sub_groups]
+
+        sub_exposure_method = arr.long_table({
+            'sub_bvd9': sub_exposure['sub_bvd9'].values[rows],
+            'bvd9': sub_exposure['bvd9'].values[rows],
+            'keyword_mask': sub_exposure['keyword_mask'].values[rows]
+        }, years, {
+            'sub_turnover_sum': turnover[rows],
+            'sub_turnover_sum_masked': masked_turnover[rows],
+            'sub_exposure': sub_exposures,
+            'total_sub_turnover_sum_masked_in_parent': masked_sums[sub_groups],
+            'total_sub_turnover_sum_in_parent': total_sums[sub_groups],
+            'parent_exposure': exposures[sub_groups]
+        })
+
+        sub_exposure_method['method'] = str(method)
 
+        sub_exposure_method.dropna(subset=['parent_exposure', 'sub_turnover_sum'], inplace=True)
+
+        report_keyword_match['From ORBIS with applied method: ' + str(method)] = {
+            'sub_bvd9_in_selected_bvd9': selected_sub_ids['sub_bvd9'][selected_sub_ids[method] == True].count().sum(),
+            'unique_is_matching_a_keyword': sub_exposure_method['sub_bvd9'][
+                sub_exposure_method['keyword_mask'] == True].nunique()
+        }
+
+        report_exposure['at_parent_level'].update({
+            'With method: ' + str(method): {
+                'Total_exposure': parent_exposure['parent_exposure'].sum()
+            }
+        })
 
+        report_exposure['at_subsidiary_level'].update({
+            'With method: ' + str(method): {
+                'Total_exposure': sub_exposure_method['sub_exposure'].sum()
+            }
+        })
+
+        parent_exposure_conso.append(parent_exposure)
+        sub_exposure_conso.append(sub_exposure_method)
+
+    parent_exposure_conso = pd.concat(parent_exposure_conso, ignore_index=True)
+    sub_exposure_conso = pd.concat(sub_exposure_conso, ignore_index=True)
+
+    parent_exposure_cols = ['bvd9', 'year', 'total_sub_turnover_sum_masked_in_parent',
+                            'total_sub_turnover_sum_in_parent', 'parent_exposure', 'method']
+
+    sub_exposure_cols = ['sub_bvd9', 'sub_turnover_sum', 'sub_turnover_sum_masked', 'sub_exposure'] + \
+                        parent_exposure_cols
+
+    # Save output tables
+    if save:
+        load.write_table(parent_exposure_conso,
+                         files['rnd_outputs']['parents']['expo'],
+                         columns=parent_exposure_cols,
+                         **files['output_options']
+                         )
+
+        load.write_table(sub_exposure_conso,
+                         files['rnd_outputs']['subs']['expo'],
+                         columns=sub_exposure_cols,
+                         **files['output_options']
+                         )
+
+    return report_keyword_match, report_exposure, parent_exposure_conso, sub_exposure_conso[sub_exposure_cols]
+
+
+@perf.track
 def compute_parent_rnd(cases,
                        files,
                        range_ys,
                        parent_exposure,
-                       parent_fins):
+                       parent_fins,
+                       save=True):
+    """
+    Compute parent level rnd of all methods on dense arrays of parent companies by years
+    The rnd and operating revenue blocks of parent financials are stacked once and multiplied by exposure, a vector of
+    one exposure per parent company broadcast over years or a dense array of exposure by year. Rows are paired with
+    financials as the former merges of melted tables did, so that the long table built for the output has the same
+    rows in the same order, year after year for each method
+    :param parent_exposure: DataFrame of parent exposure of all methods, by year when exposure is by year
+    :param parent_fins: DataFrame of parent company financials
+    :param save: write the output tables (False to only return them)
+    :return: rnd report and parent rnd of all methods, method after method
+    """
     print('Compute parent level rnd')
 
-    parent_rnd_conso = pd.DataFrame()
+    parent_rnd_conso = []
 
     report_parent_rnd = {}
 
     oprev_ys = range_ys['oprev_ys']
     rnd_ys = range_ys['rnd_ys']
-    LY = range_ys['LY']
+    years = arr.label_years(rnd_ys)
+
+    parent_fins = parent_fins[stage_columns(cases, range_ys)['compute_parent_rnd']['parent_fins']]
 
-    parent_rnd = pd.merge(parent_exposure, parent_fins,
-                          left_on='bvd9', right_on='bvd9',
-                          how='left'
-                          )
+    # Parent financials by years
+    rnds = arr.wide_array(parent_fins, rnd_ys)
+    oprevs = arr.wide_array(parent_fins, oprev_ys)
 
     for method in cases['methods']:
-        parent_rnd_method = parent_rnd[parent_rnd['method'] == method]
+        parent_exposure_method = parent_exposure[parent_exposure['method'] == method]
+
+        if cases['exposure_by_year']:
+            parents = pd.unique(parent_exposure_method['bvd9'].values)
 
-        # Calculating group level rnd
-        rnd_melt = parent_rnd_method.melt(
-            id_vars=['bvd9', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
-                     'parent_exposure'],
-            value_vars=rnd_ys,
-            var_name='rnd_label', value_name='parent_rnd')
+            exposures = arr.dense_array(parent_exposure_method['bvd9'].values, parent_exposure_method['year'].values,
+                                        parent_exposure_method['parent_exposure'].values, parents, years)
+        else:
+            parents = parent_exposure_method['bvd9'].values
 
-        rnd_melt['year'] = [int('20' + s[-2:]) for s in rnd_melt['rnd_label']]
+            exposures = np.repeat(parent_exposure_method['parent_exposure'].values[:, None], len(years), axis=1)
 
-        oprev_melt = parent_rnd_method.melt(
-            id_vars=['bvd9'],
-            value_vars=oprev_ys,
-            var_name='oprev_label', value_name='parent_oprev')
+        # Rows of parent companies with their financials, as merged on bvd9
+        (rows, fin_rows) = arr.join_rows(parents, parent_fins['bvd9'].values)
 
-        oprev_melt['year'] = [int('20' + s[-2:]) for s in oprev_melt['oprev_label']]
+        # Operating revenue rows of each of these rows, as merged on bvd9 and year
+        (rnd_rows, oprev_rows) = arr.join_rows(parents[rows], parents[rows])
 
-        parent_rnd_method_melted = pd.merge(
-            rnd_melt,
-            oprev_melt,
-            left_on=['bvd9', 'year'],
-            right_on=['bvd9', 'year'],
-            how='left')
+        parent_rnd = arr.take_rows(rnds, fin_rows[rnd_rows])
+        exposure = exposures[rows[rnd_rows]]
 
-        parent_rnd_method_melted['parent_rnd_clean'] = parent_rnd_method_melted['parent_rnd'] * parent_rnd_method_melted[
-            'parent_exposure']
+        parent_rnd_method = arr.long_table({'bvd9': parents[rows[rnd_rows]]}, years, {
+            'parent_oprev': arr.take_rows(oprevs, fin_rows[oprev_rows]),
+            'parent_rnd': parent_rnd,
+            'parent_exposure': exposure,
+            'parent_rnd_clean': parent_rnd * exposure
+        }, year_major=True)
 
-        parent_rnd_method_melted['method'] = str(method)
+        parent_rnd_method['method'] = str(method)
 
-        parent_rnd_method_melted.dropna(subset=['parent_exposure', 'parent_rnd', 'parent_rnd_clean'], how='all',
+        parent_rnd_method.dropna(subset=['parent_exposure', 'parent_rnd', 'parent_rnd_clean'], how='all',
                                  inplace=True)
 
-        parent_rnd_conso = parent_rnd_conso.append(parent_rnd_method_melted)
+        parent_rnd_conso.append(parent_rnd_method)
 
         report_parent_rnd.update(
             pd.DataFrame.to_dict(
-                parent_rnd_method_melted[['year', 'parent_rnd_clean']].groupby(
+                parent_rnd_method[['year', 'parent_rnd_clean']].groupby(
                     ['year']).sum().rename(columns={'parent_rnd_clean': 'with_method: ' + str(method)})
             )
         )
 
+    parent_rnd_conso = pd.concat(parent_rnd_conso, ignore_index=True)
+
     parent_rnd_conso_cols = ['bvd9', 'year', 'parent_oprev', 'parent_rnd', 'parent_exposure', 'parent_rnd_clean',
                              'method']
 
-    parent_rnd_conso.to_csv(files['rnd_outputs']['parents']['rnd'],
-                            columns=parent_rnd_conso_cols,
-                            float_format='%.10f',
-                            index=False,
-                            na_rep='#N/A'
-                            )
+    if save:
+        load.write_table(parent_rnd_conso,
+                         files['rnd_outputs']['parents']['rnd'],
+                         columns=parent_rnd_conso_cols,
+                         **files['output_options']
+                         )
 
     return report_parent_rnd, parent_rnd_conso
 
 
+@perf.track
 def compute_sub_rnd(cases,
                     files,
                     range_ys,
                     sub_exposure,
-                    parent_rnd):
-    print('Compute subsidiary level rnd')
+                    parent_rnd,
+                    save=True):
+    """
+    Allocate parent level rnd to subsidiaries for all methods and years at once
+    Subsidiaries are paired with the yearly rnd of their parent company by a single join on integer keys (method,
+    bvd9 and year when exposure is by year) and the exposure of each parent company recovered from its subsidiaries
+    is a single grouped transform over (method, bvd9, year), so that the table is built once without intermediate
+    merges. Rows come method after method, with the same values as when computed method by method
+    :param sub_exposure: DataFrame of subsidiary exposure of all methods
+    :param parent_rnd: DataFrame of parent rnd by year of all methods
+    :param save: write the output tables (False to only return them)
+    :return: rnd report and subsidiary rnd of all methods, method after method
+    """
+    if cases['sparse_allocation']:
+        return compute_sub_rnd_sparse(cases, files, range_ys, sub_exposure, parent_rnd, save)
 
-    sub_rnd_conso = pd.DataFrame()
+    print('Compute subsidiary level rnd')
 
     report_sub_rnd = {}
 
-    oprev_ys = range_ys['oprev_ys']
-    rnd_ys = range_ys['rnd_ys']
-    LY = range_ys['LY']
+    methods = [str(method) for method in cases['methods']]
 
-    for method in cases['methods']:
-        sub_rnd = pd.DataFrame()
+    columns = stage_columns(cases, range_ys)['compute_sub_rnd']
 
-        sub_exposure_method = sub_exposure[sub_exposure['method'] == method]
-        parent_rnd_method = parent_rnd[parent_rnd['method'] == method]
+    sub_exposure = sub_exposure[columns['sub_exposure']]
+    parent_rnd = parent_rnd[columns['parent_rnd']]
 
-        # Calculating subsidiary level rnd
-        sub_rnd = pd.merge(
-            sub_exposure_method, parent_rnd_method[['bvd9', 'parent_rnd', 'year', 'parent_rnd_clean']],
-            left_on='bvd9', right_on='bvd9',
-            how='left'
-        )
+    # Methods as integer keys, -1 for methods not computed
+    sub_methods = pd.Categorical(sub_exposure['method'], categories=methods).codes
+    rnd_methods = pd.Categorical(parent_rnd['method'], categories=methods).codes
 
-        df = sub_rnd[
-            ['bvd9', 'year', 'sub_exposure']
-        ].groupby(['bvd9', 'year']).sum().rename(
-            columns={'sub_exposure': 'parent_exposure_from_sub'}
-        )
+    # Subsidiaries method after method
+    sub_rows = np.argsort(sub_methods, kind='mergesort')
+    sub_rows = sub_rows[sub_methods[sub_rows] >= 0]
 
-        sub_rnd = pd.merge(
-            sub_rnd, df,
-            left_on=['bvd9', 'year'], right_on=['bvd9', 'year'],
-            how='left',
-            suffixes=(False, False)
-        )
+    keys = ['bvd9', 'year'] if cases['exposure_by_year'] else ['bvd9']
+
+    # Calculating subsidiary level rnd, year by year when exposure is by year
+    (pair_rows, rnd_rows) = arr.join_rows(
+        [sub_methods[sub_rows]] + [sub_exposure[key].values[sub_rows] for key in keys],
+        [rnd_methods] + [parent_rnd[key].values for key in keys]
+    )
+
+    sub_rows = sub_rows[pair_rows]
+    has_rnd = rnd_rows >= 0
+
+    if cases['exposure_by_year']:
+        years = sub_exposure['year'].values[sub_rows]
+    elif has_rnd.all():
+        years = parent_rnd['year'].values[rnd_rows]
+    else:
+        # Years of subsidiaries whose parent company has no rnd are missing, as after a left merge
+        years = arr.take_rows(parent_rnd['year'].values.astype('float64'), rnd_rows)
+
+    sub_rnd_conso = pd.DataFrame({
+        'sub_bvd9': sub_exposure['sub_bvd9'].values[sub_rows],
+        'bvd9': sub_exposure['bvd9'].values[sub_rows],
+        'year': years,
+        'parent_rnd_clean': arr.take_rows(parent_rnd['parent_rnd_clean'].values, rnd_rows),
+        'sub_exposure': sub_exposure['sub_exposure'].values[sub_rows],
+        'method': np.array(methods, dtype=object)[sub_methods[sub_rows]]
+    })
+
+    # Parent exposure recovered from subsidiaries, by method, parent company and year
+    grouped = has_rnd | cases['exposure_by_year']
+
+    exposure_sums = sub_rnd_conso['sub_exposure'][grouped].groupby(
+        [sub_methods[sub_rows][grouped], sub_rnd_conso['bvd9'].values[grouped], years[grouped]], sort=False
+    ).transform('sum')
+
+    exposure_from_sub = np.full(len(sub_rnd_conso), np.nan, dtype=exposure_sums.dtype)
+    exposure_from_sub[grouped] = exposure_sums.values
+
+    sub_rnd_conso['parent_exposure_from_sub'] = exposure_from_sub
+
+    sub_rnd_conso['sub_rnd_clean'] = sub_rnd_conso['parent_rnd_clean'] * sub_rnd_conso['sub_exposure'] / \
+                                     sub_rnd_conso['parent_exposure_from_sub']
 
-        sub_rnd['sub_rnd_clean'] = sub_rnd['parent_rnd_clean'] * sub_rnd['sub_exposure'] / sub_rnd[
-            'parent_exposure_from_sub']
+    method_bounds = np.searchsorted(sub_methods[sub_rows], np.arange(len(methods) + 1))
 
-        sub_rnd['method'] = str(method)
+    for (index, method) in enumerate(cases['methods']):
+        sub_rnd = sub_rnd_conso.iloc[method_bounds[index]:method_bounds[index + 1]]
 
-        sub_rnd_conso = sub_rnd_conso.append(sub_rnd)
+        # Years are only reported as floats for methods with subsidiaries missing parent rnd, as computed on their own
+        report_years = sub_rnd['year']
+
+        if report_years.dtype != parent_rnd['year'].dtype and report_years.notna().all():
+            report_years = report_years.astype(parent_rnd['year'].dtype)
 
         report_sub_rnd.update(
             pd.DataFrame.to_dict(
-                sub_rnd[['year', 'sub_rnd_clean']].groupby(['year']).sum().rename(
-                    columns={'sub_rnd_clean': 'with_method: ' + str(method)})
+                pd.DataFrame({'year': report_years.values, 'sub_rnd_clean': sub_rnd['sub_rnd_clean'].values}).groupby(
+                    ['year']).sum().rename(columns={'sub_rnd_clean': 'with_method: ' + str(method)})
             )
         )
 
@@ -672,12 +1102,131 @@ def compute_sub_rnd(cases,
     # )
 
     # Save output tables
-    sub_rnd_conso.dropna(subset=['sub_rnd_clean']).to_csv(files['rnd_outputs']['subs']['rnd'],
-                                                          columns=sub_rnd_conso_cols,
-                                                          float_format='%.10f',
-                                                          index=False,
-                                                          na_rep='#N/A'
-                                                          )
+    if save:
+        load.write_table(sub_rnd_conso.dropna(subset=['sub_rnd_clean']),
+                         files['rnd_outputs']['subs']['rnd'],
+                         columns=sub_rnd_conso_cols,
+                         **files['output_options']
+                         )
+
+    return report_sub_rnd, sub_rnd_conso[sub_rnd_conso_cols]
+
+
+@perf.track
+def compute_sub_rnd_sparse(cases,
+                           files,
+                           range_ys,
+                           sub_exposure,
+                           parent_rnd,
+                           save=True):
+    """
+    Allocate parent level rnd to subsidiaries as the product of a sparse matrix of exposure shares with the dense array
+    of parent rnd by years
+    The share matrix of the subsidiaries of the parent companies of all methods is built once from subsidiary exposure
+    and applied to the rnd of all years in one product. Subsidiaries get a row for every year, rows of years without
+    parent rnd being left out of the output file and report
+    Dense arrays hold a single value per cell, so that tables with duplicated (method, bvd9, year) rows of parent rnd
+    or of subsidiary exposure by year are allocated by the join of compute_sub_rnd instead
+    :param sub_exposure: DataFrame of subsidiary exposure of all methods
+    :param parent_rnd: DataFrame of parent rnd by year of all methods
+    :param save: write the output tables (False to only return them)
+    :return: rnd report and subsidiary rnd of all methods, method after method
+    """
+    columns = stage_columns(cases, range_ys)['compute_sub_rnd']
+
+    sub_exposure = sub_exposure[columns['sub_exposure']]
+    parent_rnd = parent_rnd[columns['parent_rnd']]
+
+    duplicated = parent_rnd.duplicated(subset=['method', 'bvd9', 'year']).any()
+
+    if cases['exposure_by_year']:
+        duplicated |= sub_exposure.duplicated(subset=['method', 'sub_bvd9', 'bvd9', 'year']).any()
+
+    if duplicated:
+        print('... duplicated parent rnd or subsidiary exposure rows, fall back to the join allocation')
+
+        return compute_sub_rnd(dict(cases, sparse_allocation=False), files, range_ys, sub_exposure, parent_rnd,
+                               save)
+
+    print('Compute subsidiary level rnd with a sparse allocation matrix')
+
+    report_sub_rnd = {}
+
+    methods = [str(method) for method in cases['methods']]
+    years = arr.label_years(range_ys['rnd_ys'])
+
+    # Methods as integer keys, -1 for methods not computed
+    sub_methods = pd.Categorical(sub_exposure['method'], categories=methods).codes
+    rnd_methods = pd.Categorical(parent_rnd['method'], categories=methods).codes
+
+    # Subsidiaries method after method
+    sub_rows = np.argsort(sub_methods, kind='mergesort')
+    sub_rows = sub_rows[sub_methods[sub_rows] >= 0]
+
+    sub_exposure = sub_exposure.iloc[sub_rows]
+    sub_methods = sub_methods[sub_rows]
+
+    if cases['exposure_by_year']:
+        # One row per subsidiary of a parent company, with its exposure by year
+        edges = pd.DataFrame({'method': sub_methods,
+                              'sub_bvd9': sub_exposure['sub_bvd9'].values,
+                              'bvd9': sub_exposure['bvd9'].values}).groupby(['method', 'sub_bvd9', 'bvd9'],
+                                                                           sort=False).ngroup().values
+
+        edge_rows = np.unique(edges, return_index=True)[1]
+
+        exposures = np.full((len(edge_rows), len(years)), np.nan)
+        exposures[edges, np.searchsorted(years, sub_exposure['year'].values)] = sub_exposure['sub_exposure'].values
+    else:
+        edge_rows = np.arange(len(sub_exposure))
+
+        exposures = sub_exposure['sub_exposure'].values[:, None].astype('float64')
+
+    edge_methods = sub_methods[edge_rows]
+    edge_bvd9 = sub_exposure['bvd9'].values[edge_rows]
+
+    # Parent companies of each method as (method, bvd9) keys
+    (parent_keys, edge_parents) = np.unique((edge_methods.astype('int64') << 32) + edge_bvd9, return_inverse=True)
+
+    rnd = arr.dense_array((rnd_methods.astype('int64') << 32) + parent_rnd['bvd9'].values,
+                          parent_rnd['year'].values, parent_rnd['parent_rnd_clean'].values, parent_keys, years)
+
+    # Calculating subsidiary level rnd
+    shares = sps.share_matrix(edge_parents, exposures, len(parent_keys))
+
+    sub_rnd = sps.allocate(shares, rnd)
+
+    sub_rnd_conso = arr.long_table({
+        'sub_bvd9': sub_exposure['sub_bvd9'].values[edge_rows],
+        'bvd9': edge_bvd9,
+        'method': np.array(methods, dtype=object)[edge_methods]
+    }, years, {
+        'parent_rnd_clean': rnd[edge_parents],
+        'sub_exposure': np.broadcast_to(exposures, sub_rnd.shape),
+        'parent_exposure_from_sub': np.broadcast_to(shares['exposure_sums'], sub_rnd.shape),
+        'sub_rnd_clean': sub_rnd
+    }).dropna(subset=['sub_rnd_clean'])
+
+    for method in cases['methods']:
+        sub_rnd = sub_rnd_conso[sub_rnd_conso['method'] == str(method)]
+
+        report_sub_rnd.update(
+            pd.DataFrame.to_dict(
+                sub_rnd[['year', 'sub_rnd_clean']].groupby(['year']).sum().rename(
+                    columns={'sub_rnd_clean': 'with_method: ' + str(method)})
+            )
+        )
+
+    sub_rnd_conso_cols = ['sub_bvd9', 'bvd9', 'year', 'parent_rnd_clean', 'sub_exposure', 'parent_exposure_from_sub',
+                          'sub_rnd_clean', 'method']
+
+    # Save output tables
+    if save:
+        load.write_table(sub_rnd_conso,
+                         files['rnd_outputs']['subs']['rnd'],
+                         columns=sub_rnd_conso_cols,
+                         **files['output_options']
+                         )
 
     return report_sub_rnd, sub_rnd_conso[sub_rnd_conso_cols]
 
@@ -791,152 +1340,189 @@ def pprint_report(report,
             df = pd.DataFrame.from_dict(report['compute_rnd']['at_subsidiary_level'])
             file.write(tabulate(df, tablefmt='simple', headers=df.columns, floatfmt='10,.0f'))
 
+        if 'performance' in report:
+            file.write('*********************************************\n')
+            file.write('PERFORMANCE\n')
+            file.write('*********************************************\n\n')
 
-def merge_sub_rnd_w_parents(
-        sub_rnd,
-        parent_ids,
-        parent_guo_ids
-):
-    print('... merge with parent and guo data')
+            file.write('by stage\n\n')
 
-    # Get company and guo type data for subs
-    parent_ids_merged = pd.merge(
-        parent_ids,
-        parent_guo_ids,
-        left_on='guo_bvd9', right_on='guo_bvd9',
-        how='left',
-        suffixes=(False, False)
-    )
+            df = perf.performance_table(report['performance']['stages'])
+            file.write(tabulate(df, tablefmt='simple', headers=df.columns, floatfmt='10,.3f'))
+            file.write('\n\n')
 
-    # Get ultimate owner company type info for subs
-    sub_rnd_merged = pd.merge(
-        sub_rnd,
-        parent_ids_merged,
-        left_on='bvd9', right_on='bvd9',
-        how='left',
-        suffixes=(False, False)
-    )
+            file.write('by function\n\n')
 
-    return sub_rnd_merged
+            df = perf.performance_table(report['performance']['functions'])
+            file.write(tabulate(df, tablefmt='simple', headers=df.columns, floatfmt='10,.3f'))
 
 
-def merge_sub_rnd_w_countries(
-        sub_rnd,
+@perf.track
+def sub_rnd_dimensions(
+        files,
+        rnd_cluster_cats,
+        parent_ids,
+        parent_guo_ids,
         selected_sub_ids,
-        country_map
+        country_map,
+        selected_sub_fins
 ):
-    print('... merge with country data')
+    """
+    Build the dimension tables of the sub rnd fact table, the surrogate key of a dimension row being its position
+    Guo and country attributes are taken onto the parent and subsidiary dimensions, which stay small
+    :param files: dictionary of file paths parameters
+    :param rnd_cluster_cats: list of keyword cluster columns of selected_sub_fins
+    :param parent_ids: DataFrame of parent companies with bvd9, guo_bvd9 and is_listed_company
+    :param parent_guo_ids: DataFrame of global ultimate owners with guo_bvd9 and guo_type
+    :param selected_sub_ids: DataFrame of subsidiaries with sub_bvd9 and sub_country_2DID_iso
+    :param country_map: DataFrame of country codes and world players
+    :param selected_sub_fins: DataFrame of subsidiaries with sub_bvd9 and keyword cluster columns
+    :return: dictionary of parent, sub (country) and cluster dimension tables
+    """
+    print('... build parent, guo, country and cluster dimensions')
 
-    # Get country info for subs
-    sub_ids_w_country = pd.merge(
-        selected_sub_ids,
-        country_map[['country_2DID_iso', 'country_3DID_iso', 'world_player']],
-        left_on='sub_country_2DID_iso', right_on='country_2DID_iso',
-        how='left',
-        suffixes=(False, False)
-    ).drop(columns=['country_2DID_iso', 'sub_country_2DID_iso'])
+    guo = star.dimension(parent_guo_ids, 'guo_bvd9', ['guo_type'])
 
-    sub_ids_w_country.rename(
-        columns={'country_3DID_iso': 'sub_country_3DID_iso',
-                 'world_player': 'sub_world_player'}, inplace=True
-    )
+    # Parents are only flagged as listed when listed companies are among the company types of the case
+    if 'is_listed_company' not in parent_ids.columns:
+        parent_ids = parent_ids.assign(is_listed_company=False)
 
-    sub_rnd_merged = pd.merge(
-        sub_rnd,
-        sub_ids_w_country,
-        left_on='sub_bvd9', right_on='sub_bvd9',
-        how='left',
-        suffixes=(False, False)
-    )
+    parent = star.dimension(parent_ids, 'bvd9', ['is_listed_company', 'guo_bvd9'])
 
-    return sub_rnd_merged
+    parent['guo_type'] = star.take(guo, 'guo_type', star.surrogate_keys(guo, 'guo_bvd9', parent['guo_bvd9']))
 
+    # TODO: Upload VCS reference table
+    # Flag parents embedded in MNC
+    if Path(files['ref_tables']['mnc_ids']).exists():
+        mnc_bvd9 = pd.read_csv(
+            files['ref_tables']['mnc_ids'],
+            na_values='#N/A',
+            dtype=str
+        ).parent_bvd9
+    else:
+        print('... no MNC reference table at ' + str(files['ref_tables']['mnc_ids']) + ', no parent embedded in MNC')
 
-def merge_sub_rnd_w_clusters(
-        rnd_cluster_cats,
-        sub_rnd,
-        selected_sub_fins
-):
-    print('... merge with cluster data')
+        mnc_bvd9 = []
 
-    # Get keyword info for subs
-    sub_rnd_merged = pd.merge(
-        sub_rnd,
-        selected_sub_fins[['sub_bvd9', 'keyword_mask'] + rnd_cluster_cats],
-        left_on='sub_bvd9', right_on='sub_bvd9',
-        how='left',
-        suffixes=(False, False)
-    )
+    parent['is_embedded_in_MNC'] = load.decode_ids(parent[['bvd9']])['bvd9'].isin(mnc_bvd9)
 
-    # Compute a keyword based share for each cluster and apply to subs_rnd
-    sub_rnd_merged['keyword_mask'] = sub_rnd_merged[rnd_cluster_cats].sum(axis=1)
+    country = star.dimension(country_map, 'country_2DID_iso', ['country_3DID_iso', 'world_player'])
 
-    for category in rnd_cluster_cats:
-        sub_rnd_merged[category] = sub_rnd_merged['sub_rnd_clean'] * sub_rnd_merged[category] / sub_rnd_merged[
-            'keyword_mask']
+    sub = star.dimension(selected_sub_ids, 'sub_bvd9', ['sub_country_2DID_iso'])
 
-    sub_rnd_merged.drop(columns=['keyword_mask', 'sub_rnd_clean'], inplace=True)
+    sub_countries = star.surrogate_keys(country, 'country_2DID_iso', sub['sub_country_2DID_iso'])
 
-    return sub_rnd_merged
+    sub['sub_country_3DID_iso'] = star.take(country, 'country_3DID_iso', sub_countries)
+    sub['sub_world_player'] = star.take(country, 'world_player', sub_countries)
 
+    cluster = star.dimension(selected_sub_fins, 'sub_bvd9', rnd_cluster_cats)
 
+    cluster[rnd_cluster_cats] = cluster[rnd_cluster_cats].astype(float)
+
+    # Number of clusters of each subsidiary, over which its rnd is shared
+    cluster['keyword_mask'] = cluster[rnd_cluster_cats].sum(axis=1)
+
+    return {'parent': parent, 'sub': sub, 'cluster': cluster}
+
+
+@perf.track
 def melt_n_group_sub_rnd(
         cases,
         rnd_cluster_cats,
-        sub_rnd
+        sub_rnd,
+        dims
 ):
-    print('... melt and group sub_rnd')
+    """
+    Group sub rnd by year, country, world player, guo type, company type, cluster and method, as a groupby over the
+    sub rnd table merged with its dimensions and melted by cluster would, without materialising either table
+    Fact rows only hold the surrogate keys of their dimension rows and attributes are read as integer codes, so that
+    the cost of the grouping stays close to the size of the sub rnd table
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param rnd_cluster_cats: list of keyword cluster columns
+    :param sub_rnd: DataFrame of bvd9, sub_bvd9, year, method and sub_rnd_clean
+    :param dims: dictionary returned by sub_rnd_dimensions
+    :return: DataFrames of sub rnd grouped for all subsidiaries and for subsidiaries embedded in MNC
+    """
+    print('... group sub_rnd by dimension codes')
 
-    sub_rnd_melted = sub_rnd
+    parents = star.surrogate_keys(dims['parent'], 'bvd9', sub_rnd['bvd9'])
+    subs = star.surrogate_keys(dims['sub'], 'sub_bvd9', sub_rnd['sub_bvd9'])
+    clusters = star.surrogate_keys(dims['cluster'], 'sub_bvd9', sub_rnd['sub_bvd9'])
+
+    # Group at parent level
+    keys = {
+        'year': pd.factorize(sub_rnd['year'], sort=True),
+        'sub_country_3DID_iso': star.take_codes(dims['sub'], 'sub_country_3DID_iso', subs),
+        'sub_world_player': star.take_codes(dims['sub'], 'sub_world_player', subs),
+        'guo_type': star.take_codes(dims['parent'], 'guo_type', parents),
+        'is_listed_company': star.take_codes(dims['parent'], 'is_listed_company', parents),
+        'method': pd.factorize(sub_rnd['method'], sort=True)
+    }
 
-    # Get keyword info for subs
-    sub_rnd_melted = sub_rnd.melt(
-        id_vars=['bvd9', 'sub_bvd9', 'year', 'sub_country_3DID_iso', 'sub_world_player', 'guo_type',
-                 'is_listed_company', 'method'],
-        value_vars=rnd_cluster_cats,
-        var_name='cluster', value_name='sub_rnd_clean')
+    is_embedded = star.take(dims['parent'], 'is_embedded_in_MNC', parents) == True
 
-    # TODO: Upload VCS reference table
-    # Flag parents embedded in MNC
-    mnc_ids = pd.read_csv(
-        r'C:\Users\Simon\PycharmProjects\rnd-private\ref_tables\mnc_tracking_jrc004_to_newapp_20200420.csv',
-        na_values='#N/A',
-        dtype=str
-    )
+    rnd = sub_rnd['sub_rnd_clean'].values
 
-    sub_rnd_melted['is_embedded_in_MNC'] = sub_rnd_melted.bvd9.isin(mnc_ids.parent_bvd9)
+    keyword_mask = star.take(dims['cluster'], 'keyword_mask', clusters)
 
-    # Group at parent level
-    sub_rnd_grouped_cols = ['year', 'sub_country_3DID_iso', 'sub_world_player', 'guo_type', 'is_listed_company',
-                            'cluster', 'method']
+    # Group all subsidiaries for soeur_rnd benchmark and subsidiaries embedded in MNC in the same pass, keyword based
+    # share of sub_rnd of each cluster being computed one cluster at a time
+    with np.errstate(divide='ignore', invalid='ignore'):
+        totals = star.grouping_sets(
+            [codes for (codes, uniques) in keys.values()],
+            (rnd * star.take(dims['cluster'], category, clusters) / keyword_mask for category in rnd_cluster_cats),
+            is_embedded
+        )
+
+    approaches = np.array(['NewApp_rnd_2020_GLOBAL_20200419', 'NewApp_rnd_2020_GLOBAL_20200419_in_MNC'], dtype=object)
+
+    sums = np.column_stack(totals['sums']) if rnd_cluster_cats else np.zeros((len(totals['sets']), 0))
 
-    # sub_rnd_grouped_cols = ['year', 'sub_country_3DID_iso', 'sub_world_player', 'guo_type', 'is_listed_company',
-    #                         'method']
+    # Clusters sort as strings once melted
+    cluster_order = np.argsort(rnd_cluster_cats, kind='mergesort')
 
-    # for soeur_rnd benchmark
-    sub_rnd_grouped = sub_rnd_melted.groupby(sub_rnd_grouped_cols).sum()
+    # One row per group and cluster
+    group_rows = np.repeat(np.arange(len(totals['sets'])), len(rnd_cluster_cats))
+    cluster_rows = np.tile(cluster_order, len(totals['sets']))
+
+    group_codes = dict(zip(keys.keys(), totals['codes']))
+
+    # Rows ordered by approach, then by the keys with clusters ordered within groups of the keys before method
+    sort_codes = {
+        'approach': totals['sets'][group_rows],
+        **{col: group_codes[col][group_rows] for col in keys.keys() if col != 'method'},
+        'cluster': np.argsort(cluster_order)[cluster_rows],
+        'method': group_codes['method'][group_rows]
+    }
 
-    sub_rnd_grouped.reset_index(inplace=True)
+    order = np.lexsort([sort_codes[col] for col in reversed(list(sort_codes.keys()))])
 
-    sub_rnd_grouped['approach'] = 'NewApp_rnd_2020_GLOBAL_20200419'
+    (group_rows, cluster_rows) = (group_rows[order], cluster_rows[order])
 
-    sub_rnd_grouped['technology'] = sub_rnd_grouped['priority'] = sub_rnd_grouped['action'] = '#N/A'
+    table = pd.DataFrame({col: uniques.take(group_codes[col][group_rows]) for col, (codes, uniques) in keys.items()})
 
-    # estimating rnd embedded in MNC
-    embedded_sub_rnd_grouped = sub_rnd_melted[sub_rnd_melted.is_embedded_in_MNC == True].groupby(
-        sub_rnd_grouped_cols).sum()
+    table.insert(table.columns.get_loc('method'), 'cluster', np.array(rnd_cluster_cats, dtype=object)[cluster_rows])
 
-    embedded_sub_rnd_grouped.reset_index(inplace=True)
+    table['sub_rnd_clean'] = sums[group_rows, cluster_rows]
+    table['is_embedded_in_MNC'] = totals['flagged_n'][group_rows]
 
-    embedded_sub_rnd_grouped['approach'] = 'NewApp_rnd_2020_GLOBAL_20200419_in_MNC'
+    table['approach'] = approaches[totals['sets'][group_rows]]
 
-    embedded_sub_rnd_grouped['technology'] = embedded_sub_rnd_grouped['priority'] = embedded_sub_rnd_grouped['action'] = '#N/A'
+    table['technology'] = table['priority'] = table['action'] = '#N/A'
+
+    is_embedded_set = totals['sets'][group_rows] == 1
+
+    sub_rnd_grouped = table[~is_embedded_set].reset_index(drop=True)
+
+    embedded_sub_rnd_grouped = table[is_embedded_set].reset_index(drop=True)
 
     return sub_rnd_grouped, embedded_sub_rnd_grouped
 
 
+@perf.track
 def merge_n_group_sub_rnd(
         cases,
+        files,
         rnd_cluster_cats,
         sub_rnd,
         parent_ids,
@@ -946,43 +1532,104 @@ def merge_n_group_sub_rnd(
         selected_sub_fins
 ):
 
-    sub_rnd_merged_w_parents = merge_sub_rnd_w_parents(
-        sub_rnd,
+    dims = sub_rnd_dimensions(
+        files,
+        rnd_cluster_cats,
         parent_ids,
-        parent_guo_ids
+        parent_guo_ids,
+        selected_sub_ids,
+        country_map,
+        selected_sub_fins
     )
 
-    sub_rnd_merged_w_countries = merge_sub_rnd_w_countries(
-        sub_rnd_merged_w_parents,
-        selected_sub_ids,
-        country_map
+    (sub_rnd_grouped, embedded_sub_rnd_grouped) = melt_n_group_sub_rnd(
+        cases,
+        rnd_cluster_cats,
+        sub_rnd,
+        dims
     )
 
-    sub_rnd_merged_w_clusters = merge_sub_rnd_w_clusters(
+    # Company type keeps the is_listed_company flag, the listed and unlisted guo50 masks of the former merges being
+    # discarded
+    sub_rnd_grouped.rename(columns={'is_listed_company': 'type'}, inplace=True)
+
+    embedded_sub_rnd_grouped.rename(columns={'is_listed_company': 'type'}, inplace=True)
+
+    return sub_rnd_grouped, embedded_sub_rnd_grouped
+
+
+@perf.track
+def build_rnd_cube(
+        cases,
+        files,
         rnd_cluster_cats,
-        sub_rnd_merged_w_countries,
+        sub_rnd,
+        parent_ids,
+        parent_guo_ids,
+        selected_sub_ids,
+        country_map,
         selected_sub_fins
-    )
+):
+    """
+    Aggregate sub rnd estimates once into a cube by approach, year, country, world player, guo type, company type
+    (listed or unlisted guo50), cluster and method, and save it with the case so that breakdowns are queried from the
+    cube (see rnd_cube.query)
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param files: dictionary of file paths parameters
+    :param rnd_cluster_cats: list of keyword cluster columns of selected_sub_fins
+    :param sub_rnd: DataFrame of bvd9, sub_bvd9, year, method and sub_rnd_clean
+    :param parent_ids: DataFrame of parent companies with bvd9, guo_bvd9 and is_listed_company
+    :param parent_guo_ids: DataFrame of global ultimate owners with guo_bvd9 and guo_type
+    :param selected_sub_ids: DataFrame of subsidiaries with sub_bvd9 and sub_country_2DID_iso
+    :param country_map: DataFrame of country codes and world players
+    :param selected_sub_fins: DataFrame of subsidiaries with sub_bvd9 and keyword cluster columns
+    :return: DataFrame of the rnd cube
+    """
+    # Subsidiaries without rnd are left out, as in the saved sub rnd, so that the cube is the same whether sub rnd was
+    # just computed, spliced in an incremental run or read back
+    sub_rnd = sub_rnd.dropna(subset=['sub_rnd_clean'])
 
-    (sub_rnd_grouped, embedded_sub_rnd_grouped) = melt_n_group_sub_rnd(
+    (sub_rnd_grouped, embedded_sub_rnd_grouped) = merge_n_group_sub_rnd(
         cases,
+        files,
         rnd_cluster_cats,
-        sub_rnd_merged_w_clusters
+        sub_rnd,
+        parent_ids,
+        parent_guo_ids,
+        selected_sub_ids,
+        country_map,
+        selected_sub_fins
     )
 
-    sub_rnd_grouped.mask(sub_rnd_grouped['is_listed_company'] == True, 'listed')
-    sub_rnd_grouped.mask(sub_rnd_grouped['is_listed_company'] == False, 'unlisted guo50')
+    # Company types are only labelled in the cube, grouped sub rnd keeping the is_listed_company flag
+    company_types = {True: 'listed', False: 'unlisted guo50'}
 
-    sub_rnd_grouped.rename(columns={'is_listed_company': 'type'}, inplace=True)
+    for grouped in [sub_rnd_grouped, embedded_sub_rnd_grouped]:
+        grouped['type'] = grouped['type'].map(company_types)
 
-    embedded_sub_rnd_grouped.mask(embedded_sub_rnd_grouped['is_listed_company'] == True, 'listed')
-    embedded_sub_rnd_grouped.mask(embedded_sub_rnd_grouped['is_listed_company'] == False, 'unlisted guo50')
+    print('... build rnd cube')
 
-    embedded_sub_rnd_grouped.rename(columns={'is_listed_company': 'type'}, inplace=True)
+    rnd_cube = cube.build_cube([sub_rnd_grouped, embedded_sub_rnd_grouped])
 
-    return sub_rnd_grouped, embedded_sub_rnd_grouped
+    print('... save rnd cube')
+
+    load.write_table(rnd_cube, files['cube'], **files['output_options'])
+
+    return rnd_cube
+
+
+def load_rnd_cube(files):
+    """
+    Read the rnd cube saved with the case
+    :param files: dictionary of file paths parameters
+    :return: DataFrame of the rnd cube
+    """
+    (rnd_cube, memory) = load.read_table(files['cube'])
+
+    return cube.categorize(rnd_cube)
 
 
+@perf.track
 def load_n_group_soeur_rnd(
         cases,
         files
@@ -1000,33 +1647,43 @@ def load_n_group_soeur_rnd(
 
     print('... and group')
 
-    # Group all soeur scope
-    soeur_rnd_grouped = soeur_rnd.groupby(['year', 'sub_country_3DID_iso', 'sub_world_player']).sum()
+    # Group all soeur scope and soeur embedded in MNC scope in the same pass
+    keys = {
+        col: pd.factorize(soeur_rnd[col], sort=True) for col in ['year', 'sub_country_3DID_iso', 'sub_world_player']
+    }
+
+    measures = [col for col in soeur_rnd.select_dtypes(include=['number', 'bool']).columns if col not in keys]
 
-    soeur_rnd_grouped.reset_index(inplace=True)
+    totals = star.grouping_sets(
+        [codes for (codes, uniques) in keys.values()],
+        (soeur_rnd[col].values for col in measures),
+        soeur_rnd['is_embedded_in_MNC'] == True
+    )
 
-    soeur_rnd_grouped['approach'] = 'SOEUR_rnd_2019b_20200309'
+    soeur_rnd_grouped = pd.DataFrame({col: uniques.take(totals['codes'][index])
+                                      for index, (col, (codes, uniques)) in enumerate(keys.items())})
 
-    soeur_rnd_grouped['method'] = '#N/A'
+    for (col, sums) in zip(measures, totals['sums']):
+        # Counts and flags sum up as integers
+        soeur_rnd_grouped[col] = sums if is_float_dtype(soeur_rnd[col]) else sums.astype('int64')
 
-    soeur_rnd_grouped['type'] = soeur_rnd_grouped['cluster'] = soeur_rnd_grouped['guo_type'] = '#N/A'
+    soeur_rnd_grouped['approach'] = np.array(['SOEUR_rnd_2019b_20200309', 'SOEUR_rnd_2019b_20200309_in_MNC'],
+                                             dtype=object)[totals['sets']]
 
-    # Group soeur embedded in MNC scope
-    embedded_soeur_rnd_grouped = soeur_rnd[soeur_rnd.is_embedded_in_MNC == True].groupby(
-        ['year', 'sub_country_3DID_iso', 'sub_world_player']).sum()
+    soeur_rnd_grouped['method'] = '#N/A'
 
-    embedded_soeur_rnd_grouped.reset_index(inplace=True)
+    soeur_rnd_grouped['type'] = soeur_rnd_grouped['cluster'] = soeur_rnd_grouped['guo_type'] = '#N/A'
 
-    embedded_soeur_rnd_grouped['approach'] = 'SOEUR_rnd_2019b_20200309_in_MNC'
+    is_embedded_set = totals['sets'] == 1
 
-    embedded_soeur_rnd_grouped['method'] = '#N/A'
+    embedded_soeur_rnd_grouped = soeur_rnd_grouped[is_embedded_set].reset_index(drop=True)
 
-    embedded_soeur_rnd_grouped['type'] = embedded_soeur_rnd_grouped['cluster'] = embedded_soeur_rnd_grouped[
-        'guo_type'] = '#N/A'
+    soeur_rnd_grouped = soeur_rnd_grouped[~is_embedded_set].reset_index(drop=True)
 
     return (soeur_rnd_grouped, embedded_soeur_rnd_grouped)
 
 
+@perf.track
 def load_n_group_MNC_rnd(
         cases,
         files
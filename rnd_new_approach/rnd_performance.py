@@ -0,0 +1,213 @@
+# Import libraries
+import functools
+import inspect
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak memory is read with psutil if installed
+    resource = None
+
+# Operational metrics of the current run, saved in the performance section of report.json
+PERFORMANCE = {'stages': {}, 'functions': {}}
+
+# Running peaks of traced memory of open measurements, innermost last
+OPEN_PEAKS = []
+
+# Measurement of the current stage of rnd_main, with the row counts of the tracked functions it calls
+CURRENT_STAGE = {'name': None, 'start': None, 'rows_in': {}, 'rows_out': {}}
+
+# Number of tracked functions running, so that only the outermost calls count for the row counts of a stage
+TRACK_DEPTH = [0]
+
+
+def init_performance(trace_memory=False):
+    """
+    Reset operational metrics for a new run
+    :param trace_memory: trace python memory allocations with tracemalloc to report the peak of each measurement
+    (slows down the run)
+    :return: dictionary of operational metrics, updated as stages and functions run
+    """
+    PERFORMANCE['stages'] = {}
+    PERFORMANCE['functions'] = {}
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    return PERFORMANCE
+
+
+def process_peak_rss_mb():
+    """
+    Read the peak resident memory of the process since it started, which is not reset between measurements
+    :return: peak resident memory in MB, None if it cannot be read on this platform
+    """
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return round(peak / 2 ** (20 if sys.platform == 'darwin' else 10), 3)
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+
+    return round(psutil.Process().memory_info().peak_wset / 2 ** 20, 3)
+
+
+def start_measure():
+    """
+    Start measuring wall time, CPU time and traced memory of a block of code
+    :return: dictionary of starting counters to pass to stop_measure
+    """
+    if tracemalloc.is_tracing():
+        if OPEN_PEAKS:
+            OPEN_PEAKS[-1] = max(OPEN_PEAKS[-1], tracemalloc.get_traced_memory()[1])
+
+        # Peaks can only be reset from python 3.9, before that they run from the start of tracing
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+        OPEN_PEAKS.append(0)
+
+    return {'wall': time.perf_counter(), 'cpu': time.process_time()}
+
+
+def stop_measure(start):
+    """
+    Stop measuring a block of code
+    CPU time is the one of the main process, worker processes parsing input files are not included
+    :param start: dictionary returned by start_measure
+    :return: dictionary of wall time and CPU time in seconds, of the peak of traced memory during the measurement and
+    of the peak resident memory of the process so far in MB
+    """
+    metrics = {
+        'wall_s': round(time.perf_counter() - start['wall'], 3),
+        'cpu_s': round(time.process_time() - start['cpu'], 3),
+        'peak_traced_MB': None,
+        'process_peak_rss_MB': process_peak_rss_mb()
+    }
+
+    if tracemalloc.is_tracing() and OPEN_PEAKS:
+        peak = max(OPEN_PEAKS.pop(), tracemalloc.get_traced_memory()[1])
+
+        if OPEN_PEAKS:
+            OPEN_PEAKS[-1] = max(OPEN_PEAKS[-1], peak)
+
+        # Without peak reset, the peak of traced memory is the one since tracing started and is not reported
+        if hasattr(tracemalloc, 'reset_peak'):
+            metrics['peak_traced_MB'] = round(peak / 2 ** 20, 3)
+
+    return metrics
+
+
+def start_stage(name):
+    """
+    Close the current stage of rnd_main and start measuring the next one
+    :param name: name of the stage
+    :return: Nothing
+    """
+    end_stage()
+
+    CURRENT_STAGE['name'] = name
+    CURRENT_STAGE['start'] = start_measure()
+    CURRENT_STAGE['rows_in'] = {}
+    CURRENT_STAGE['rows_out'] = {}
+
+
+def end_stage():
+    """
+    Close the current stage of rnd_main and record its metrics
+    :return: Nothing
+    """
+    if CURRENT_STAGE['name'] is None:
+        return
+
+    PERFORMANCE['stages'][CURRENT_STAGE['name']] = {
+        **stop_measure(CURRENT_STAGE['start']),
+        'rows_in': CURRENT_STAGE['rows_in'],
+        'rows_out': CURRENT_STAGE['rows_out']
+    }
+
+    CURRENT_STAGE['name'] = None
+    CURRENT_STAGE['start'] = None
+
+
+def track(function):
+    """
+    Decorate a function to record its wall time, CPU time, peak memory and the row counts of the DataFrames it takes
+    and returns
+    Repeated calls add up times and keep the highest peaks and the row counts of the last call. Row counts of calls
+    that are not made from another tracked function also count for the current stage, by function and argument
+    :param function: function to track
+    :return: decorated function
+    """
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        arguments = signature.bind_partial(*args, **kwargs).arguments
+
+        rows_in = {name: len(value) for name, value in arguments.items() if isinstance(value, pd.DataFrame)}
+
+        start = start_measure()
+
+        TRACK_DEPTH[0] += 1
+
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            TRACK_DEPTH[0] -= 1
+
+        metrics = stop_measure(start)
+
+        outputs = result if isinstance(result, tuple) else (result,)
+
+        rows_out = [len(output) for output in outputs if isinstance(output, (pd.DataFrame, pd.Series))]
+
+        record = PERFORMANCE['functions'].setdefault(function.__name__, {'calls': 0, 'wall_s': 0, 'cpu_s': 0})
+
+        record['calls'] += 1
+        record['wall_s'] = round(record['wall_s'] + metrics['wall_s'], 3)
+        record['cpu_s'] = round(record['cpu_s'] + metrics['cpu_s'], 3)
+
+        for peak in ['peak_traced_MB', 'process_peak_rss_MB']:
+            record[peak] = max(filter(None, [record.get(peak), metrics[peak]]), default=None)
+
+        record['rows_in'] = rows_in
+        record['rows_out'] = rows_out
+
+        if CURRENT_STAGE['name'] is not None and TRACK_DEPTH[0] == 0:
+            CURRENT_STAGE['rows_in'].update({function.__name__ + '.' + name: n for name, n in rows_in.items()})
+            CURRENT_STAGE['rows_out'].update({
+                function.__name__ + ('[' + str(index) + ']' if len(rows_out) > 1 else ''): n
+                for index, n in enumerate(rows_out)
+            })
+
+        return result
+
+    return wrapper
+
+
+def performance_table(records):
+    """
+    Tabulate stage or function metrics for the readable report
+    :param records: dictionary of names to metrics
+    :return: DataFrame with a row per stage or function
+    """
+    df = pd.DataFrame.from_dict(records, orient='index')
+
+    for col in ['rows_in', 'rows_out']:
+        if col in df.columns:
+            df[col] = df[col].apply(
+                lambda rows: ', '.join(name + '=' + str(n) for name, n in rows.items()) if isinstance(rows, dict)
+                else ', '.join(str(n) for n in rows)
+            )
+
+    return df
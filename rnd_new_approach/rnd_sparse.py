@@ -0,0 +1,50 @@
+# Import libraries
+import numpy as np
+from scipy import sparse
+
+
+def share_matrix(parents,
+                 exposures,
+                 parent_n):
+    """
+    Build the sparse matrix of the shares of parent rnd allocated to subsidiaries
+    A subsidiary receives the share of its exposure in the exposure summed over all subsidiaries of its parent company,
+    missing exposures counting as zero in the sum as in a grouped sum. When exposure is by year, rows and columns are
+    (subsidiary, year) and (parent company, year) cells, so that the shares of all years apply in the same product
+    :param parents: int array of the parent company position of each subsidiary
+    :param exposures: float array of subsidiaries by years of exposure, with a single column when exposure is not by
+    year
+    :param parent_n: number of parent companies
+    :return: dictionary with the CSR matrix of shares, the number of subsidiaries and of exposure years, and the parent
+    exposure summed over subsidiaries as a float array of subsidiaries by exposure years
+    """
+    (sub_n, year_n) = exposures.shape
+
+    rows = np.arange(sub_n * year_n)
+    cols = np.repeat(np.asarray(parents, dtype='int64'), year_n) * year_n + np.tile(np.arange(year_n), sub_n)
+
+    values = exposures.reshape(-1)
+
+    sums = np.bincount(cols, weights=np.nan_to_num(values), minlength=parent_n * year_n)[cols]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = values / sums
+
+    # Zero and missing shares are stored so that missing parent rnd stays missing for every subsidiary
+    matrix = sparse.csr_matrix((shares, (rows, cols)), shape=(sub_n * year_n, parent_n * year_n))
+
+    return {'matrix': matrix, 'sub_n': sub_n, 'year_n': year_n, 'exposure_sums': sums.reshape(sub_n, year_n)}
+
+
+def allocate(shares,
+             parent_rnd):
+    """
+    Allocate parent rnd to subsidiaries in a single sparse-dense product
+    :param shares: dictionary returned by share_matrix
+    :param parent_rnd: float array of parent companies by years of rnd
+    :return: float array of subsidiaries by years of allocated rnd
+    """
+    # Parent rnd as one column per year, or as a single column of (parent company, year) cells when exposure is by year
+    cells = parent_rnd.reshape(shares['matrix'].shape[1], parent_rnd.shape[1] // shares['year_n'])
+
+    return (shares['matrix'] @ cells).reshape(shares['sub_n'], parent_rnd.shape[1])
@@ -0,0 +1,252 @@
+# Import libraries
+import datetime
+import hashlib
+import json
+
+from rnd_new_approach import rnd_methods as mtd
+from rnd_new_approach import rnd_incremental as inc
+from data_input import file_loader as load
+
+# Packages and modules of this repository whose functions and constants are fingerprinted when a stage runs them
+CODE_PACKAGES = ['rnd_new_approach', 'data_input', 'config']
+
+
+def stage_graph(cases,
+                files,
+                range_ys,
+                keywords):
+    """
+    Declare the stages of rnd_main with what their outputs depend on
+    upstream: stages whose outputs are read by the stage
+    config: keys of cases used by the stage
+    params: other parameters used by the stage
+    sources: folder of the input files read by the stage
+    code: functions called by the stage, fingerprinted with the helpers of this repository they run (see
+    file_loader.code_sources)
+    outputs: files written by the stage
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param files: dictionary of file paths parameters
+    :param range_ys: dictionary of year ranges for financials
+    :param keywords: dictionary of keywords for activity screening
+    :return: dictionary of stage names to stage definitions, in execution order
+    """
+    input_path = cases['case_root'].joinpath(r'input')
+    parents = files['rnd_outputs']['parents']
+    subs = files['rnd_outputs']['subs']
+    mnc_ids = files['ref_tables']['mnc_ids']
+
+    return {
+        'select_parents': {
+            'upstream': [],
+            'config': ['company_types', 'parent_id_files_n'],
+            'params': {},
+            'sources': input_path.joinpath(r'parent_ids'),
+            'code': [mtd.load_parent_ids],
+            'outputs': [parents['id'], parents['guo']]
+        },
+        'load_parent_fins': {
+            'upstream': [],
+            'config': ['parent_fin_files_n', 'rnd_limit', 'float32'],
+            'params': {'range_ys': range_ys},
+            'sources': input_path.joinpath(r'parent_fins'),
+            'code': [mtd.load_parent_fins, mtd.select_parent_ids_with_rnd],
+            'outputs': [parents['fin'], parents['bvd9_short']]
+        },
+        'load_sub_ids': {
+            'upstream': ['select_parents', 'load_parent_fins'],
+            'config': ['sub_id_files_n', 'methods'],
+            'params': {},
+            'sources': input_path.joinpath(r'sub_ids'),
+            'code': [mtd.load_sub_ids, mtd.screen_sub_ids_for_method],
+            'outputs': [subs['id'], subs['bvd9_full'], subs['bvd9_short']]
+        },
+        'load_sub_fins': {
+            # Subsidiary financials depend on the selected subsidiaries when they are filtered while loading
+            'upstream': ['load_sub_ids'] if cases['select_sub_fins'] else [],
+            'config': ['sub_fin_files_n', 'select_sub_fins', 'float32'],
+            'params': {'range_ys': range_ys},
+            'sources': input_path.joinpath(r'sub_fins'),
+            'code': [mtd.load_sub_fins],
+            'outputs': [subs['fin']]
+        },
+        'screen_sub_fins': {
+            'upstream': ['load_sub_fins'],
+            'config': [],
+            'params': {'keywords': keywords},
+            'sources': None,
+            'code': [mtd.screen_sub_fins_for_keywords],
+            'outputs': [subs['fin']]
+        },
+        'compute_exposure': {
+            'upstream': ['load_sub_ids', 'screen_sub_fins'],
+            'config': ['methods', 'select_sub_fins', 'exposure_by_year', 'previous_case_root'],
+            'params': {},
+            'sources': None,
+            'code': [mtd.compute_exposure, inc.diff_vintages, inc.compute_exposure],
+            'outputs': [parents['expo'], subs['expo']]
+        },
+        'compute_parent_rnd': {
+            'upstream': ['load_parent_fins', 'compute_exposure'],
+            'config': ['methods', 'exposure_by_year', 'previous_case_root'],
+            'params': {},
+            'sources': None,
+            'code': [mtd.compute_parent_rnd, inc.compute_parent_rnd],
+            'outputs': [parents['rnd']]
+        },
+        'compute_sub_rnd': {
+            'upstream': ['compute_exposure', 'compute_parent_rnd'],
+            'config': ['methods', 'exposure_by_year', 'sparse_allocation', 'previous_case_root'],
+            'params': {},
+            'sources': None,
+            'code': [mtd.compute_sub_rnd, inc.compute_sub_rnd],
+            'outputs': [subs['rnd']]
+        },
+        'build_rnd_cube': {
+            'upstream': ['select_parents', 'load_sub_ids', 'screen_sub_fins', 'compute_sub_rnd'],
+            'config': [],
+            'params': {'mnc_ids': load.file_digest(mnc_ids) if mnc_ids.exists() else None},
+            'sources': None,
+            'code': [mtd.build_rnd_cube],
+            'outputs': [files['cube']]
+        }
+    }
+
+
+def source_digests(source_path,
+                   record):
+    """
+    Hash the input files of a folder, reusing the digest recorded at the previous run for files whose size and
+    modification time did not change
+    :param source_path: folder of input files
+    :param record: dictionary of file paths to their size, modification time and digest, updated in place
+    :return: dictionary of file names to digests
+    """
+    digests = {}
+
+    if source_path is None or not source_path.exists():
+        return digests
+
+    for file_path in sorted(source_path.glob('*.xlsx')):
+        stat = file_path.stat()
+        known = record.get(str(file_path), {})
+
+        if known.get('size') != stat.st_size or known.get('mtime') != stat.st_mtime_ns:
+            print('... hash ' + file_path.name)
+
+            known = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': load.file_digest(file_path)}
+
+            record[str(file_path)] = known
+
+        digests[file_path.name] = known['digest']
+
+    return digests
+
+
+def fingerprint_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def init_stages(cases,
+                files,
+                range_ys,
+                keywords):
+    """
+    Fingerprint every stage of rnd_main and compare with the fingerprints recorded when they last ran
+    A stage fingerprint covers its configuration values, parameters, source files, code and the fingerprints of its
+    upstream stages, so that a change anywhere upstream invalidates all downstream stages and nothing else
+    :param cases: dictionary of configuration parameters for the considered use case
+    :param files: dictionary of file paths parameters
+    :param range_ys: dictionary of year ranges for financials
+    :param keywords: dictionary of keywords for activity screening
+    :return: dictionary holding the stage graph, the current fingerprints and the record of previous runs
+    """
+    print('Fingerprint pipeline stages ...')
+
+    record_path = cases['case_root'].joinpath(r'stages.json')
+
+    record = {'stages': {}, 'sources': {}}
+
+    if record_path.exists():
+        with open(record_path, 'r') as file:
+            record = json.load(file)
+
+    graph = stage_graph(cases, files, range_ys, keywords)
+
+    fingerprints = {}
+
+    for name, stage in graph.items():
+        fingerprints[name] = {
+            'config': fingerprint_hash({key: str(cases[key]) for key in stage['config']}),
+            'params': fingerprint_hash(stage['params']),
+            'sources': fingerprint_hash(source_digests(stage['sources'], record['sources'])),
+            'code': fingerprint_hash(load.code_sources(stage['code'], CODE_PACKAGES)),
+            'upstream': fingerprint_hash({upstream: fingerprints[upstream]['key'] for upstream in stage['upstream']})
+        }
+
+        fingerprints[name]['key'] = fingerprint_hash(fingerprints[name])
+
+    stages = {'record_path': record_path, 'record': record, 'graph': graph, 'fingerprints': fingerprints, 'ran': []}
+
+    for name in graph.keys():
+        reasons = stale_reasons(stages, name)
+
+        print('... ' + name + ': ' + ('stale (' + ', '.join(reasons) + ')' if reasons else 'up to date'))
+
+    return stages
+
+
+def stale_reasons(stages,
+                  name):
+    """
+    List why a stage has to run
+    :param stages: dictionary returned by init_stages
+    :param name: name of the stage
+    :return: list of reasons, empty if the stage is up to date
+    """
+    recorded = stages['record']['stages'].get(name)
+
+    if recorded is None:
+        return ['never run']
+
+    reasons = [part for part, value in stages['fingerprints'][name].items()
+               if part != 'key' and recorded['fingerprint'].get(part) != value]
+
+    if not all(output.exists() for output in stages['graph'][name]['outputs']):
+        reasons.append('missing outputs')
+
+    # Outputs of upstream stages that ran in this run may be pending in the background writer or may overwrite a
+    # shared output file, so that downstream stages have to run on the tables handed over in memory
+    if any(upstream in stages['ran'] for upstream in stages['graph'][name]['upstream']):
+        reasons.append('upstream ran')
+
+    return reasons
+
+
+def is_stale(stages,
+             name):
+    """
+    Check whether a stage has to run
+    :param stages: dictionary returned by init_stages
+    :param name: name of the stage
+    :return: True if the fingerprint of the stage changed since it last ran or if its outputs are missing
+    """
+    return bool(stale_reasons(stages, name))
+
+
+def mark_done(stages,
+              name):
+    """
+    Record the fingerprint of a stage that has just run
+    :param stages: dictionary returned by init_stages
+    :param name: name of the stage
+    :return: Nothing
+    """
+    stages['ran'].append(name)
+
+    stages['record']['stages'][name] = {
+        'Datetime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'fingerprint': stages['fingerprints'][name]
+    }
+
+    with open(stages['record_path'], 'w') as file:
+        json.dump(stages['record'], file, indent=4)
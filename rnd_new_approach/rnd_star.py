@@ -0,0 +1,122 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+
+def dimension(df,
+              key,
+              cols):
+    """
+    Build a compact dimension table with one row per natural key, the surrogate key of a row being its position
+    :param df: DataFrame holding the natural key and the attributes
+    :param key: natural key column (e.g. bvd9)
+    :param cols: list of attribute columns
+    :return: DataFrame of the natural key and attributes, first row of duplicated keys kept
+    """
+    return df[[key] + cols].dropna(subset=[key]).drop_duplicates(subset=key, keep='first').reset_index(drop=True)
+
+
+def surrogate_keys(dim,
+                   key,
+                   values):
+    """
+    Look up the surrogate keys of natural keys
+    :param dim: dimension table
+    :param key: natural key column of the dimension table
+    :param values: list-like of natural keys
+    :return: int array of surrogate keys, -1 for keys missing from the dimension table
+    """
+    return pd.Index(dim[key]).get_indexer(values)
+
+
+def take(dim,
+         col,
+         surrogates):
+    """
+    Fetch an attribute of a dimension table by position
+    :param dim: dimension table
+    :param col: attribute column
+    :param surrogates: int array of surrogate keys, -1 for missing rows
+    :return: array of attribute values, missing values for missing rows
+    """
+    return pd.api.extensions.take(dim[col].values, surrogates, allow_fill=True)
+
+
+def take_codes(dim,
+               col,
+               surrogates):
+    """
+    Fetch an attribute of a dimension table by position as integer codes, so that fact rows never hold the values
+    :param dim: dimension table
+    :param col: attribute column
+    :param surrogates: int array of surrogate keys, -1 for missing rows
+    :return: int array of codes, -1 for missing rows or missing values, and array of values by code in sorted order
+    """
+    (codes, uniques) = pd.factorize(dim[col], sort=True)
+
+    return np.where(surrogates >= 0, codes[np.maximum(surrogates, 0)], -1), uniques
+
+
+def group_keys(codes):
+    """
+    Number the combinations of key codes of fact rows, as a sorted groupby over the decoded keys would
+    :param codes: list of int arrays of key codes, -1 for missing values
+    :return: int array of the group of each row, -1 for rows with a missing key, and list of int arrays of the key codes
+    of each group
+    """
+    known = np.logical_and.reduce([code >= 0 for code in codes])
+
+    sizes = [int(code.max()) + 1 if known.any() else 1 for code in codes]
+
+    (cells, groups) = np.unique(np.ravel_multi_index([code[known] for code in codes], sizes), return_inverse=True)
+
+    rows = np.full(len(known), -1, dtype='int64')
+    rows[known] = groups
+
+    return rows, list(np.unravel_index(cells, sizes))
+
+
+def grouping_sets(codes,
+                  values,
+                  flags):
+    """
+    Sum values by combination of key codes over all rows and over flagged rows at once, as a grouping sets query with
+    the set as an extra key, so that keys are grouped in a single pass instead of once per set over a filtered copy
+    :param codes: list of int arrays of key codes, -1 for missing values
+    :param values: iterable of float arrays of values to sum, e.g. a generator so that a single array is held at once
+    :param flags: boolean array of the flagged rows (e.g. subsidiaries embedded in MNC)
+    :return: dictionary with the set of each output group (0 for all rows, 1 for flagged rows), the list of int arrays
+    of the key codes of each output group, the list of float arrays of sums and the number of flagged rows of each
+    output group
+    """
+    (groups, group_codes) = group_keys(codes)
+
+    group_n = len(group_codes[0])
+
+    known = groups >= 0
+
+    (groups, flags) = (groups[known], np.asarray(flags, dtype=bool)[known])
+
+    flagged_n = np.bincount(groups, weights=flags, minlength=group_n)
+
+    # Groups of the flagged set are the groups with flagged rows
+    flagged_groups = np.flatnonzero(flagged_n > 0)
+
+    rows = np.concatenate([np.arange(group_n), flagged_groups])
+
+    sums = []
+
+    for value in values:
+        value = np.nan_to_num(np.asarray(value, dtype=float)[known])
+
+        all_sums = np.bincount(groups, weights=value, minlength=group_n)
+        flagged_sums = np.bincount(groups, weights=np.where(flags, value, 0), minlength=group_n)
+
+        sums.append(np.concatenate([all_sums, flagged_sums[flagged_groups]]))
+
+    return {
+        'sets': np.repeat([0, 1], [group_n, len(flagged_groups)]),
+        'codes': [code[rows] for code in group_codes],
+        'sums': sums,
+        'flagged_n': flagged_n[rows].astype('int64')
+    }
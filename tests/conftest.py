@@ -0,0 +1,22 @@
+# Import libraries
+import sys
+from pathlib import Path
+
+import pytest
+
+# Run tests against the modules of the repository, as rnd_main does
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from data_input import file_loader as load
+
+
+@pytest.fixture
+def entities(tmp_path):
+    """
+    Start an empty entity registry for the test, so that keys do not depend on the tests run before
+    """
+    load.init_entities(tmp_path.joinpath('entities.csv'))
+
+    yield
+
+    load.flush_tables()
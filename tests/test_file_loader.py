@@ -0,0 +1,222 @@
+# Import libraries
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_input import file_loader as load
+
+RANGE_YS = {'rnd_ys': ['rnd_y17', 'rnd_y18'], 'oprev_ys': ['op_revenue_y17', 'op_revenue_y18'], 'LY': '18'}
+
+# Columns of a parent financials export, as named by parent_fins_from_xls
+FIN_NAMES = ['rank', 'company_name', 'bvd9', 'Emp_number_y18', 'sales_y18', 'rnd_y18', 'rnd_y17', 'op_revenue_y18',
+             'op_revenue_y17']
+
+
+def read_csv_export(file_path,
+                    columns=None):
+    """
+    Parse a csv export, as the parsing functions of file_loader parse the Results sheet of an ORBIS export
+    """
+    return pd.read_csv(file_path, usecols=columns, dtype={'bvd9': str})
+
+
+def csv_export(tmp_path):
+    rng = np.random.default_rng(2)
+
+    export = pd.DataFrame({
+        'bvd9': ['%09d' % i for i in range(300)],
+        'country_2DID_iso': rng.choice(['FR', 'DE', 'US', 'CN'], 300),
+        'op_revenue_y18': rng.random(300) * 1e3
+    })
+
+    file_path = tmp_path.joinpath('export.csv')
+
+    export.to_csv(file_path, index=False)
+
+    return file_path
+
+
+def test_cache_hit_filters_on_unselected_columns(tmp_path):
+    file_path = csv_export(tmp_path)
+
+    columns = ['bvd9', 'op_revenue_y18']
+    isin = {'country_2DID_iso': ['FR', 'DE']}
+
+    reference = load.select_xls_to_df(read_csv_export, file_path, columns=columns, isin=isin)
+
+    miss = load.cached_xls_to_df(read_csv_export, file_path, tmp_path.joinpath('cache'), columns=columns, isin=isin)
+
+    # Second read comes from the cached file, which holds the full export
+    hit = load.cached_xls_to_df(read_csv_export, file_path, tmp_path.joinpath('cache'), columns=columns, isin=isin)
+
+    assert len(list(tmp_path.joinpath('cache').glob('*.feather'))) == 1
+
+    pd.testing.assert_frame_equal(miss, reference)
+    pd.testing.assert_frame_equal(hit.reset_index(drop=True), reference.reset_index(drop=True))
+
+
+def test_loader_schema_covers_helpers():
+    schema = load.loader_schema(partial(load.parent_ids_from_xls))
+
+    assert 'def parent_ids_from_xls' in schema
+    assert 'def read_results_sheet' in schema
+
+
+@pytest.fixture
+def parent_fin_exports(tmp_path):
+    """
+    Three ORBIS exports of parent financials, with missing values written as n.a.
+    """
+    rng = np.random.default_rng(1)
+
+    for number in range(1, 4):
+        export = pd.DataFrame({'rank': range(1, 51), 'company_name': ['company ' + str(i) for i in range(50)],
+                               'bvd9': ['%09d' % (number * 1000 + i) for i in range(50)]})
+
+        for col in FIN_NAMES[3:]:
+            export[col] = pd.Series(np.round(rng.random(50) * 1e3, 3), dtype=object).mask(rng.random(50) < .2, 'n.a.')
+
+        export.columns = [name.upper() for name in FIN_NAMES]
+
+        export.to_excel(tmp_path.joinpath('parent_fins_#' + str(number) + '.xlsx'), sheet_name='Results', index=False)
+
+    return tmp_path
+
+
+def read_excel_loop(root):
+    """
+    Read exports one after the other with read_excel and consolidate them, as parent_fins_from_orbis_xls did
+    """
+    dfs = [pd.read_excel(root.joinpath('parent_fins_#' + str(number) + '.xlsx'), sheet_name='Results',
+                         names=FIN_NAMES, na_values='n.a.', dtype={'company_name': str, 'bvd9': str})
+           for number in range(1, 4)]
+
+    return load.compact_dtypes(pd.concat(dfs).drop(columns=['rank']))[0]
+
+
+def test_parallel_loader_matches_sequential_loader(parent_fin_exports):
+    reference = read_excel_loop(parent_fin_exports)
+
+    for workers in [1, 3]:
+        loaded = load.parent_fins_from_orbis_xls(parent_fin_exports, 3, RANGE_YS['oprev_ys'], RANGE_YS['rnd_ys'],
+                                                 RANGE_YS['LY'], workers=workers)
+
+        assert loaded['rnd_y18'].dtype == 'float64' and loaded['rnd_y18'].isna().any()
+
+        pd.testing.assert_frame_equal(loaded, reference)
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_projected_read_matches_full_read(parent_fin_exports, cached):
+    cache_root = parent_fin_exports.joinpath('cache') if cached else None
+
+    full = load.parent_fins_from_orbis_xls(parent_fin_exports, 3, RANGE_YS['oprev_ys'], RANGE_YS['rnd_ys'],
+                                           RANGE_YS['LY'])
+
+    # Requested columns in another order than in the sheet
+    columns = ['rnd_y18', 'bvd9', 'op_revenue_y17']
+
+    for repeat in range(2 if cached else 1):
+        projected = load.parent_fins_from_orbis_xls(parent_fin_exports, 3, RANGE_YS['oprev_ys'], RANGE_YS['rnd_ys'],
+                                                    RANGE_YS['LY'], cache_root=cache_root, columns=columns)
+
+        pd.testing.assert_frame_equal(projected, full[columns])
+
+    # Rows filtered as each export is parsed
+    selected = list(full['bvd9'][::7])
+
+    filtered = load.orbis_xls_to_df(
+        partial(load.parent_fins_from_xls, oprev_ys=RANGE_YS['oprev_ys'], rnd_ys=RANGE_YS['rnd_ys'], LY=RANGE_YS['LY']),
+        [parent_fin_exports.joinpath('parent_fins_#' + str(number) + '.xlsx') for number in range(1, 4)],
+        cache_root=cache_root,
+        columns=columns,
+        isin={'bvd9': selected}
+    )
+
+    pd.testing.assert_frame_equal(filtered, full.loc[full['bvd9'].isin(selected), columns])
+
+
+@pytest.mark.parametrize('suffix', ['.csv', '.parquet', '.feather'])
+@pytest.mark.parametrize('float32', [False, True])
+def test_compact_dtypes_round_trip(tmp_path, entities, suffix, float32):
+    rng = np.random.default_rng(4)
+
+    table = pd.DataFrame({
+        'bvd9': ['%09d' % i for i in rng.integers(0, 50, 400)],
+        'sub_bvd9': ['%09d' % (1000 + i) for i in range(400)],
+        'sub_company_name': ['subsidiary ' + str(i) for i in range(400)],
+        'sub_country_2DID_iso': pd.Series(rng.choice(['FR', 'DE', 'US'], 400)).mask(rng.random(400) < .1),
+        'method': rng.choice(['keep_all', 'keep_subs'], 400),
+        'is_listed_company': rng.random(400) < .5,
+        'keep_subs': rng.random(400) < .5,
+        'solar': rng.random(400) < .5,
+        'op_revenue_y18': np.where(rng.random(400) < .1, np.nan, np.round(rng.random(400) * 1e3, 3))
+    })
+
+    (compacted, memory) = load.compact_dtypes(load.encode_ids(table), flags=['solar'], float32=float32)
+
+    assert memory['after_MB'] < memory['before_MB']
+
+    assert compacted['bvd9'].dtype == 'int32'
+    assert compacted['sub_country_2DID_iso'].dtype == 'category' and compacted['method'].dtype == 'category'
+    assert compacted['op_revenue_y18'].dtype == ('float32' if float32 else 'float64')
+
+    file_path = tmp_path.joinpath('table' + suffix)
+
+    load.write_table(compacted, file_path)
+
+    (read, memory) = load.read_table(file_path, flags=['solar'], float32=float32)
+
+    pd.testing.assert_frame_equal(read, compacted)
+
+    # Decoded identifiers and values are the ones of the original table
+    pd.testing.assert_frame_equal(load.decode_ids(read).astype(table.dtypes.to_dict()), table)
+
+
+def test_entity_keys_round_trip_and_rank_as_strings(tmp_path, entities):
+    rng = np.random.default_rng(16)
+
+    # Identifiers parsed from Excel as a mix of strings and numbers, with missing values, in two overlapping batches
+    ids = pd.Series(['%09d' % i for i in rng.integers(0, 500, 800)], dtype=object)
+    ids[::17] = np.nan
+    ids[5::23] = [int(i) for i in rng.integers(10 ** 5, 10 ** 6, len(ids[5::23]))]
+
+    names = ids.where(ids.isna(), ids.astype(str))
+
+    (first, second) = (ids[:500], ids[300:])
+
+    first_keys = load.entity_keys(first)
+    second_keys = load.entity_keys(second)
+
+    assert first_keys.dtype == 'int32'
+    assert list(first_keys[300:]) == list(second_keys[:200])
+    assert list(first_keys == load.MISSING_ID) == list(first.isna())
+
+    keys = load.entity_keys(ids)
+
+    assert list(pd.Series(load.entity_names(keys)).fillna('#N/A')) == list(names.fillna('#N/A'))
+
+    # Keys rank as identifiers sort as strings, missing identifiers last
+    order = np.argsort(load.entity_ranks(keys), kind='mergesort')
+
+    assert list(order) == list(names.reset_index(drop=True).sort_values(kind='mergesort', na_position='last').index)
+
+    # Tables grouped by key and sorted by identifier match tables grouped by identifier
+    table = pd.DataFrame({'bvd9': names, 'value': rng.random(len(names))})
+
+    grouped = load.sort_by_ids(load.encode_ids(table).groupby('bvd9')['value'].sum().reset_index().query(
+        'bvd9 != ' + str(load.MISSING_ID)), 'bvd9')
+
+    reference = table.groupby('bvd9')['value'].sum().reset_index()
+
+    pd.testing.assert_frame_equal(load.decode_ids(grouped), reference)
+
+    # Keys survive persisting and reloading the registry
+    load.save_entities()
+    load.flush_tables()
+
+    assert load.init_entities(tmp_path.joinpath('entities.csv')) == len(pd.unique(names.dropna()))
+
+    assert list(load.entity_keys(ids)) == list(keys)
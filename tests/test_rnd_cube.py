@@ -0,0 +1,192 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_input import file_loader as load
+from rnd_new_approach import rnd_methods as mtd
+from rnd_new_approach import rnd_cube as cube
+
+CATS = ['wind', 'solar', 'hydro']
+ALL = 'NewApp_rnd_2020_GLOBAL_20200419'
+IN_MNC = 'NewApp_rnd_2020_GLOBAL_20200419_in_MNC'
+
+
+@pytest.fixture
+def tables(tmp_path, entities):
+    """
+    Random sub rnd estimates with their parent, guo, country and cluster tables, some keys being missing
+    """
+    rng = np.random.default_rng(7)
+
+    (parent_n, sub_n, row_n) = (60, 400, 5000)
+
+    parent_bvd9 = np.array(['%09d' % i for i in range(parent_n)], dtype=object)
+    sub_bvd9 = np.array(['%09d' % (100000 + i) for i in range(sub_n)], dtype=object)
+
+    parent_ids = pd.DataFrame({
+        'bvd9': parent_bvd9,
+        'guo_bvd9': np.array(['%09d' % (900000 + i) for i in rng.integers(0, 10, parent_n)], dtype=object),
+        'is_listed_company': rng.random(parent_n) < .5
+    })
+
+    parent_guo_ids = pd.DataFrame({
+        'guo_bvd9': ['%09d' % (900000 + i) for i in range(10)],
+        'guo_type': rng.choice(['Corporate', 'Bank', 'Foundation'], 10)
+    })
+
+    country_map = pd.DataFrame({
+        'country_2DID_iso': ['FR', 'US', 'CN', 'DE'],
+        'country_3DID_iso': ['FRA', 'USA', 'CHN', 'DEU'],
+        'world_player': ['EU', 'US', 'CN', 'EU']
+    })
+
+    sub_ids = pd.DataFrame({
+        'sub_bvd9': sub_bvd9,
+        'sub_country_2DID_iso': rng.choice(['FR', 'US', 'CN', 'DE', 'ZZ'], sub_n)
+    })
+
+    sub_fins = pd.DataFrame({'sub_bvd9': sub_bvd9})
+
+    for cat in CATS:
+        sub_fins[cat] = rng.random(sub_n) < .4
+
+    sub_rnd = pd.DataFrame({
+        'bvd9': rng.choice(parent_bvd9, row_n),
+        'sub_bvd9': rng.choice(sub_bvd9, row_n),
+        'year': rng.integers(2015, 2019, row_n),
+        'method': rng.choice(['keep_all', 'keep_comps', 'keep_subs'], row_n),
+        'sub_rnd_clean': rng.random(row_n) * 1e3
+    })
+
+    mnc_path = tmp_path.joinpath('mnc_ids.csv')
+
+    pd.DataFrame({'parent_bvd9': parent_bvd9[::4]}).to_csv(mnc_path, index=False)
+
+    files = {
+        'ref_tables': {'mnc_ids': mnc_path},
+        'cube': tmp_path.joinpath('rnd_cube.csv'),
+        'output_options': {'compression': None, 'csv_export': False}
+    }
+
+    (parent_ids, parent_guo_ids, sub_ids, sub_fins, sub_rnd) = [
+        load.encode_ids(df) for df in (parent_ids, parent_guo_ids, sub_ids, sub_fins, sub_rnd)
+    ]
+
+    return {'files': files, 'parent_ids': parent_ids, 'parent_guo_ids': parent_guo_ids, 'sub_ids': sub_ids,
+            'country_map': country_map, 'sub_fins': sub_fins, 'sub_rnd': sub_rnd, 'mnc_bvd9': parent_bvd9[::4]}
+
+
+def sub_level_table(tables):
+    """
+    Merge sub rnd with its parent, guo, country and cluster attributes and melt it by cluster with plain pandas
+    """
+    parents = pd.merge(tables['parent_ids'], tables['parent_guo_ids'], on='guo_bvd9', how='left')
+
+    parents['is_embedded_in_MNC'] = load.decode_ids(parents[['bvd9']])['bvd9'].isin(tables['mnc_bvd9'])
+    parents['type'] = parents['is_listed_company'].map({True: 'listed', False: 'unlisted guo50'})
+
+    subs = pd.merge(tables['sub_ids'], tables['country_map'], left_on='sub_country_2DID_iso',
+                    right_on='country_2DID_iso', how='left').rename(
+        columns={'country_3DID_iso': 'sub_country_3DID_iso', 'world_player': 'sub_world_player'})
+
+    fins = tables['sub_fins'].copy()
+    fins['keyword_mask'] = fins[CATS].sum(axis=1)
+
+    table = pd.merge(tables['sub_rnd'], parents[['bvd9', 'guo_type', 'type', 'is_embedded_in_MNC']], on='bvd9')
+    table = pd.merge(table, subs[['sub_bvd9', 'sub_country_3DID_iso', 'sub_world_player']], on='sub_bvd9')
+    table = pd.merge(table, fins, on='sub_bvd9', how='left')
+
+    for cat in CATS:
+        table[cat] = table['sub_rnd_clean'] * table[cat] / table['keyword_mask']
+
+    return table.drop(columns='sub_rnd_clean').melt(
+        id_vars=['year', 'sub_country_3DID_iso', 'sub_world_player', 'guo_type', 'type', 'method',
+                 'is_embedded_in_MNC'],
+        value_vars=CATS,
+        var_name='cluster',
+        value_name='sub_rnd_clean'
+    ).dropna(subset=['sub_country_3DID_iso', 'guo_type'])
+
+
+@pytest.fixture
+def rnd_cube(tables):
+    mtd.build_rnd_cube({}, tables['files'], CATS, tables['sub_rnd'], tables['parent_ids'], tables['parent_guo_ids'],
+                       tables['sub_ids'], tables['country_map'], tables['sub_fins'])
+
+    load.flush_tables()
+
+    return mtd.load_rnd_cube(tables['files'])
+
+
+def expected(table, by):
+    return table.groupby(by)['sub_rnd_clean'].sum().reset_index().sort_values(by, ignore_index=True)
+
+
+def check(result, reference, by):
+    assert len(result) == len(reference)
+
+    for col in by:
+        assert list(result[col].astype(reference[col].dtype)) == list(reference[col])
+
+    np.testing.assert_allclose(result['sub_rnd_clean'], reference['sub_rnd_clean'], rtol=1e-9)
+
+
+def test_slice(tables, rnd_cube):
+    table = sub_level_table(tables)
+
+    by = ['year', 'sub_world_player', 'cluster']
+
+    result = cube.query(rnd_cube, by=by, where={'approach': ALL, 'method': 'keep_all'})
+
+    check(result, expected(table[table.method == 'keep_all'], by), by)
+
+
+def test_dice(tables, rnd_cube):
+    table = sub_level_table(tables)
+
+    by = ['sub_country_3DID_iso', 'guo_type', 'type']
+
+    result = cube.query(rnd_cube, by=by, where={'approach': ALL, 'method': 'keep_subs', 'cluster': ['wind', 'hydro'],
+                                                 'year': [2016, 2017]})
+
+    reference = table[(table.method == 'keep_subs') & table.cluster.isin(['wind', 'hydro']) &
+                      table.year.isin([2016, 2017])]
+
+    check(result, expected(reference, by), by)
+
+
+def test_rollup(tables, rnd_cube):
+    table = sub_level_table(tables)
+
+    for by in (['method', 'year'], ['method']):
+        check(cube.query(rnd_cube, by=by, where={'approach': ALL}), expected(table, by), by)
+
+    total = cube.query(rnd_cube, by=[], where={'approach': ALL})
+
+    np.testing.assert_allclose(total['sub_rnd_clean'], [table['sub_rnd_clean'].sum()], rtol=1e-9)
+
+
+def test_embedded_in_mnc(tables, rnd_cube):
+    table = sub_level_table(tables)
+
+    by = ['year', 'method']
+
+    result = cube.query(rnd_cube, by=by, where={'approach': IN_MNC})
+
+    check(result, expected(table[table.is_embedded_in_MNC], by), by)
+
+
+def test_subs_without_rnd_leave_the_cube_unchanged(tables, rnd_cube):
+    # Computed sub rnd also lists subsidiaries without rnd, which the saved sub rnd leaves out
+    without_rnd = tables['sub_rnd'].sample(500, random_state=0).assign(sub_rnd_clean=np.nan)
+
+    files = dict(tables['files'], cube=tables['files']['cube'].with_name('rnd_cube_with_nan.csv'))
+
+    mtd.build_rnd_cube({}, files, CATS, pd.concat([tables['sub_rnd'], without_rnd], ignore_index=True),
+                       tables['parent_ids'], tables['parent_guo_ids'], tables['sub_ids'], tables['country_map'],
+                       tables['sub_fins'])
+
+    load.flush_tables()
+
+    pd.testing.assert_frame_equal(mtd.load_rnd_cube(files), rnd_cube)
@@ -0,0 +1,208 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_input import file_loader as load
+from rnd_new_approach import rnd_methods as mtd
+
+METHODS = ['keep_all', 'keep_subs']
+RANGE_YS = {'rnd_ys': ['rnd_y16', 'rnd_y17', 'rnd_y18'],
+            'oprev_ys': ['op_revenue_y16', 'op_revenue_y17', 'op_revenue_y18'], 'LY': '18'}
+
+PARENT_RND_COLS = ['bvd9', 'year', 'parent_oprev', 'parent_rnd', 'parent_exposure', 'parent_rnd_clean', 'method']
+SUB_RND_COLS = ['sub_bvd9', 'bvd9', 'year', 'parent_rnd_clean', 'sub_exposure', 'parent_exposure_from_sub',
+                'sub_rnd_clean', 'method']
+
+
+def melted_parent_rnd(cases,
+                      range_ys,
+                      parent_exposure,
+                      parent_fins):
+    """
+    Compute parent rnd on tables melted by year and merged, method after method, as compute_parent_rnd did before
+    dense arrays
+    """
+    parent_rnd_conso = []
+
+    report_parent_rnd = {}
+
+    parent_rnd = pd.merge(parent_exposure, parent_fins,
+                          left_on='bvd9', right_on='bvd9',
+                          how='left'
+                          )
+
+    for method in cases['methods']:
+        parent_rnd_method = parent_rnd[parent_rnd['method'] == method]
+
+        rnd_melt = parent_rnd_method.melt(
+            id_vars=['bvd9', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
+                     'parent_exposure'],
+            value_vars=range_ys['rnd_ys'],
+            var_name='rnd_label', value_name='parent_rnd')
+
+        rnd_melt['year'] = [int('20' + s[-2:]) for s in rnd_melt['rnd_label']]
+
+        oprev_melt = parent_rnd_method.melt(
+            id_vars=['bvd9'],
+            value_vars=range_ys['oprev_ys'],
+            var_name='oprev_label', value_name='parent_oprev')
+
+        oprev_melt['year'] = [int('20' + s[-2:]) for s in oprev_melt['oprev_label']]
+
+        parent_rnd_method_melted = pd.merge(
+            rnd_melt,
+            oprev_melt,
+            left_on=['bvd9', 'year'],
+            right_on=['bvd9', 'year'],
+            how='left')
+
+        parent_rnd_method_melted['parent_rnd_clean'] = parent_rnd_method_melted['parent_rnd'] * \
+                                                       parent_rnd_method_melted['parent_exposure']
+
+        parent_rnd_method_melted['method'] = str(method)
+
+        parent_rnd_method_melted.dropna(subset=['parent_exposure', 'parent_rnd', 'parent_rnd_clean'], how='all',
+                                        inplace=True)
+
+        parent_rnd_conso.append(parent_rnd_method_melted)
+
+        report_parent_rnd.update(
+            pd.DataFrame.to_dict(
+                parent_rnd_method_melted[['year', 'parent_rnd_clean']].groupby(
+                    ['year']).sum().rename(columns={'parent_rnd_clean': 'with_method: ' + str(method)})
+            )
+        )
+
+    return report_parent_rnd, pd.concat(parent_rnd_conso, ignore_index=True)[PARENT_RND_COLS]
+
+
+@pytest.fixture
+def parent_tables():
+    """
+    Random parent exposure of all methods and parent financials with missing values, parent companies without
+    financials and parent companies listed twice in financials
+    """
+    rng = np.random.default_rng(20)
+
+    parent_bvd9 = ['%09d' % i for i in range(200)]
+
+    parent_exposure = pd.concat([
+        pd.DataFrame({
+            'bvd9': rng.choice(parent_bvd9, 150, replace=False),
+            'total_sub_turnover_sum_masked_in_parent': rng.random(150) * 1e2,
+            'total_sub_turnover_sum_in_parent': rng.random(150) * 1e3,
+            'parent_exposure': np.where(rng.random(150) < .1, np.nan, rng.random(150)),
+            'method': method
+        }) for method in METHODS
+    ], ignore_index=True)
+
+    parent_fins = pd.DataFrame({'bvd9': rng.choice(parent_bvd9, 170, replace=False)})
+
+    for col in RANGE_YS['rnd_ys'] + RANGE_YS['oprev_ys']:
+        parent_fins[col] = np.where(rng.random(170) < .15, np.nan, rng.random(170) * 1e3)
+
+    parent_fins = pd.concat([parent_fins, parent_fins.iloc[:5].assign(rnd_y17=1.0)], ignore_index=True)
+
+    return parent_exposure, parent_fins
+
+
+def test_parent_rnd_matches_melted_merges(tmp_path, entities, parent_tables):
+    (parent_exposure, parent_fins) = parent_tables
+
+    cases = {'methods': METHODS, 'exposure_by_year': False}
+
+    (report, parent_rnd) = mtd.compute_parent_rnd(cases, {}, RANGE_YS, load.encode_ids(parent_exposure),
+                                                  load.encode_ids(parent_fins), save=False)
+
+    (ref_report, ref_parent_rnd) = melted_parent_rnd(cases, RANGE_YS, parent_exposure, parent_fins)
+
+    # Same rows in the same order, year after year for each method
+    pd.testing.assert_frame_equal(load.decode_ids(parent_rnd[PARENT_RND_COLS]), ref_parent_rnd, check_dtype=False)
+
+    for (method, by_year) in ref_report.items():
+        assert report[method] == pytest.approx(by_year, rel=1e-12)
+
+
+def per_method_sub_rnd(cases,
+                       sub_exposure,
+                       parent_rnd):
+    """
+    Allocate parent rnd to subsidiaries with merges method after method, as compute_sub_rnd did before a single join
+    """
+    sub_rnd_conso = []
+
+    report_sub_rnd = {}
+
+    for method in cases['methods']:
+        sub_exposure_method = sub_exposure[sub_exposure['method'] == method]
+        parent_rnd_method = parent_rnd[parent_rnd['method'] == method]
+
+        sub_rnd = pd.merge(
+            sub_exposure_method, parent_rnd_method[['bvd9', 'parent_rnd', 'year', 'parent_rnd_clean']],
+            left_on='bvd9', right_on='bvd9',
+            how='left'
+        )
+
+        df = sub_rnd[
+            ['bvd9', 'year', 'sub_exposure']
+        ].groupby(['bvd9', 'year']).sum().rename(
+            columns={'sub_exposure': 'parent_exposure_from_sub'}
+        )
+
+        sub_rnd = pd.merge(
+            sub_rnd, df,
+            left_on=['bvd9', 'year'], right_on=['bvd9', 'year'],
+            how='left',
+            suffixes=(False, False)
+        )
+
+        sub_rnd['sub_rnd_clean'] = sub_rnd['parent_rnd_clean'] * sub_rnd['sub_exposure'] / sub_rnd[
+            'parent_exposure_from_sub']
+
+        sub_rnd['method'] = str(method)
+
+        sub_rnd_conso.append(sub_rnd)
+
+        report_sub_rnd.update(
+            pd.DataFrame.to_dict(
+                sub_rnd[['year', 'sub_rnd_clean']].groupby(['year']).sum().rename(
+                    columns={'sub_rnd_clean': 'with_method: ' + str(method)})
+            )
+        )
+
+    return report_sub_rnd, pd.concat(sub_rnd_conso, ignore_index=True)[SUB_RND_COLS]
+
+
+def test_sub_rnd_join_matches_per_method_merges(tmp_path, entities, parent_tables):
+    (parent_exposure, parent_fins) = parent_tables
+
+    rng = np.random.default_rng(21)
+
+    cases = {'methods': METHODS, 'exposure_by_year': False, 'sparse_allocation': False}
+
+    # Parent rnd with rows repeated for parent companies listed twice in financials
+    parent_rnd = melted_parent_rnd(cases, RANGE_YS, parent_exposure, parent_fins)[1]
+
+    # Subsidiaries of parent companies with and without rnd, some of them in several parent companies
+    sub_exposure = pd.concat([
+        pd.DataFrame({
+            'sub_bvd9': ['%09d' % (1000 + i) for i in rng.integers(0, 600, 500)],
+            'bvd9': ['%09d' % i for i in rng.integers(0, 220, 500)],
+            'sub_exposure': np.where(rng.random(500) < .1, np.nan, rng.random(500)),
+            'method': method
+        }) for method in METHODS
+    ], ignore_index=True)
+
+    (report, sub_rnd) = mtd.compute_sub_rnd(cases, {}, RANGE_YS, load.encode_ids(sub_exposure),
+                                            load.encode_ids(parent_rnd), save=False)
+
+    (ref_report, ref_sub_rnd) = per_method_sub_rnd(cases, sub_exposure, parent_rnd)
+
+    assert ref_sub_rnd['year'].isna().any() and ref_sub_rnd['sub_rnd_clean'].notna().any()
+
+    # Same rows in the same order, method after method
+    pd.testing.assert_frame_equal(load.decode_ids(sub_rnd), ref_sub_rnd, check_dtype=False)
+
+    for (method, by_year) in ref_report.items():
+        assert report[method] == pytest.approx(by_year, rel=1e-12)
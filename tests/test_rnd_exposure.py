@@ -0,0 +1,224 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_input import file_loader as load
+from rnd_new_approach import rnd_methods as mtd
+
+METHODS = ['keep_all', 'keep_comps', 'keep_subs']
+RANGE_YS = {'rnd_ys': ['rnd_y17', 'rnd_y18'], 'oprev_ys': ['op_revenue_y17', 'op_revenue_y18'], 'LY': '18'}
+
+PARENT_COLS = ['bvd9', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
+               'parent_exposure', 'method']
+SUB_COLS = ['sub_bvd9', 'sub_turnover_sum', 'sub_turnover_sum_masked', 'sub_exposure'] + PARENT_COLS
+
+YEAR_PARENT_COLS = ['bvd9', 'year', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
+                    'parent_exposure', 'method']
+YEAR_SUB_COLS = ['sub_bvd9', 'sub_turnover_sum', 'sub_turnover_sum_masked', 'sub_exposure'] + YEAR_PARENT_COLS
+
+
+def per_method_exposure(methods,
+                        selected_sub_ids,
+                        sub_fins):
+    """
+    Compute exposure method after method on filtered copies, as compute_exposure did before computing all methods
+    in one pass
+    """
+    parent_exposure_conso = []
+    sub_exposure_conso = []
+    report_exposure = {'at_subsidiary_level': {}, 'at_parent_level': {}}
+
+    for method in methods:
+        sub_exposure = pd.merge(
+            selected_sub_ids[selected_sub_ids[method] == True], sub_fins,
+            left_on=['sub_bvd9'], right_on=['sub_bvd9'],
+            how='left'
+        )
+
+        parent_exposure = sub_exposure[
+            ['bvd9', 'sub_turnover_sum_masked', 'sub_turnover_sum']
+        ].groupby(['bvd9']).sum().rename(
+            columns={'sub_turnover_sum': 'total_sub_turnover_sum_in_parent',
+                     'sub_turnover_sum_masked': 'total_sub_turnover_sum_masked_in_parent'}
+        )
+
+        parent_exposure['parent_exposure'] = parent_exposure['total_sub_turnover_sum_masked_in_parent'] / \
+                                             parent_exposure['total_sub_turnover_sum_in_parent']
+
+        parent_exposure['method'] = str(method)
+
+        parent_exposure.reset_index(inplace=True)
+
+        sub_exposure = pd.merge(
+            sub_exposure, parent_exposure[
+                ['bvd9', 'total_sub_turnover_sum_masked_in_parent', 'total_sub_turnover_sum_in_parent',
+                 'parent_exposure']],
+            left_on='bvd9', right_on='bvd9',
+            how='left'
+        )
+
+        sub_exposure['sub_exposure'] = sub_exposure['sub_turnover_sum_masked'] / sub_exposure[
+            'total_sub_turnover_sum_in_parent']
+
+        sub_exposure['method'] = str(method)
+
+        sub_exposure.dropna(subset=['parent_exposure', 'sub_turnover_sum'], inplace=True)
+
+        report_exposure['at_parent_level']['With method: ' + str(method)] = {
+            'Total_exposure': parent_exposure['parent_exposure'].sum()
+        }
+
+        report_exposure['at_subsidiary_level']['With method: ' + str(method)] = {
+            'Total_exposure': sub_exposure['sub_exposure'].sum()
+        }
+
+        parent_exposure_conso.append(parent_exposure)
+        sub_exposure_conso.append(sub_exposure)
+
+    return (report_exposure, pd.concat(parent_exposure_conso, ignore_index=True)[PARENT_COLS],
+            pd.concat(sub_exposure_conso, ignore_index=True)[SUB_COLS])
+
+
+@pytest.fixture
+def tables():
+    """
+    Random subsidiaries flagged for methods and their screened financials, some turnovers being missing and some
+    subsidiaries having no financials
+    """
+    rng = np.random.default_rng(5)
+
+    selected_sub_ids = pd.DataFrame({
+        'bvd9': ['%09d' % i for i in rng.integers(0, 80, 1500)],
+        'sub_bvd9': ['%09d' % (100000 + i) for i in rng.integers(0, 1000, 1500)]
+    }).drop_duplicates(ignore_index=True)
+
+    for method in METHODS:
+        selected_sub_ids[method] = rng.random(len(selected_sub_ids)) < .7
+
+    sub_bvd9 = selected_sub_ids['sub_bvd9'].drop_duplicates()
+
+    sub_fins = pd.DataFrame({'sub_bvd9': sub_bvd9[rng.random(len(sub_bvd9)) < .9].values})
+
+    sub_fins['sub_turnover_sum'] = np.where(rng.random(len(sub_fins)) < .1, np.nan, rng.random(len(sub_fins)) * 1e3)
+    sub_fins['keyword_mask'] = rng.random(len(sub_fins)) < .5
+    sub_fins['sub_turnover_sum_masked'] = sub_fins['sub_turnover_sum'].mask(~sub_fins['keyword_mask'])
+
+    return selected_sub_ids, sub_fins
+
+
+def test_one_pass_matches_per_method(tmp_path, entities, tables):
+    (selected_sub_ids, sub_fins) = tables
+
+    cases = {'methods': METHODS, 'exposure_by_year': False}
+
+    files = {
+        'rnd_outputs': {'parents': {'expo': tmp_path.joinpath('parent_expo.csv')},
+                        'subs': {'expo': tmp_path.joinpath('sub_expo.csv')}},
+        'output_options': {'compression': None, 'csv_export': False}
+    }
+
+    (keyword_report, report, parent_exposure, sub_exposure) = mtd.compute_exposure(
+        cases, files, RANGE_YS, load.encode_ids(selected_sub_ids), load.encode_ids(sub_fins))
+
+    load.flush_tables()
+
+    (ref_report, ref_parent_exposure, ref_sub_exposure) = per_method_exposure(METHODS, selected_sub_ids, sub_fins)
+
+    pd.testing.assert_frame_equal(load.decode_ids(parent_exposure[PARENT_COLS]).reset_index(drop=True),
+                                  ref_parent_exposure, check_dtype=False)
+
+    pd.testing.assert_frame_equal(load.decode_ids(sub_exposure[SUB_COLS]).reset_index(drop=True),
+                                  ref_sub_exposure, check_dtype=False)
+
+    for level in report.keys():
+        for (method, totals) in ref_report[level].items():
+            assert report[level][method]['Total_exposure'] == pytest.approx(totals['Total_exposure'], rel=1e-12)
+
+
+def melted_exposure(methods,
+                    oprev_ys,
+                    selected_sub_ids,
+                    sub_fins):
+    """
+    Compute exposure by year with plain pandas, method after method on a table melted by year
+    """
+    parent_exposure_conso = []
+    sub_exposure_conso = []
+
+    for method in methods:
+        sub_exposure = pd.merge(selected_sub_ids.loc[selected_sub_ids[method] == True, ['bvd9', 'sub_bvd9']],
+                                sub_fins, on='sub_bvd9', how='left')
+
+        sub_exposure = sub_exposure.melt(id_vars=['bvd9', 'sub_bvd9', 'keyword_mask'], value_vars=oprev_ys,
+                                         var_name='label', value_name='sub_turnover_sum')
+
+        sub_exposure['year'] = ('20' + sub_exposure['label'].str[-2:]).astype('int64')
+        sub_exposure['sub_turnover_sum_masked'] = sub_exposure['sub_turnover_sum'].where(
+            sub_exposure['keyword_mask'] == True)
+
+        parent_exposure = sub_exposure.groupby(['bvd9', 'year'])[
+            ['sub_turnover_sum_masked', 'sub_turnover_sum']].sum().rename(
+            columns={'sub_turnover_sum': 'total_sub_turnover_sum_in_parent',
+                     'sub_turnover_sum_masked': 'total_sub_turnover_sum_masked_in_parent'}
+        ).reset_index()
+
+        parent_exposure['parent_exposure'] = parent_exposure['total_sub_turnover_sum_masked_in_parent'] / \
+                                             parent_exposure['total_sub_turnover_sum_in_parent']
+
+        parent_exposure['method'] = method
+
+        sub_exposure = pd.merge(sub_exposure, parent_exposure.drop(columns='method'), on=['bvd9', 'year'])
+
+        sub_exposure['sub_exposure'] = sub_exposure['sub_turnover_sum_masked'] / sub_exposure[
+            'total_sub_turnover_sum_in_parent']
+
+        sub_exposure['method'] = method
+
+        sub_exposure.dropna(subset=['parent_exposure', 'sub_turnover_sum'], inplace=True)
+
+        parent_exposure_conso.append(parent_exposure)
+        sub_exposure_conso.append(sub_exposure)
+
+    return (pd.concat(parent_exposure_conso, ignore_index=True)[YEAR_PARENT_COLS],
+            pd.concat(sub_exposure_conso, ignore_index=True)[YEAR_SUB_COLS])
+
+
+def test_exposure_by_year_matches_melted_exposure(tmp_path, entities, tables):
+    (selected_sub_ids, sub_fins) = tables
+
+    rng = np.random.default_rng(19)
+
+    # Yearly turnovers, some of them missing
+    for col in RANGE_YS['oprev_ys']:
+        sub_fins[col] = np.where(rng.random(len(sub_fins)) < .1, np.nan, rng.random(len(sub_fins)) * 1e3)
+
+    cases = {'methods': METHODS, 'exposure_by_year': True}
+
+    files = {
+        'rnd_outputs': {'parents': {'expo': tmp_path.joinpath('parent_expo.csv')},
+                        'subs': {'expo': tmp_path.joinpath('sub_expo.csv')}},
+        'output_options': {'compression': None, 'csv_export': False}
+    }
+
+    (keyword_report, report, parent_exposure, sub_exposure) = mtd.compute_exposure(
+        cases, files, RANGE_YS, load.encode_ids(selected_sub_ids), load.encode_ids(sub_fins), save=False)
+
+    (ref_parent_exposure, ref_sub_exposure) = melted_exposure(METHODS, RANGE_YS['oprev_ys'], selected_sub_ids,
+                                                              sub_fins)
+
+    # Parent companies come in bvd9 order, years in order within each parent company
+    pd.testing.assert_frame_equal(load.decode_ids(parent_exposure[YEAR_PARENT_COLS]).reset_index(drop=True),
+                                  ref_parent_exposure, check_dtype=False)
+
+    keys = ['method', 'bvd9', 'sub_bvd9', 'year']
+
+    pd.testing.assert_frame_equal(
+        load.decode_ids(sub_exposure[YEAR_SUB_COLS]).sort_values(keys).reset_index(drop=True),
+        ref_sub_exposure.sort_values(keys).reset_index(drop=True),
+        check_dtype=False
+    )
+
+    for method in METHODS:
+        assert report['at_parent_level']['With method: ' + method]['Total_exposure'] == pytest.approx(
+            ref_parent_exposure.loc[ref_parent_exposure['method'] == method, 'parent_exposure'].sum(), rel=1e-12)
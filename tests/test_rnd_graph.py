@@ -0,0 +1,70 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+from data_input import file_loader as load
+from rnd_new_approach import rnd_methods as mtd
+
+METHODS = ['keep_all', 'keep_comps', 'keep_subs']
+
+
+def isin_flags(parent_ids,
+               sub_ids):
+    """
+    Flag subsidiaries with isin over the flat tables, as screen_sub_ids_for_method did before the ownership graph
+    """
+    sub_ids = sub_ids.copy()
+
+    sub_ids.loc[sub_ids['sub_bvd9'].duplicated(keep=False), 'is_sub_a_duplicate'] = True
+    sub_ids.loc[sub_ids['is_sub_a_duplicate'] != True, 'is_sub_a_duplicate'] = False
+
+    sub_ids.loc[:, 'keep_all'] = True
+
+    sub_ids.loc[~sub_ids['bvd9'].isin(sub_ids['sub_bvd9']), 'keep_subs'] = True
+    sub_ids.loc[sub_ids['keep_subs'] != True, 'keep_subs'] = False
+    sub_ids.loc[~sub_ids['sub_bvd9'].isin(parent_ids['bvd9']), 'keep_comps'] = True
+    sub_ids.loc[sub_ids['keep_comps'] != True, 'keep_comps'] = False
+
+    return sub_ids
+
+
+def test_graph_flags_match_isin(tmp_path, entities):
+    rng = np.random.default_rng(17)
+
+    # Parent companies and subsidiaries drawn from overlapping ranges, so that some parents are subsidiaries of other
+    # parents, some subsidiaries are listed parents and some subsidiaries have several parents or repeated edges
+    parent_ids = pd.DataFrame({
+        'bvd9': ['%09d' % i for i in rng.choice(300, 120, replace=False)],
+        'guo_bvd9': ['%09d' % (900 + i) for i in rng.integers(0, 40, 120)]
+    })
+
+    sub_ids = pd.DataFrame({
+        'bvd9': rng.choice(parent_ids['bvd9'], 1000),
+        'sub_bvd9': ['%09d' % i for i in rng.integers(200, 700, 1000)]
+    })
+
+    # Other columns of the saved subsidiary identification
+    for col in ['sub_company_name', 'sub_bvd_id', 'sub_legal_entity_id', 'sub_country_2DID_iso', 'sub_NACE_4Dcode',
+                'sub_NACE_desc']:
+        sub_ids[col] = 'n.a.'
+
+    sub_ids['sub_lvl'] = 1
+
+    files = {'rnd_outputs': {'subs': {'id': tmp_path.joinpath('sub_ids.csv')}},
+             'output_options': {'compression': None, 'csv_export': False}}
+
+    (report, flagged) = mtd.screen_sub_ids_for_method({'methods': METHODS}, files, load.encode_ids(parent_ids),
+                                                      load.encode_ids(sub_ids))
+
+    load.flush_tables()
+
+    reference = isin_flags(parent_ids, sub_ids)
+
+    # The reference really exercises each flag both ways
+    for col in ['is_sub_a_duplicate', 'keep_comps', 'keep_subs']:
+        assert reference[col].any() and not reference[col].all()
+
+    for col in ['is_sub_a_duplicate'] + METHODS:
+        assert list(flagged[col].astype(bool)) == list(reference[col].astype(bool)), col
+
+    assert list(load.decode_ids(flagged[['bvd9', 'sub_bvd9']])['sub_bvd9']) == list(sub_ids['sub_bvd9'])
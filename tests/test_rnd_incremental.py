@@ -0,0 +1,214 @@
+# Import libraries
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import config as cfg
+from data_input import file_loader as load
+from rnd_new_approach import rnd_methods as mtd
+from rnd_new_approach import rnd_incremental as inc
+
+METHODS = ['keep_all', 'keep_subs']
+RANGE_YS = {'rnd_ys': ['rnd_y16', 'rnd_y17', 'rnd_y18'],
+            'oprev_ys': ['op_revenue_y16', 'op_revenue_y17', 'op_revenue_y18'], 'LY': '18'}
+
+# Stages record of both cases, with the same code fingerprints so that the previous case can be reused
+STAGES = {'fingerprints': {name: {'code': 'same code'} for name in inc.INCREMENTAL_STAGES}}
+
+
+def vintage(seed):
+    """
+    Random parent financials, subsidiaries flagged for methods and screened subsidiary financials
+    """
+    rng = np.random.default_rng(seed)
+
+    parent_bvd9 = ['%09d' % i for i in range(60)]
+
+    parent_fins = pd.DataFrame({'bvd9': parent_bvd9})
+
+    for col in RANGE_YS['rnd_ys'] + RANGE_YS['oprev_ys']:
+        parent_fins[col] = np.where(rng.random(60) < .05, np.nan, rng.random(60) * 1e3)
+
+    sub_ids = pd.DataFrame({
+        'bvd9': rng.choice(parent_bvd9, 600),
+        'sub_bvd9': ['%09d' % (100000 + i) for i in rng.integers(0, 400, 600)]
+    }).drop_duplicates(ignore_index=True)
+
+    for method in METHODS:
+        sub_ids[method] = rng.random(len(sub_ids)) < .7
+
+    sub_fins = pd.DataFrame({'sub_bvd9': sub_ids['sub_bvd9'].drop_duplicates().values})
+
+    for col in RANGE_YS['oprev_ys']:
+        sub_fins[col] = rng.random(len(sub_fins)) * 1e2
+
+    sub_fins['sub_turnover_sum'] = sub_fins[RANGE_YS['oprev_ys']].sum(axis=1)
+    sub_fins['keyword_mask'] = rng.random(len(sub_fins)) < .5
+    sub_fins['sub_turnover_sum_masked'] = sub_fins['sub_turnover_sum'].mask(~sub_fins['keyword_mask'])
+
+    return {'parent_fins': parent_fins, 'sub_ids': sub_ids, 'sub_fins': sub_fins}
+
+
+def next_vintage(previous):
+    """
+    Change the financials of some parent companies and subsidiaries, re-flag and add subsidiaries and drop a parent
+    """
+    rng = np.random.default_rng(99)
+
+    parent_fins = previous['parent_fins'].copy()
+    parent_fins.loc[::9, 'rnd_y17'] = parent_fins.loc[::9, 'rnd_y17'] * 2
+
+    sub_ids = previous['sub_ids'][previous['sub_ids']['bvd9'] != '000000005'].copy()
+    sub_ids.loc[sub_ids.index[::25], 'keep_subs'] = ~sub_ids.loc[sub_ids.index[::25], 'keep_subs']
+
+    added = pd.DataFrame({'bvd9': ['000000007', '000000011'], 'sub_bvd9': ['000999001', '000999002'],
+                          'keep_all': True, 'keep_subs': True})
+
+    sub_ids = pd.concat([sub_ids, added], ignore_index=True)
+
+    sub_fins = previous['sub_fins'].copy()
+
+    for row in sub_fins.index[::30]:
+        sub_fins.loc[row, 'keyword_mask'] = not sub_fins.loc[row, 'keyword_mask']
+
+    added_fins = sub_fins.iloc[:2].assign(sub_bvd9=['000999001', '000999002'])
+
+    sub_fins = pd.concat([sub_fins, added_fins], ignore_index=True)
+    sub_fins['sub_turnover_sum_masked'] = sub_fins['sub_turnover_sum'].mask(~sub_fins['keyword_mask'])
+
+    return {'parent_fins': parent_fins, 'sub_ids': sub_ids, 'sub_fins': sub_fins}
+
+
+def case(tmp_path,
+         name,
+         exposure_by_year,
+         previous_case_root=None):
+    cases = {
+        'methods': METHODS,
+        'exposure_by_year': exposure_by_year,
+        'sparse_allocation': False,
+        'previous_case_root': previous_case_root,
+        'root': Path(cfg.__file__).resolve().parent,
+        'case_root': tmp_path.joinpath(name)
+    }
+
+    cases['case_root'].mkdir()
+
+    return cases, cfg.import_my_files(cases)
+
+
+def full_run(cases,
+             files,
+             tables):
+    """
+    Compute exposure, parent rnd and sub rnd of all parent companies, as rnd_main does without a previous case
+    """
+    (parent_fins, sub_ids, sub_fins) = [load.encode_ids(tables[name]) for name in ['parent_fins', 'sub_ids',
+                                                                                   'sub_fins']]
+
+    outputs = files['rnd_outputs']
+
+    load.write_table(parent_fins, outputs['parents']['fin'], **files['output_options'])
+    load.write_table(sub_ids, outputs['subs']['id'], **files['output_options'])
+    load.write_table(sub_fins, outputs['subs']['fin'], **files['output_options'])
+
+    (keyword_report, exposure_report, parent_exposure, sub_exposure) = mtd.compute_exposure(cases, files, RANGE_YS,
+                                                                                            sub_ids, sub_fins)
+
+    (parent_report, parent_rnd) = mtd.compute_parent_rnd(cases, files, RANGE_YS, parent_exposure, parent_fins)
+
+    (sub_report, sub_rnd) = mtd.compute_sub_rnd(cases, files, RANGE_YS, sub_exposure, parent_rnd)
+
+    with open(cases['case_root'].joinpath(r'stages.json'), 'w') as file:
+        json.dump({'stages': {name: {'fingerprint': {'code': 'same code'}} for name in inc.INCREMENTAL_STAGES}}, file)
+
+    return {'parent_exposure': parent_exposure, 'sub_exposure': sub_exposure, 'parent_rnd': parent_rnd,
+            'sub_rnd': sub_rnd, 'parent_report': parent_report, 'sub_report': sub_report}
+
+
+def incremental_run(cases,
+                    files,
+                    tables):
+    """
+    Recompute exposure, parent rnd and sub rnd of the parent companies affected by changes, as rnd_main does with a
+    previous case
+    """
+    (parent_fins, sub_ids, sub_fins) = [load.encode_ids(tables[name]) for name in ['parent_fins', 'sub_ids',
+                                                                                   'sub_fins']]
+
+    (increment, report) = inc.diff_vintages(cases, files, RANGE_YS, STAGES, parent_fins, sub_ids, sub_fins)
+
+    assert increment is not None, report
+
+    (keyword_report, exposure_report, parent_exposure, sub_exposure) = inc.compute_exposure(
+        cases, files, RANGE_YS, sub_ids, sub_fins, increment)
+
+    (parent_report, parent_rnd) = inc.compute_parent_rnd(cases, files, RANGE_YS, parent_exposure, parent_fins,
+                                                         increment)
+
+    (sub_report, sub_rnd) = inc.compute_sub_rnd(cases, files, RANGE_YS, sub_exposure, parent_rnd, increment)
+
+    return {'parent_exposure': parent_exposure, 'sub_exposure': sub_exposure, 'parent_rnd': parent_rnd,
+            'sub_rnd': sub_rnd, 'parent_report': parent_report, 'sub_report': sub_report,
+            'increment': increment}
+
+
+def sorted_table(df,
+                 keys):
+    keys = [key for key in keys if key in df.columns]
+
+    df = df.assign(method=df['method'].astype(str))
+
+    return df.sort_values(keys, kind='mergesort').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('exposure_by_year', [False, True])
+def test_incremental_matches_full_run(tmp_path, entities, exposure_by_year):
+    previous = vintage(1)
+    current = next_vintage(previous)
+
+    (previous_cases, previous_files) = case(tmp_path, 'previous', exposure_by_year)
+
+    full_run(previous_cases, previous_files, previous)
+
+    (full_cases, full_files) = case(tmp_path, 'full', exposure_by_year)
+
+    full = full_run(full_cases, full_files, current)
+
+    (inc_cases, inc_files) = case(tmp_path, 'incremental', exposure_by_year, previous_cases['case_root'])
+
+    incremental = incremental_run(inc_cases, inc_files, current)
+
+    load.flush_tables()
+
+    # Only part of the parent companies is recomputed
+    assert 0 < len(incremental['increment']['affected']) < len(incremental['increment']['universe'])
+
+    keys = ['method', 'bvd9', 'sub_bvd9', 'year']
+
+    # Subsidiaries without rnd are only left out of the tables written by a full run
+    full['sub_rnd'] = full['sub_rnd'].dropna(subset=['sub_rnd_clean'])
+
+    for name in ['parent_exposure', 'sub_exposure', 'parent_rnd', 'sub_rnd']:
+        result = sorted_table(incremental[name], keys)
+        reference = sorted_table(full[name], keys)
+
+        assert list(result.columns) == list(reference.columns)
+        assert len(result) == len(reference)
+
+        for col in result.columns:
+            if col in keys:
+                dtype = str if col == 'method' else float
+
+                assert list(result[col].astype(dtype)) == list(reference[col].astype(dtype))
+            else:
+                # Reused and recomputed rows are read back from csv outputs written with 10 decimals
+                np.testing.assert_allclose(result[col].astype(float), reference[col].astype(float), rtol=1e-6,
+                                           atol=1e-9)
+
+    for name in ['parent_report', 'sub_report']:
+        for (method, by_year) in full[name].items():
+            assert incremental[name][method] == pytest.approx(by_year, rel=1e-6)
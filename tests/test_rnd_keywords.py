@@ -0,0 +1,96 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+from rnd_new_approach import rnd_keywords as kwd
+
+DESC_COLS = ['trade_desc', 'products&services_desc', 'full_overview_desc']
+
+KEYWORDS = {
+    'solar': ['solar', 'Solar panel', 'photovoltaic', 'PV '],
+    'wind': ['wind', 'wind turbine', 'offshore'],
+    'fuel': ['fuel cell', 'hydrogen', 'H2.0', 'c++ fuel'],
+    'storage': ['battery', 'batteries', 'storage', 'fuel'],
+    'empty': []
+}
+
+WORDS = ['solar', 'SOLAR PANELS', 'photo', 'photovoltaics', 'pv module', 'wind', 'Windturbine', 'wind turbine',
+         'offshore', 'fuel cells', 'fuel', 'hydrogen', 'H2.0', 'h2x0', 'C++ FUEL', 'battery', 'batteries', 'storage',
+         'steel', 'retail', 'software', 'bank']
+
+
+def str_contains_screen(df,
+                        keywords):
+    """
+    Screen descriptions keyword after keyword with str.contains, as screen_sub_fins_for_keywords did
+    """
+    screened = pd.DataFrame(index=df.index)
+
+    for category in keywords.keys():
+        screened[category] = False
+
+        for keyword in keywords[category]:
+            screened[category] |= df['trade_desc'].str.contains(keyword, case=False, regex=False) | \
+                                  df['products&services_desc'].str.contains(keyword, case=False, regex=False) | \
+                                  df['full_overview_desc'].str.contains(keyword, case=False, regex=False)
+
+    return screened == True
+
+
+@pytest.fixture
+def descriptions():
+    """
+    Random descriptions made of keywords, prefixes of keywords and other words, some of them missing
+    """
+    rng = np.random.default_rng(11)
+
+    def text():
+        if rng.random() < .15:
+            return np.nan
+
+        return ' '.join(rng.choice(WORDS, rng.integers(0, 6)))
+
+    return pd.DataFrame({col: [text() for row in range(2000)] for col in DESC_COLS})
+
+
+def test_matcher_matches_str_contains(descriptions):
+    screened = kwd.screen_descriptions(descriptions, kwd.compile_keywords(KEYWORDS), DESC_COLS)
+
+    pd.testing.assert_frame_equal(screened, str_contains_screen(descriptions, KEYWORDS))
+
+
+def test_parallel_matcher_matches_str_contains(descriptions):
+    screened = kwd.screen_descriptions(descriptions, kwd.compile_keywords(KEYWORDS), DESC_COLS, workers=2)
+
+    pd.testing.assert_frame_equal(screened, str_contains_screen(descriptions, KEYWORDS))
+
+
+def test_cached_matcher_matches_str_contains(tmp_path, descriptions):
+    kwd.screen_descriptions_cached(descriptions.iloc[:500], KEYWORDS, DESC_COLS, tmp_path)
+
+    # Second run reads the hits of the first rows from the cache and screens the other rows
+    screened = kwd.screen_descriptions_cached(descriptions, KEYWORDS, DESC_COLS, tmp_path)
+
+    pd.testing.assert_frame_equal(screened, str_contains_screen(descriptions, KEYWORDS))
+
+
+def test_cached_screen_matches_uncached_screen_after_keyword_change(tmp_path, descriptions):
+    kwd.screen_descriptions_cached(descriptions, KEYWORDS, DESC_COLS, tmp_path)
+
+    # Changed keywords of a category, another category added and some descriptions edited
+    keywords = dict(KEYWORDS, wind=['wind', 'turbine'], steel=['steel'])
+
+    edited = descriptions.copy()
+    edited.loc[edited.index[::40], 'trade_desc'] = 'offshore wind turbine steel'
+
+    for workers in [1, 2]:
+        cached = kwd.screen_descriptions_cached(edited, keywords, DESC_COLS, tmp_path, workers=workers)
+
+        uncached = kwd.screen_descriptions(edited, kwd.compile_keywords(keywords), DESC_COLS)
+
+        pd.testing.assert_frame_equal(cached, uncached)
+
+    # Categories whose keywords did not change are cached once, changed ones under their new keywords too
+    assert len(list(tmp_path.glob('wind - *.feather'))) == 2
+    assert len(list(tmp_path.glob('solar - *.feather'))) == 1
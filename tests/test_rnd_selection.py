@@ -0,0 +1,51 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+from rnd_new_approach import rnd_methods as mtd
+
+RND_LIMITS = [0.1, 0.5, 0.8, 0.9, 0.99]
+
+
+def nlargest_selection(parent_fins,
+                       rnd_limit):
+    """
+    Grow the selection one company at a time with nlargest, as select_parent_ids_with_rnd did
+    """
+    start = 0.0
+    count = 0
+
+    while start < rnd_limit * parent_fins['rnd_mean'].sum() and count < len(parent_fins):
+        count += 1
+        start = parent_fins.nlargest(count, ['rnd_mean'])['rnd_mean'].sum()
+
+    return parent_fins.nlargest(count, ['rnd_mean'])
+
+
+@pytest.fixture
+def parent_fins():
+    """
+    Random mean rnd of parent companies, with ties and missing values
+    """
+    rng = np.random.default_rng(23)
+
+    rnd_mean = np.round(rng.pareto(1.5, 400) * 100, -1)
+
+    return pd.DataFrame({
+        'bvd9': ['%09d' % i for i in range(400)],
+        'rnd_mean': np.where(rng.random(400) < .1, np.nan, rnd_mean)
+    })
+
+
+def test_ranking_matches_nlargest_loop(parent_fins):
+    (ranked, counts) = mtd.rank_parent_ids_by_rnd(parent_fins, RND_LIMITS)
+
+    for rnd_limit in RND_LIMITS:
+        reference = nlargest_selection(parent_fins, rnd_limit)
+
+        assert counts[rnd_limit] == len(reference)
+
+        pd.testing.assert_frame_equal(ranked.head(counts[rnd_limit]), reference)
+
+        pd.testing.assert_frame_equal(mtd.select_parent_ids_with_rnd(parent_fins, rnd_limit), reference)
@@ -0,0 +1,107 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_input import file_loader as load
+from rnd_new_approach import rnd_methods as mtd
+
+METHODS = ['keep_all', 'keep_subs']
+RANGE_YS = {'rnd_ys': ['rnd_y16', 'rnd_y17', 'rnd_y18'], 'oprev_ys': ['op_revenue_y16', 'op_revenue_y17',
+                                                                     'op_revenue_y18'], 'LY': '18'}
+KEYS = ['method', 'sub_bvd9', 'bvd9', 'year']
+
+
+def random_tables(exposure_by_year,
+                  seed=3):
+    """
+    Random subsidiary exposure and parent rnd of two methods, with missing values and parents without rnd
+    """
+    rng = np.random.default_rng(seed)
+
+    years = [2016, 2017, 2018]
+
+    edges = pd.DataFrame({
+        'bvd9': ['%09d' % i for i in rng.integers(0, 40, 300)],
+        'sub_bvd9': ['%09d' % (100000 + i) for i in rng.integers(0, 250, 300)]
+    }).drop_duplicates()
+
+    sub_exposure = pd.concat([edges.assign(method=method) for method in METHODS], ignore_index=True)
+    sub_exposure = sub_exposure[rng.random(len(sub_exposure)) < .8]
+
+    if exposure_by_year:
+        sub_exposure = pd.concat([sub_exposure.assign(year=year) for year in years], ignore_index=True)
+
+    sub_exposure['sub_exposure'] = np.where(rng.random(len(sub_exposure)) < .1, np.nan, rng.random(len(sub_exposure)))
+
+    parent_rnd = pd.DataFrame([(method, bvd9, year) for method in METHODS for bvd9 in edges.bvd9.unique()
+                               for year in years], columns=['method', 'bvd9', 'year'])
+    parent_rnd = parent_rnd[rng.random(len(parent_rnd)) < .85].reset_index(drop=True)
+
+    parent_rnd['parent_rnd'] = rng.random(len(parent_rnd)) * 1e3
+    parent_rnd['parent_rnd_clean'] = parent_rnd['parent_rnd'].mask(rng.random(len(parent_rnd)) < .1)
+
+    return load.encode_ids(sub_exposure), load.encode_ids(parent_rnd)
+
+
+def run(tmp_path,
+        exposure_by_year,
+        sparse_allocation,
+        sub_exposure,
+        parent_rnd):
+    cases = {'methods': METHODS, 'exposure_by_year': exposure_by_year, 'sparse_allocation': sparse_allocation}
+
+    files = {
+        'rnd_outputs': {'subs': {'rnd': tmp_path.joinpath('sub_rnd_' + str(sparse_allocation) + '.csv')}},
+        'output_options': {'compression': None, 'csv_export': False}
+    }
+
+    (report, sub_rnd) = mtd.compute_sub_rnd(cases, files, RANGE_YS, sub_exposure, parent_rnd)
+
+    load.flush_tables()
+
+    sub_rnd = sub_rnd.dropna(subset=['sub_rnd_clean'])
+
+    return report, sub_rnd.astype({'year': 'int64'}).sort_values(KEYS, ignore_index=True)
+
+
+def check(result, reference):
+    assert len(result) == len(reference)
+
+    for col in KEYS:
+        assert list(result[col]) == list(reference[col])
+
+    for col in ['parent_rnd_clean', 'sub_exposure', 'parent_exposure_from_sub', 'sub_rnd_clean']:
+        np.testing.assert_allclose(result[col].astype(float), reference[col].astype(float), rtol=1e-9)
+
+
+@pytest.mark.parametrize('exposure_by_year', [False, True])
+def test_sparse_matches_join(tmp_path, entities, exposure_by_year):
+    (sub_exposure, parent_rnd) = random_tables(exposure_by_year)
+
+    (join_report, join_rnd) = run(tmp_path, exposure_by_year, False, sub_exposure, parent_rnd)
+    (sparse_report, sparse_rnd) = run(tmp_path, exposure_by_year, True, sub_exposure, parent_rnd)
+
+    assert len(join_rnd) > 0
+
+    check(sparse_rnd, join_rnd)
+
+    for (method, by_year) in join_report.items():
+        assert sparse_report[method] == pytest.approx(by_year, rel=1e-9)
+
+
+@pytest.mark.parametrize('exposure_by_year', [False, True])
+def test_sparse_matches_join_with_duplicated_parents(tmp_path, entities, exposure_by_year):
+    (sub_exposure, parent_rnd) = random_tables(exposure_by_year)
+
+    # Parents listed twice with different rnd, as when parent rnd tables of two vintages are appended
+    duplicates = parent_rnd.iloc[::7].assign(parent_rnd_clean=lambda df: df['parent_rnd_clean'] * 2)
+
+    parent_rnd = pd.concat([parent_rnd, duplicates], ignore_index=True)
+
+    (join_report, join_rnd) = run(tmp_path, exposure_by_year, False, sub_exposure, parent_rnd)
+    (sparse_report, sparse_rnd) = run(tmp_path, exposure_by_year, True, sub_exposure, parent_rnd)
+
+    check(sparse_rnd, join_rnd)
+
+    assert sparse_report == join_report
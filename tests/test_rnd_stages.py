@@ -0,0 +1,183 @@
+# Import libraries
+import importlib
+from pathlib import Path
+
+import pytest
+
+import config as cfg
+from data_input import file_loader as load
+from rnd_new_approach import rnd_stages as stg
+
+RANGE_YS = {'rnd_ys': ['rnd_y17', 'rnd_y18'], 'oprev_ys': ['op_revenue_y17', 'op_revenue_y18'], 'LY': '18'}
+KEYWORDS = {'solar': ['solar', 'photovoltaic'], 'wind': ['wind turbine']}
+
+CASES = {
+    'company_types': ['listed'],
+    'parent_id_files_n': {'listed': 1},
+    'parent_fin_files_n': 1,
+    'rnd_limit': 0.9,
+    'float32': False,
+    'sub_id_files_n': 1,
+    'sub_fin_files_n': 1,
+    'methods': ['keep_all', 'keep_subs'],
+    'select_sub_fins': False,
+    'exposure_by_year': False,
+    'sparse_allocation': False,
+    'previous_case_root': None
+}
+
+# Stages downstream of each stage, following upstream links
+DOWNSTREAM = {
+    'load_sub_fins': ['screen_sub_fins', 'compute_exposure', 'compute_parent_rnd', 'compute_sub_rnd',
+                      'build_rnd_cube'],
+    'screen_sub_fins': ['compute_exposure', 'compute_parent_rnd', 'compute_sub_rnd', 'build_rnd_cube'],
+    'compute_exposure': ['compute_parent_rnd', 'compute_sub_rnd', 'build_rnd_cube']
+}
+
+
+@pytest.fixture
+def case(tmp_path):
+    """
+    Case with one ORBIS export of each kind in its input folder
+    """
+    cases = dict(CASES, root=Path(cfg.__file__).resolve().parent, case_root=tmp_path.joinpath('case'))
+
+    for folder in ['parent_ids', 'parent_fins', 'sub_ids', 'sub_fins']:
+        cases['case_root'].joinpath('input', folder).mkdir(parents=True)
+        cases['case_root'].joinpath('input', folder, folder + '_#1.xlsx').write_bytes(folder.encode())
+
+    return cases, cfg.import_my_files(cases)
+
+
+def run_stages(stages):
+    """
+    Run every stale stage, as rnd_main does, writing placeholder outputs
+    :return: list of the stages that ran
+    """
+    for name, stage in stages['graph'].items():
+        if stg.is_stale(stages, name):
+            for output in stage['outputs']:
+                output.write_text(name)
+
+            stg.mark_done(stages, name)
+
+    return stages['ran']
+
+
+def stale_stages(cases,
+                 files,
+                 keywords=KEYWORDS):
+    stages = stg.init_stages(cases, files, RANGE_YS, keywords)
+
+    return [name for name in stages['graph'] if stg.is_stale(stages, name)]
+
+
+def test_stages_are_up_to_date_after_a_run(case):
+    (cases, files) = case
+
+    stages = stg.init_stages(cases, files, RANGE_YS, KEYWORDS)
+
+    assert all(stg.stale_reasons(stages, name) == ['never run'] for name in stages['graph'])
+
+    assert run_stages(stages) == list(stages['graph'].keys())
+
+    assert stale_stages(cases, files) == []
+
+
+@pytest.mark.parametrize('change', ['config', 'sources', 'keywords'])
+def test_changes_invalidate_downstream_stages_only(case, change):
+    (cases, files) = case
+
+    run_stages(stg.init_stages(cases, files, RANGE_YS, KEYWORDS))
+
+    keywords = KEYWORDS
+
+    if change == 'config':
+        cases = dict(cases, exposure_by_year=True)
+
+        expected = ['compute_exposure'] + DOWNSTREAM['compute_exposure']
+    elif change == 'sources':
+        cases['case_root'].joinpath('input', 'sub_fins', 'sub_fins_#1.xlsx').write_bytes(b'changed sub_fins')
+
+        expected = ['load_sub_fins'] + DOWNSTREAM['load_sub_fins']
+    else:
+        keywords = dict(KEYWORDS, wind=['wind turbine', 'offshore'])
+
+        expected = ['screen_sub_fins'] + DOWNSTREAM['screen_sub_fins']
+
+    assert stale_stages(cases, files, keywords) == expected
+
+
+def test_missing_output_only_invalidates_its_stage(case):
+    (cases, files) = case
+
+    run_stages(stg.init_stages(cases, files, RANGE_YS, KEYWORDS))
+
+    files['rnd_outputs']['parents']['expo'].unlink()
+
+    stages = stg.init_stages(cases, files, RANGE_YS, KEYWORDS)
+
+    assert stale_stages(cases, files) == ['compute_exposure']
+    assert stg.stale_reasons(stages, 'compute_exposure') == ['missing outputs']
+
+    # Stages downstream of a stage that ran in this run run too
+    assert run_stages(stages) == ['compute_exposure'] + DOWNSTREAM['compute_exposure']
+
+
+def test_code_fingerprint_follows_helpers(tmp_path, monkeypatch):
+    module_path = tmp_path.joinpath('stage_code.py')
+
+    source = '''
+COLUMNS = ['bvd9', 'sub_bvd9']
+
+
+def helper(df):
+    return df[COLUMNS]
+
+
+def unused(df):
+    return df
+
+
+def stage(df):
+    return [helper(row) for row in df]
+
+
+def other(df):
+    return unused(df)
+'''
+
+    module_path.write_text(source)
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    module = importlib.import_module('stage_code')
+
+    sources = load.code_sources([module.stage], ['stage_code'])
+
+    assert sorted(sources.keys()) == ['stage_code.COLUMNS', 'stage_code.helper', 'stage_code.stage']
+
+    other_sources = load.code_sources([module.other], ['stage_code'])
+
+    # Editing a helper changes the code fingerprint of the functions calling it only
+    module_path.write_text(source.replace('return df[COLUMNS]', 'return df[COLUMNS].copy()'))
+
+    module = importlib.reload(module)
+
+    assert load.code_sources([module.stage], ['stage_code']) != sources
+    assert load.code_sources([module.other], ['stage_code']) == other_sources
+
+
+def test_stage_code_is_specific_to_each_stage(case):
+    (cases, files) = case
+
+    graph = stg.stage_graph(cases, files, RANGE_YS, KEYWORDS)
+
+    cube_code = load.code_sources(graph['build_rnd_cube']['code'], stg.CODE_PACKAGES)
+    parent_code = load.code_sources(graph['select_parents']['code'], stg.CODE_PACKAGES)
+
+    assert 'rnd_new_approach.rnd_star.take' in cube_code
+    assert 'data_input.file_loader.read_results_sheet' in parent_code
+
+    assert not any(name.startswith('rnd_new_approach.rnd_star') for name in parent_code)
+    assert 'data_input.file_loader.read_results_sheet' not in cube_code
@@ -0,0 +1,64 @@
+# Import libraries
+import numpy as np
+import pandas as pd
+
+from rnd_new_approach import rnd_star as star
+
+
+def test_grouping_sets_match_two_groupbys():
+    rng = np.random.default_rng(17)
+
+    row_n = 5000
+
+    # Key codes with missing values (-1), values with missing values and flagged rows
+    codes = [rng.integers(-1, 6, row_n), rng.integers(0, 4, row_n), rng.integers(-1, 3, row_n)]
+    values = [np.where(rng.random(row_n) < .1, np.nan, rng.random(row_n)) for index in range(2)]
+    flags = rng.random(row_n) < .3
+
+    totals = star.grouping_sets(codes, iter(values), flags)
+
+    table = pd.DataFrame({'key0': codes[0], 'key1': codes[1], 'key2': codes[2], 'value0': values[0],
+                          'value1': values[1], 'flag': flags.astype(int)})
+
+    table = table[(table[['key0', 'key1', 'key2']] >= 0).all(axis=1)]
+
+    keys = ['key0', 'key1', 'key2']
+
+    for (grouping_set, rows) in ((0, table), (1, table[table.flag == 1])):
+        reference = rows.groupby(keys)[['value0', 'value1']].sum().reset_index()
+        reference = pd.merge(reference, table.groupby(keys)['flag'].sum().reset_index(), on=keys)
+
+        in_set = totals['sets'] == grouping_set
+
+        result = pd.DataFrame({
+            'key0': totals['codes'][0][in_set],
+            'key1': totals['codes'][1][in_set],
+            'key2': totals['codes'][2][in_set],
+            'value0': totals['sums'][0][in_set],
+            'value1': totals['sums'][1][in_set],
+            'flag': totals['flagged_n'][in_set]
+        })
+
+        pd.testing.assert_frame_equal(result, reference, check_dtype=False)
+
+
+def test_group_keys_match_sorted_groupby():
+    rng = np.random.default_rng(19)
+
+    codes = [rng.integers(-1, 5, 1000), rng.integers(0, 7, 1000)]
+
+    (rows, group_codes) = star.group_keys(codes)
+
+    table = pd.DataFrame({'key0': codes[0], 'key1': codes[1]})
+
+    known = (table >= 0).all(axis=1)
+
+    reference = table[known].groupby(['key0', 'key1']).ngroup()
+
+    assert list(rows[known.values]) == list(reference)
+    assert (rows[~known.values] == -1).all()
+
+    groups = table[known].drop_duplicates().sort_values(['key0', 'key1'])
+
+    assert list(group_codes[0]) == list(groups['key0'])
+    assert list(group_codes[1]) == list(groups['key1'])